@@ -1,8 +1,9 @@
 import requests
 import config
+from bot_registry import BOTS
 url = config.API_BASE_URL + "subscriptions" #url MAX
-BTokens = [config.BOT_TOKEN_INVEST, config.BOT_TOKEN_SOTR, config.BOT_TOKEN_CHECK, config.BOT_TOKEN_ISP, config.BOT_TOKEN_IQ]
-hooks = ["webhook", "webhook1", "webhook2", "webhook3", "webhook4"]
+BTokens = [bot.token for bot in BOTS]
+hooks = [bot.route for bot in BOTS]
 
 for tkn in range(len(BTokens)):
     headers = {
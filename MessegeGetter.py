@@ -1,93 +1,247 @@
-from turtledemo.penrose import inflatedart
-
-import requests
-from config import *
-import time
-import json
-import re
-import logging.handlers
+import argparse
+import logging
 import os
-from flask import Flask, request, jsonify
-url = API_BASE_URL + "updates" #url MAX
-BTokens = [BOT_TOKEN_INVEST, BOT_TOKEN_SOTR, BOT_TOKEN_CHECK, BOT_TOKEN_ISP, BOT_TOKEN_IQ]
-
-
-LOG_DIR = 'logs'
-os.makedirs(LOG_DIR, exist_ok=True)
-
-# Ротация логов: 10 файлов по 5 МБ каждый
-file_handler = logging.handlers.RotatingFileHandler(
-    os.path.join(LOG_DIR, 'app.log'),
-    maxBytes=5 * 1024 * 1024,
-    backupCount=10,
-    encoding='utf-8'
-)
-file_handler.setFormatter(logging.Formatter(
-    '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-))
-
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
-
-logging.basicConfig(
-    level=logging.INFO,
-    handlers=[file_handler, console_handler]
-)
-logger = logging.getLogger(__name__)
-
-
-
-def sanitize_filename(name):
-    """Оставляет в имени файла только безопасные символы (цифры и буквы)."""
-    if name is None:
-        return "unknown"
-    # Разрешаем только цифры, буквы, дефис и подчеркивание
-    return re.sub(r'[^\w\-]', '', str(name))
+import random
+import threading
+import time
 
-def save_message_to_log(filename, data, dir):
-    """Сохраняет входящее сообщение в файл с именем chat_id."""
-    try:
-        if not os.path.exists(dir):
-            os.makedirs(dir)
+import requests
 
-        safe_filename = sanitize_filename(filename)
-        file_path = os.path.join(dir, f"{safe_filename}.txt")  #
+import app_logging
+import config
+from bot_registry import BOTS, BOTS_BY_NAME
+from max_client import client
+from rate_limit import parse_retry_after
+from template_cache import templates
+from update_handlers import DUPLICATE, FAILED, process_update
+
+# ==================== КОНФИГУРАЦИЯ ====================
+POLL_LIMIT = getattr(config, "POLL_LIMIT", 100)  # Update за один запрос (1..1000)
+POLL_TIMEOUT = getattr(config, "POLL_TIMEOUT", 30)  # Ожидание на стороне сервера (сек, 0..90)
+POLL_UPDATE_TYPES = getattr(config, "POLL_UPDATE_TYPES",
+                            ("message_created", "bot_started", "message_callback", "bot_stopped"))
+POLL_MARKER_DIR = getattr(config, "POLL_MARKER_DIR", os.path.join("data", "markers"))  # Сохранённые marker
+POLL_IDLE_DELAY = getattr(config, "POLL_IDLE_DELAY", 1.0)  # Пауза, если сервер вернул пустой ответ сразу
+POLL_MAX_IDLE_DELAY = getattr(config, "POLL_MAX_IDLE_DELAY", 30.0)
+POLL_ERROR_DELAY = getattr(config, "POLL_ERROR_DELAY", 1.0)  # Пауза после ошибки (удваивается)
+POLL_MAX_ERROR_DELAY = getattr(config, "POLL_MAX_ERROR_DELAY", 60.0)
+POLL_REPORT_INTERVAL = getattr(config, "POLL_REPORT_INTERVAL", 60.0)  # Сводка состояния опроса в лог (сек)
+
+url = config.API_BASE_URL + "updates" #url MAX
 
-        with open(file_path, 'a', encoding='cp1251', errors='ignore') as f:
-            f.write(json.dumps(data, ensure_ascii=False) + '\n')
+logger = logging.getLogger(__name__)
 
-    except Exception as e:
-        logger.exception(f"Error saving log for {filename}: {e}")
 
-while True:
-    try:
-        headers = {
-            "Authorization": BTokens[1],  # Токен Бота
-            "Content-Type": "application/json"
+class UpdatePoller:
+    """
+    Long polling GET /updates для одного бота (запасной путь, когда вебхук недоступен).
+    Сервер держит запрос до POLL_TIMEOUT секунд, пока не появятся update; marker последней
+    обработанной пачки сохраняется на диск, поэтому после перезапуска update не приходят повторно.
+    Каждый update проходит тот же конвейер, что и вебхук (update_handlers.process_update).
+    """
+
+    def __init__(self, bot, limit=POLL_LIMIT, timeout=POLL_TIMEOUT, types=POLL_UPDATE_TYPES,
+                 marker_dir=POLL_MARKER_DIR):
+        self.bot = bot
+        self._limit = limit
+        self._timeout = timeout
+        self._types = ",".join(types)
+        self._marker_path = os.path.join(marker_dir, f"{bot.name}.marker")
+        self.marker = self._load_marker()
+        self._idle_delay = 0.0
+        self._error_delay = 0.0
+        self._lock = threading.Lock()
+        self._stats = {
+            "polls": 0,
+            "updates": 0,
+            "duplicates": 0,
+            "failed": 0,
+            "errors": 0,
+            "last_success": None,
+            "last_error": None,
         }
-        response = requests.get(url, headers=headers)
-        data = response.json()
-        #print(response.text)
-        updates = data.get('updates', {})
+
+    def run(self, stop=None):
+        """Цикл опроса до stop.set() (или бесконечно)."""
+        stop = stop or threading.Event()
+        logger.info("Polling updates for %s from marker %s", self.bot.name, self.marker)
+        while not stop.is_set():
+            delay = self.poll_once()
+            if delay:
+                stop.wait(delay)
+
+    def poll_once(self):
+        """Один запрос к /updates. Возвращает паузу до следующего запроса (сек)."""
+        params = {"limit": self._limit, "timeout": self._timeout, "types": self._types}
+        if self.marker is not None:
+            params["marker"] = self.marker
+        started = time.monotonic()
+        try:
+            # Таймаут чтения больше серверного ожидания, иначе long poll оборвётся на нашей стороне
+            response = client.request("GET", url, self.bot.token, params=params, timeout=(10, self._timeout + 10))
+        except requests.exceptions.RequestException as e:
+            return self._failed(f"request error: {e}")
+
+        if response.status_code == 429:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            return self._failed("rate limited (429)", retry_after)
+        if response.status_code != 200:
+            return self._failed(f"HTTP {response.status_code}: {response.text[:200]}")
+        try:
+            data = response.json()
+        except ValueError as e:
+            return self._failed(f"invalid JSON: {e}")
+
+        updates = data.get("updates") or []
         for update in updates:
-            callback = update.get('callback', {})
-            message = update.get('message', {})
-
-            if message:
-                logger.info(data)
-                message_id = message.get('body', {}).get('mid')
-                chat_id = message.get('recipient', {}).get('chat_id')
-                save_message_to_log("message_" + message_id + '_chat_id_' + str(chat_id), data, LOGS_DIR_SOTR)
-
-            if callback:
-                logger.info(data)
-                callback_id = callback.get('callback_id')
-                message_id = data.get('message', {}).get('body', {}).get('mid')
-                chat_id = callback.get('recipient', {}).get('chat_id')
-                save_message_to_log("callback_id_" + callback_id + "_chat_id_" + str(chat_id), data, LOGS_DIR_SOTR)
-                pressed_button = callback.get("payload")
-
-
-    except Exception as e:
-            print(f"Ошибка при запросе getUpdates: {e}")
-            time.sleep(5)
+            self._process(update)
+        # marker сохраняем после обработки: при сбое пачка придёт снова, дубли отсечёт идемпотентность
+        if data.get("marker") is not None and data.get("marker") != self.marker:
+            self.marker = data["marker"]
+            self._save_marker()
+
+        with self._lock:
+            self._stats["polls"] += 1
+            self._stats["updates"] += len(updates)
+            self._stats["last_success"] = time.time()
+        self._error_delay = 0.0
+        if updates:
+            self._idle_delay = 0.0
+            return 0.0
+        # Пустой ответ после полного ожидания - нормальный простой, сразу ждём снова.
+        # Пустой ответ сразу (сервер не держит запрос) - увеличиваем паузу, чтобы не крутить цикл
+        if time.monotonic() - started >= self._timeout / 2:
+            self._idle_delay = 0.0
+            return 0.0
+        self._idle_delay = min(POLL_MAX_IDLE_DELAY, max(POLL_IDLE_DELAY, self._idle_delay * 2))
+        return self._idle_delay
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["marker"] = self.marker
+        stats["backoff"] = max(self._idle_delay, self._error_delay)
+        return stats
+
+    # ---------- Внутреннее ----------
+
+    def _process(self, update):
+        try:
+            result = process_update(self.bot, update)
+            if result is DUPLICATE or result is FAILED:
+                with self._lock:
+                    self._stats["duplicates" if result is DUPLICATE else "failed"] += 1
+        except Exception as e:
+            logger.exception("Error processing polled update for %s: %s", self.bot.name, e)
+
+    def _failed(self, reason, retry_after=None):
+        self._error_delay = min(POLL_MAX_ERROR_DELAY, max(POLL_ERROR_DELAY, self._error_delay * 2))
+        delay = retry_after if retry_after is not None else self._error_delay * random.uniform(0.8, 1.2)
+        with self._lock:
+            self._stats["errors"] += 1
+            self._stats["last_error"] = reason
+        logger.warning("Polling %s failed: %s, retry in %.1fs", self.bot.name, reason, delay)
+        return delay
+
+    def _load_marker(self):
+        try:
+            with open(self._marker_path, "r", encoding="utf-8") as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def _save_marker(self):
+        try:
+            os.makedirs(os.path.dirname(self._marker_path), exist_ok=True)
+            tmp = f"{self._marker_path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(str(self.marker))
+            os.replace(tmp, self._marker_path)
+        except OSError as e:
+            logger.error("Failed to save marker for %s: %s", self.bot.name, e)
+
+
+class PollingSupervisor:
+    """
+    Опрос всех ботов одновременно: у каждого токена свой поток, UpdatePoller (marker, паузы)
+    и своя HTTP-сессия в max_client. Медленный или недоступный бот ждёт в своём потоке
+    и не задерживает остальных. Упавший поток перезапускается.
+    """
+
+    def __init__(self, bots=None):
+        self.pollers = {bot.name: UpdatePoller(bot) for bot in (bots or BOTS)}
+        self._threads = {}
+        self._restarts = {name: 0 for name in self.pollers}
+        self._started = {}
+        self._stop = threading.Event()
+
+    def start(self):
+        for name in self.pollers:
+            self._spawn(name)
+        logger.info("Polling supervisor started for %s", ', '.join(self.pollers))
+
+    def run(self):
+        """Запускает опрос и следит за потоками до stop() или Ctrl+C."""
+        self.start()
+        last_report = time.monotonic()
+        try:
+            while not self._stop.wait(1.0):
+                for name, thread in self._threads.items():
+                    if not thread.is_alive():
+                        self._restarts[name] += 1
+                        logger.error("Polling thread for %s died, restarting", name)
+                        self._spawn(name)
+                if time.monotonic() - last_report >= POLL_REPORT_INTERVAL:
+                    last_report = time.monotonic()
+                    self._report()
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        # Поток может висеть в long poll до POLL_TIMEOUT секунд
+        timeout = POLL_TIMEOUT + 15 if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        for thread in self._threads.values():
+            thread.join(max(0, deadline - time.monotonic()))
+        logger.info("Polling supervisor stopped")
+
+    def status(self):
+        """Состояние опроса по каждому боту."""
+        now = time.time()
+        result = {}
+        for name, poller in self.pollers.items():
+            stats = poller.stats()
+            # До первого ответа отсчитываем от запуска потока
+            last = stats["last_success"] or self._started.get(name)
+            stats["alive"] = name in self._threads and self._threads[name].is_alive()
+            # Успешный long poll завершается не реже, чем раз в POLL_TIMEOUT
+            stats["healthy"] = stats["alive"] and last is not None and now - last < POLL_TIMEOUT * 2 + stats["backoff"]
+            stats["restarts"] = self._restarts[name]
+            result[name] = stats
+        return result
+
+    def _spawn(self, name):
+        thread = threading.Thread(target=self.pollers[name].run, args=(self._stop,),
+                                  name=f"poll-{name}", daemon=True)
+        thread.start()
+        self._threads[name] = thread
+        self._started[name] = time.time()
+
+    def _report(self):
+        for name, stats in self.status().items():
+            logger.info("Polling %s: %s, updates %s, errors %s, marker %s", name,
+                        "healthy" if stats["healthy"] else "UNHEALTHY", stats["updates"], stats["errors"],
+                        stats["marker"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Получение update через long polling")
+    parser.add_argument("--bot", action="append", choices=sorted(BOTS_BY_NAME),
+                        help="Опрашивать только этого бота (можно несколько раз); по умолчанию - всех")
+    args = parser.parse_args()
+    app_logging.setup_logging()
+    templates.start()
+    bots = [BOTS_BY_NAME[name] for name in args.bot] if args.bot else BOTS
+    PollingSupervisor(bots).run()
@@ -0,0 +1,168 @@
+import atexit
+import itertools
+import logging
+import logging.handlers
+import os
+import queue
+
+import config
+
+# ==================== КОНФИГУРАЦИЯ ====================
+LOG_DIR = getattr(config, "LOG_DIR", "logs")
+LOG_LEVEL = getattr(config, "LOG_LEVEL", "INFO")
+LOG_FILE_MAX_BYTES = getattr(config, "LOG_FILE_MAX_BYTES", 5 * 1024 * 1024)  # Ротация: 10 файлов по 5 МБ
+LOG_FILE_BACKUP_COUNT = getattr(config, "LOG_FILE_BACKUP_COUNT", 10)
+LOG_QUEUE_SIZE = getattr(config, "LOG_QUEUE_SIZE", 10000)  # Записей в очереди; при переполнении - отбрасываем
+# Уровень полного дампа update в лог ("Webhook [type]|{...}"); DEBUG - все дампы только при отладке
+LOG_PAYLOAD_LEVEL = getattr(config, "LOG_PAYLOAD_LEVEL", "DEBUG")
+# Выборка дампов: {"message_created": 100} - каждый 100-й update типа пишется на LOG_PAYLOAD_SAMPLE_LEVEL,
+# чтобы в обычном логе оставались примеры; остальные - только на LOG_PAYLOAD_LEVEL
+LOG_PAYLOAD_SAMPLE = getattr(config, "LOG_PAYLOAD_SAMPLE", {})
+LOG_PAYLOAD_SAMPLE_LEVEL = getattr(config, "LOG_PAYLOAD_SAMPLE_LEVEL", "INFO")
+
+
+def _level(value):
+    return logging.getLevelName(value) if isinstance(value, str) else value
+
+
+_PAYLOAD_LEVEL = _level(LOG_PAYLOAD_LEVEL)
+_SAMPLE_LEVEL = _level(LOG_PAYLOAD_SAMPLE_LEVEL)
+_sample_every = {update_type: max(1, int(every)) for update_type, every in LOG_PAYLOAD_SAMPLE.items()}
+_sample_counters = {update_type: itertools.count() for update_type in _sample_every}
+
+_queue = None
+_listener = None
+_handlers = []
+_dropped = 0
+_log_dir = LOG_DIR
+_file_name = "app.log"
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler без форматирования в потоке запроса: стандартный prepare() собирает
+    сообщение (и repr всего update) ещё до постановки в очередь. Слушатель работает в том
+    же процессе, поэтому запись с аргументами можно передать как есть - аргументы
+    (разобранный update) после обработки не изменяются.
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        global _dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Поток запроса не ждёт диск: при переполнении запись теряется, но учитывается
+            _dropped += 1
+
+
+def _create_file_handler(log_dir):
+    os.makedirs(log_dir, exist_ok=True)
+    file_handler = logging.handlers.RotatingFileHandler(
+        os.path.join(log_dir, _file_name),
+        maxBytes=LOG_FILE_MAX_BYTES,
+        backupCount=LOG_FILE_BACKUP_COUNT,
+        encoding='utf-8'
+    )
+    file_handler.setFormatter(logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    ))
+    return file_handler
+
+
+def _create_handlers(log_dir):
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+    return [_create_file_handler(log_dir), console_handler]
+
+
+def _start_listener():
+    global _queue, _listener
+    _queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    # respect_handler_level: уровни обработчиков проверяет слушатель, а не поток запроса
+    _listener = logging.handlers.QueueListener(_queue, *_handlers, respect_handler_level=True)
+    _listener.start()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, _DeferredQueueHandler):
+            root.removeHandler(handler)
+    root.addHandler(_DeferredQueueHandler(_queue))
+
+
+def setup_logging(log_dir=LOG_DIR, level=LOG_LEVEL):
+    """
+    Логи приложения через очередь: потоки запросов только кладут запись в очередь,
+    форматирование, ротацию и запись в файл/консоль выполняет отдельный поток-слушатель.
+    Повторный вызов ничего не делает.
+    """
+    global _log_dir
+    if _listener is not None:
+        return
+    _log_dir = log_dir
+    _handlers.extend(_create_handlers(log_dir))
+    logging.getLogger().setLevel(level)
+    _start_listener()
+
+
+def stop_logging():
+    """Дописывает очередь и останавливает слушатель (вызывается при выходе)."""
+    global _listener
+    if _listener is None:
+        return
+    listener, _listener = _listener, None
+    listener.stop()
+
+
+def set_worker_tag(tag):
+    """
+    Свой файл логов процесса-обработчика pre-fork (app-<tag>.log, например app-w1.log):
+    RotatingFileHandler не умеет безопасно ротировать файл, в который пишут несколько процессов.
+    Вызывается в дочернем процессе до начала обработки запросов; app.log остаётся мастеру.
+    """
+    global _file_name
+    _file_name = f"app-{tag}.log"
+    if _listener is None:
+        return
+    stop_logging()  # Дописать очередь в старые обработчики
+    for i, handler in enumerate(_handlers):
+        if isinstance(handler, logging.handlers.RotatingFileHandler):
+            handler.close()  # Закрывает копию дескриптора родителя, сам родитель пишет дальше
+            _handlers[i] = _create_file_handler(_log_dir)
+    _start_listener()
+
+
+def payload_level(logger, update_type):
+    """
+    Уровень, на котором писать полный дамп update этого типа, или None - не писать.
+    Попавший в выборку LOG_PAYLOAD_SAMPLE - на LOG_PAYLOAD_SAMPLE_LEVEL, остальные - на LOG_PAYLOAD_LEVEL.
+    Проверяется до построения сообщения.
+    """
+    counter = _sample_counters.get(update_type)
+    # next() у itertools.count атомарен под GIL - отдельная блокировка не нужна
+    if counter is not None and logger.isEnabledFor(_SAMPLE_LEVEL) and next(counter) % _sample_every[update_type] == 0:
+        return _SAMPLE_LEVEL
+    return _PAYLOAD_LEVEL if logger.isEnabledFor(_PAYLOAD_LEVEL) else None
+
+
+def stats():
+    return {
+        "queue_depth": _queue.qsize() if _queue is not None else 0,
+        "dropped": _dropped,
+    }
+
+
+atexit.register(stop_logging)
+
+
+def _after_fork():
+    """Поток-слушатель родителя в дочернем процессе не существует - запускаем свой со своей очередью."""
+    global _dropped
+    if _listener is None:
+        return
+    _dropped = 0
+    _start_listener()
+
+
+os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,208 @@
+import asyncio
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import config
+import metrics
+import profiler
+import outbound_queue
+from async_outbound import AsyncOutboundDispatcher
+from bot_registry import BOTS_BY_ROUTE
+from template_cache import templates
+from update_handlers import DUPLICATE, FAILED, process_update
+from webhook_auth import auth as webhook_auth
+
+logger = logging.getLogger(__name__)
+
+# ==================== КОНФИГУРАЦИЯ ====================
+ASGI_CONNECTION_LIMIT = getattr(config, "ASGI_CONNECTION_LIMIT", 10000)  # Одновременных соединений
+ASGI_MAX_BODY = getattr(config, "ASGI_MAX_BODY", 10485760)  # Макс размер тела запроса (10 MB)
+# Потоков для обработчиков update: журнал, реестры, SQLite - блокирующий код, в цикле событий его не запускаем
+ASGI_HANDLER_THREADS = getattr(config, "ASGI_HANDLER_THREADS", 16)
+
+
+class WebhookASGIApp:
+    """
+    ASGI-приложение с теми же маршрутами, что и Flask-приложение main.py:
+    /<hook> (GET - проверка, POST - update), /health, /metrics и /admin/profile.
+    Обработка update - тот же конвейер update_handlers в пуле потоков (ASGI_HANDLER_THREADS),
+    исходящие вызовы - AsyncOutboundDispatcher.
+    """
+
+    def __init__(self, health=None, metrics_text=None):
+        self._health = health
+        self._metrics = metrics_text or metrics.render
+        self._dispatcher = None
+        self._previous_dispatcher = None
+        self._executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    # ---------- Жизненный цикл ----------
+
+    async def startup(self):
+        self._executor = ThreadPoolExecutor(ASGI_HANDLER_THREADS, thread_name_prefix="asgi-handler")
+        templates.start()
+        self._dispatcher = AsyncOutboundDispatcher()
+        await self._dispatcher.start()
+        self._previous_dispatcher = outbound_queue.install(self._dispatcher)
+
+    async def shutdown(self):
+        if self._executor is not None:
+            # Сначала доработать принятые update - они ещё ставят исходящие в диспетчер
+            await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
+        if self._dispatcher is not None:
+            await self._dispatcher.shutdown()
+            outbound_queue.install(self._previous_dispatcher)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.startup()
+                except Exception as e:
+                    logger.exception("ASGI startup failed: %s", e)
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    # ---------- HTTP ----------
+
+    async def _http(self, scope, receive, send):
+        path = scope["path"].strip("/")
+        method = scope["method"]
+
+        if path == "health" and method == "GET":
+            await self._respond(send, 200, self._health() if self._health else {"status": "healthy"})
+            return
+        if path == "metrics" and method == "GET":
+            await self._respond(send, 200, self._metrics().encode("utf-8"), content_type=metrics.CONTENT_TYPE)
+            return
+        if path == "admin/profile" and method == "GET":
+            await self._profile(scope, send)
+            return
+
+        bot = BOTS_BY_ROUTE.get(path)
+        if bot is None:
+            await self._respond(send, 404, {"error": "Not found"})
+            return
+        if method == "GET":
+            await self._respond(send, 200, {"status": "webhook_active"})
+            return
+        if method != "POST":
+            await self._respond(send, 405, {"error": "Method not allowed"})
+            return
+
+        started = time.perf_counter()
+        status = await self._webhook(bot, scope, receive, send)
+        metrics.webhook_seconds.observe(time.perf_counter() - started, bot.name)
+        metrics.webhook_requests.inc(bot.name, str(status))
+
+    async def _webhook(self, bot, scope, receive, send):
+        """POST с update для бота; возвращает отправленный HTTP-статус."""
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+        if not headers.get("content-type", "").startswith("application/json"):
+            logger.warning("Received non-JSON request")
+            return await self._respond(send, 400, {"error": "Content-Type must be application/json"})
+
+        body = await self._read_body(receive)
+        if body is None:
+            return await self._respond(send, 413, {"error": "Request body too large"})
+        # Подпись - по сырому телу, до разбора JSON
+        signature = headers.get("x-hub-signature-256") or headers.get("x-hub-signature")
+        if not webhook_auth.check(bot, body, signature):
+            return await self._respond(send, 403, {"error": "Forbidden"})
+        try:
+            data = json.loads(body)
+        except ValueError as e:
+            logger.error("Failed to parse JSON: %s", e)
+            return await self._respond(send, 400, {"error": "Invalid JSON"})
+
+        response = await asyncio.get_running_loop().run_in_executor(self._executor, process_update, bot, data)
+        if response is DUPLICATE:
+            return await self._respond(send, 200, {"status": "duplicate"})
+        if response is FAILED:
+            return await self._respond(send, 200, '')
+        return await self._respond(send, 200, response)
+
+    async def _profile(self, scope, send):
+        """Аналог /admin/profile main.py; сэмплер работает в пуле потоков, цикл событий не блокируется."""
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+        if not profiler.authorized(headers.get("x-admin-token")):
+            await self._respond(send, 404, {"error": "Not found"})
+            return
+        query = {k: v[0] for k, v in parse_qs(scope.get("query_string", b"").decode("latin-1")).items()}
+        try:
+            seconds, interval = profiler.parse_params(query.get("seconds", profiler.PROFILER_DEFAULT_SECONDS),
+                                                      query.get("interval", profiler.PROFILER_INTERVAL))
+        except ValueError:
+            await self._respond(send, 400, {"error": "seconds and interval must be finite numbers"})
+            return
+        result = await asyncio.get_running_loop().run_in_executor(
+            None, profiler.profile, seconds, interval, query.get("threads"))
+        if result is None:
+            await self._respond(send, 409, {"error": "Profiler is already running"})
+            return
+        await self._respond(send, 200, result[0].encode("utf-8"), content_type="text/plain; charset=utf-8")
+
+    @staticmethod
+    async def _read_body(receive):
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > ASGI_MAX_BODY:
+                return None
+            chunks.append(chunk)
+            if not message.get("more_body"):
+                return b"".join(chunks)
+
+    @staticmethod
+    async def _respond(send, status, payload, content_type="application/json"):
+        if isinstance(payload, bytes):
+            body = payload
+        else:
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", content_type.encode("latin-1")),
+                (b"content-length", str(len(body)).encode("ascii")),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+        return status
+
+
+def run_asgi(host, port, health=None, metrics_text=None):
+    """Запуск в асинхронном режиме через uvicorn (один поток, тысячи соединений)."""
+    try:
+        import uvicorn
+    except ImportError:
+        raise RuntimeError("ASGI mode requires uvicorn: pip install uvicorn aiohttp")
+
+    logger.info("Starting ASGI server on %s:%s (limit %s connections)", host, port, ASGI_CONNECTION_LIMIT)
+    uvicorn.run(
+        WebhookASGIApp(health, metrics_text),
+        host=host,
+        port=port,
+        limit_concurrency=ASGI_CONNECTION_LIMIT,
+        proxy_headers=True,  # Nginx перед нами, как ProxyFix во Flask-режиме
+        log_config=None,  # Логирование уже настроено в main.py
+        lifespan="on",
+    )
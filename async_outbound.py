@@ -0,0 +1,260 @@
+import asyncio
+import itertools
+import logging
+import threading
+import time
+
+import config
+from bot_registry import mask_token
+from outbound_queue import (BULK, DISPATCH_BACKOFF, DISPATCH_BULK_QUEUE_SIZE, DISPATCH_DRAIN_TIMEOUT,
+                            DISPATCH_MAX_RETRIES, DISPATCH_QUEUE_SIZE, INTERACTIVE, TRANSIENT_STATUS_CODES)
+import rate_limit
+from rate_limit import RATE_LIMIT_DEFAULT_RETRY_AFTER, parse_retry_after
+from reqv_to_bot import observe_call
+
+try:
+    import aiohttp
+except ImportError:  # aiohttp нужен только для ASGI-режима
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+# ==================== КОНФИГУРАЦИЯ ====================
+ASYNC_DISPATCH_WORKERS = getattr(config, "ASYNC_DISPATCH_WORKERS", 64)  # Одновременных запросов к API
+ASYNC_HTTP_TIMEOUT = getattr(config, "ASYNC_HTTP_TIMEOUT", 15)  # Таймаут запроса (сек)
+ASYNC_KEEPALIVE_TIMEOUT = getattr(config, "ASYNC_KEEPALIVE_TIMEOUT", 60)  # Держать простаивающее соединение (сек)
+ASYNC_HTTP_LIMIT = getattr(config, "ASYNC_HTTP_LIMIT", 100)  # Макс. открытых соединений к API
+
+# kind -> (HTTP-метод, параметр адреса)
+_ENDPOINTS = {
+    "send": ("POST", "user_id"),
+    "delete": ("DELETE", "message_id"),
+    "edit": ("PUT", "message_id"),
+}
+
+_LANE_PRIORITY = {INTERACTIVE: 0, BULK: 1}
+
+
+class AsyncOutboundDispatcher:
+    """
+    Асинхронный аналог OutboundDispatcher для ASGI-режима: очередь asyncio + корутины-отправители
+    поверх aiohttp. Тысячи ожидающих вызовов API не занимают ни одного потока ОС.
+    Интерфейс тот же: send_message / delete_message / edit_message / stats,
+    те же полосы приоритета и общие с синхронным диспетчером лимиты rate_limit.
+    """
+
+    def __init__(self, maxsize=DISPATCH_QUEUE_SIZE, workers=ASYNC_DISPATCH_WORKERS,
+                 max_retries=DISPATCH_MAX_RETRIES, backoff=DISPATCH_BACKOFF,
+                 bulk_maxsize=DISPATCH_BULK_QUEUE_SIZE, rate_limiter=None):
+        if aiohttp is None:
+            raise RuntimeError("ASGI mode requires aiohttp: pip install aiohttp")
+        self._maxsizes = {INTERACTIVE: maxsize, BULK: bulk_maxsize}
+        self._depth = {INTERACTIVE: 0, BULK: 0}
+        self._seq = itertools.count()
+        self._limiter = rate_limiter
+        self._workers_count = workers
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._queue = None
+        self._loop = None
+        self._loop_thread = None
+        self._lock = threading.Lock()  # submit вызывается и из потоков обработчиков update
+        self._tasks = []
+        self._sessions = {}
+        self._connector = None
+        self._stopping = False
+        self._stats = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "retried": 0,
+            "dropped": 0,
+            "throttled": 0,
+            "rate_limited": 0,
+        }
+
+    # ---------- Жизненный цикл (внутри event loop) ----------
+
+    async def start(self):
+        # (приоритет полосы, порядковый номер, ...) - интерактивные задания обгоняют рассылки
+        self._queue = asyncio.PriorityQueue()
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        # Общий пул соединений на все токены; keep-alive как у синхронного клиента
+        self._connector = aiohttp.TCPConnector(
+            limit=ASYNC_HTTP_LIMIT,
+            keepalive_timeout=ASYNC_KEEPALIVE_TIMEOUT,
+        )
+        self._tasks = [asyncio.create_task(self._worker(), name=f"outbound-async-{i}")
+                       for i in range(self._workers_count)]
+        logger.info("Async outbound dispatcher started with %s workers", self._workers_count)
+
+    async def shutdown(self, timeout=DISPATCH_DRAIN_TIMEOUT):
+        """Дожидается опустошения очереди (не дольше timeout) и закрывает соединения."""
+        if self._stopping or self._queue is None:
+            return
+        self._stopping = True
+        logger.info("Draining async outbound queue (%s jobs left)", self._queue.qsize())
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Async outbound queue not drained in %ss", timeout)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for session in self._sessions.values():
+            await session.close()
+        await self._connector.close()
+        logger.info("Async outbound dispatcher stopped")
+
+    # ---------- Публичный API ----------
+
+    @property
+    def limiter(self):
+        """Переданный планировщик или общий rate_limit.limiter."""
+        return self._limiter or rate_limit.limiter
+
+    def submit(self, kind, *args, lane=INTERACTIVE, block=False, timeout=None, callback=None):
+        # block/timeout - для совместимости с OutboundDispatcher: event loop блокировать нельзя
+        if self._stopping or self._queue is None:
+            with self._lock:
+                self._stats["dropped"] += 1
+            logger.warning("Async outbound dispatcher is not running, job %s dropped", kind)
+            return False
+        with self._lock:
+            full = self._depth[lane] >= self._maxsizes[lane]
+            if full:
+                self._stats["dropped"] += 1
+            else:
+                self._depth[lane] += 1
+                self._stats["submitted"] += 1
+        if full:
+            logger.warning("Async outbound %s queue is full (%d), job %s dropped", lane, self._maxsizes[lane], kind)
+            return False
+        item = (_LANE_PRIORITY[lane], next(self._seq), lane, kind, args, callback)
+        if threading.get_ident() == self._loop_thread:
+            self._queue.put_nowait(item)
+        else:
+            # Очередь asyncio не потокобезопасна - из пула обработчиков ставим через цикл событий
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+        return True
+
+    def send_message(self, user_id, payload, token, lane=INTERACTIVE, block=False, callback=None):
+        return self.submit("send", user_id, payload, token, lane=lane, block=block, callback=callback)
+
+    def delete_message(self, message_id, token):
+        return self.submit("delete", message_id, token)
+
+    def edit_message(self, message_id, payload, token):
+        return self.submit("edit", message_id, payload, token)
+
+    def queue_depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["lanes"] = dict(self._depth)
+        stats["queue_depth"] = self.queue_depth()
+        stats["workers"] = len(self._tasks)
+        stats["rate_limits"] = self.limiter.stats()
+        stats["mode"] = "asyncio"
+        stats["sessions"] = [mask_token(token) for token in self._sessions]
+        return stats
+
+    # ---------- Внутреннее ----------
+
+    def _session(self, token):
+        session = self._sessions.get(token)
+        if session is None:
+            session = aiohttp.ClientSession(
+                connector=self._connector,
+                connector_owner=False,
+                headers={"Authorization": token, "Content-Type": "application/json"},
+                timeout=aiohttp.ClientTimeout(total=ASYNC_HTTP_TIMEOUT),
+            )
+            self._sessions[token] = session
+        return session
+
+    async def _call(self, kind, args):
+        """Один вызов API. Возвращает (HTTP-статус или None при сетевой ошибке, Retry-After)."""
+        method, param = _ENDPOINTS[kind]
+        token = args[-1]
+        url = f"{config.API_BASE_URL}messages?{param}={args[0]}"
+        kwargs = {}
+        if kind in ("send", "edit"):
+            payload = args[1]
+            if isinstance(payload, (bytes, bytearray)):
+                kwargs["data"] = payload
+            else:
+                kwargs["json"] = payload
+        started = time.perf_counter()
+        try:
+            async with self._session(token).request(method, url, **kwargs) as response:
+                body = await response.read()
+                observe_call(kind, token, started, response.status)
+                if response.status >= 400:
+                    logger.warning("❌ Ошибка %s: %r", response.status, body[:200])
+                return response.status, parse_retry_after(response.headers.get("Retry-After"))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            observe_call(kind, token, started, None)
+            logger.warning("❌ Сетевая ошибка: %s", e)
+            return None, None
+
+    async def _worker(self):
+        while True:
+            _, _, lane, kind, args, callback = await self._queue.get()
+            with self._lock:
+                self._depth[lane] -= 1
+            ok, status = False, None
+            try:
+                ok, status = await self._run(kind, args)
+            except Exception as e:
+                self._stats["failed"] += 1
+                logger.exception("Async outbound %s failed: %s", kind, e)
+            finally:
+                self._queue.task_done()
+            if callback is not None:
+                try:
+                    callback(ok, status)
+                except Exception as e:
+                    logger.exception("Async outbound %s callback failed: %s", kind, e)
+
+    async def _limit(self, method, *args):
+        if self.limiter.shared:
+            # Общие корзины - транзакция SQLite, в цикле событий её не выполняем
+            return await asyncio.get_running_loop().run_in_executor(None, method, *args)
+        return method(*args)
+
+    async def _run(self, kind, args):
+        """Выполняет задание с повторами. Возвращает (ok, последний статус)."""
+        token = args[-1]
+        recipient = args[0] if kind == "send" else None
+        attempt = 0
+        while True:
+            # Ожидание лимита - просто пауза корутины, поток не занимается
+            wait = await self._limit(self.limiter.acquire, token, recipient)
+            while wait > 0:
+                self._stats["throttled"] += 1
+                await asyncio.sleep(wait)
+                wait = await self._limit(self.limiter.acquire, token, recipient)
+
+            status, retry_after = await self._call(kind, args)
+            if status is not None and status not in TRANSIENT_STATUS_CODES:
+                self._stats["completed" if status < 400 else "failed"] += 1
+                return status < 400, status
+            if status == 429:
+                retry_after = retry_after or RATE_LIMIT_DEFAULT_RETRY_AFTER
+                await self._limit(self.limiter.penalize, token, retry_after)
+                self._stats["rate_limited"] += 1
+            else:
+                retry_after = None
+            if attempt >= self._max_retries:
+                self._stats["failed"] += 1
+                logger.error("Async outbound %s gave up after %s attempts", kind, attempt + 1)
+                return False, status
+            delay = retry_after if retry_after is not None else self._backoff * (2 ** attempt)
+            attempt += 1
+            self._stats["retried"] += 1
+            # После 429 пауза обязательна, обычный backoff при остановке пропускаем
+            await asyncio.sleep(delay if retry_after is not None or not self._stopping else 0)
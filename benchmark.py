@@ -0,0 +1,541 @@
+import argparse
+import http.client
+import itertools
+import json
+import logging
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Офлайн-стенд: поддельный MAX API + генератор нагрузки на вебхуки + отчёт.
+#   python benchmark.py run --requests 20000 --concurrency 32 --api-latency 0.05 --api-429 0.01
+#   python benchmark.py outbound --requests 2000 --api-latency 0.02
+#   python benchmark.py fake-api --port 8900
+
+ROUTES = ("webhook", "webhook1", "webhook2", "webhook3", "webhook4")
+# Доли типов update в нагрузке по умолчанию
+DEFAULT_MIX = {"message_created": 0.6, "message_callback": 0.3, "bot_started": 0.1}
+CITY_PAYLOADS = ("CITY_TGN", "CITY_ARM", "CITY_KZN", "MENU_CITY")
+
+
+# ==================== ПОДДЕЛЬНЫЙ MAX API ====================
+
+class FakeMaxAPI:
+    """
+    Локальный сервер с эндпоинтами MAX API: messages (POST/PUT/DELETE), subscriptions, updates.
+    latency - задержка ответа (сек, +-jitter), error_429 - доля ответов 429 с Retry-After.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, error_429=0.0, retry_after=1,
+                 updates_per_poll=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_429 = error_429
+        self.retry_after = retry_after
+        self.updates_per_poll = updates_per_poll
+        self._lock = threading.Lock()
+        self._mids = itertools.count(1)
+        self._marker = 0
+        self.counts = {}
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-max-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts)
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, как у настоящего API
+            disable_nagle_algorithm = True  # Заголовки и тело уходят разными send()
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def do_PUT(self):
+                self._handle("PUT")
+
+            def do_DELETE(self):
+                self._handle("DELETE")
+
+            def _handle(self, method):
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    self.rfile.read(length)
+                parts = urlsplit(self.path)
+                endpoint = parts.path.strip("/")
+                query = parse_qs(parts.query)
+                api._count(f"{method} {endpoint}")
+
+                if api.latency or api.jitter:
+                    time.sleep(max(0.0, api.latency + random.uniform(-api.jitter, api.jitter)))
+                if endpoint == "messages" and api.error_429 and random.random() < api.error_429:
+                    api._count("429")
+                    self._reply(429, {"code": "too.many.requests"}, {"Retry-After": str(api.retry_after)})
+                    return
+
+                if endpoint == "messages" and method == "POST":
+                    mid = f"mid.{next(api._mids)}"
+                    self._reply(200, {"message": {"body": {"mid": mid}, "recipient": {"user_id": query.get("user_id")}}})
+                elif endpoint == "messages":
+                    self._reply(200, {"success": True})
+                elif endpoint == "subscriptions":
+                    self._reply(200, {"subscriptions": []} if method == "GET" else {"success": True})
+                elif endpoint == "updates":
+                    self._updates(query)
+                else:
+                    self._reply(404, {"code": "not.found"})
+
+            def _updates(self, query):
+                limit = int((query.get("limit") or ["100"])[0])
+                count = min(limit, api.updates_per_poll)
+                if not count:
+                    # Нет update - держим запрос, как long poll
+                    time.sleep(min(float((query.get("timeout") or ["0"])[0]), 1.0))
+                with api._lock:
+                    start = api._marker
+                    api._marker += count
+                    marker = api._marker
+                updates = [make_update(random.choice(tuple(DEFAULT_MIX)), start + i) for i in range(count)]
+                self._reply(200, {"updates": updates, "marker": marker})
+
+            def _reply(self, status, payload, headers=None):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+
+# ==================== НАГРУЗКА ====================
+
+def make_update(update_type, n, user_id=None):
+    """Правдоподобный update MAX API; n делает mid/callback_id/timestamp уникальными."""
+    user_id = user_id if user_id is not None else 100000 + n % 5000
+    chat_id = 500000 + user_id
+    timestamp = 1700000000000 + n
+    user = {"user_id": user_id, "name": f"User {user_id}", "username": None, "is_bot": False,
+            "last_activity_time": timestamp}
+    if update_type == "message_created":
+        return {
+            "update_type": "message_created",
+            "timestamp": timestamp,
+            "message": {
+                "sender": user,
+                "recipient": {"chat_id": chat_id, "chat_type": "dialog", "user_id": 1},
+                "timestamp": timestamp,
+                "body": {"mid": f"bench.m.{n}", "seq": n, "text": f"Тестовое сообщение {n}"},
+            },
+            "user_locale": "ru",
+        }
+    if update_type == "message_callback":
+        return {
+            "update_type": "message_callback",
+            "timestamp": timestamp,
+            "callback": {
+                "timestamp": timestamp,
+                "callback_id": f"bench.c.{n}",
+                "payload": CITY_PAYLOADS[n % len(CITY_PAYLOADS)],
+                "user": user,
+            },
+            "message": {
+                "recipient": {"chat_id": chat_id, "chat_type": "dialog", "user_id": 1},
+                "body": {"mid": f"bench.cm.{n}", "seq": n, "text": "Выберите город"},
+            },
+            "user_locale": "ru",
+        }
+    if update_type == "bot_started":
+        return {"update_type": "bot_started", "timestamp": timestamp, "chat_id": chat_id, "user": user,
+                "payload": None, "user_locale": "ru"}
+    return {"update_type": "bot_stopped", "timestamp": timestamp, "chat_id": chat_id, "user": user}
+
+
+def payload_stream(total, mix=None, seed=1):
+    """(маршрут, тело запроса) для total запросов; с одним seed последовательность одинакова."""
+    mix = mix or DEFAULT_MIX
+    rng = random.Random(seed)
+    types = list(mix)
+    weights = [mix[t] for t in types]
+    for n in range(total):
+        update = make_update(rng.choices(types, weights)[0], n)
+        yield ROUTES[n % len(ROUTES)], json.dumps(update, ensure_ascii=False).encode("utf-8")
+
+
+class LoadGenerator:
+    """
+    Замкнутая нагрузка: concurrency потоков, у каждого своё keep-alive соединение.
+    signers - {маршрут: SignatureVerifier} для подписи тел; forged - доля запросов
+    с заведомо неверной подписью (стоимость отказа при флуде).
+    """
+
+    def __init__(self, host, port, concurrency=16, timeout=30, signers=None, forged=0.0):
+        self.host = host
+        self.port = port
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.signers = signers or {}
+        self.forged = forged
+
+    def run(self, payloads):
+        payloads = iter(payloads)
+        lock = threading.Lock()
+        latencies = []
+        errors = {}
+
+        def worker(n):
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            rng = random.Random(n)
+            local = []
+            while True:
+                with lock:
+                    item = next(payloads, None)
+                if item is None:
+                    break
+                route, body = item
+                headers = {"Content-Type": "application/json"}
+                signer = self.signers.get(route)
+                if signer is not None:
+                    forged = self.forged and rng.random() < self.forged
+                    headers["X-Hub-Signature-256"] = "sha256=" + "0" * 64 if forged else signer.sign(body)
+                started = time.perf_counter()
+                try:
+                    conn.request("POST", f"/{route}", body, headers)
+                    response = conn.getresponse()
+                    response.read()
+                    status = response.status
+                except (OSError, http.client.HTTPException) as e:
+                    status = type(e).__name__
+                    conn.close()
+                    conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+                local.append(time.perf_counter() - started)
+                if status != 200:
+                    with lock:
+                        errors[str(status)] = errors.get(str(status), 0) + 1
+            conn.close()
+            with lock:
+                latencies.extend(local)
+
+        threads = [threading.Thread(target=worker, args=(i,), name=f"load-{i}") for i in range(self.concurrency)]
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+        return latency_report(latencies, elapsed, errors)
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    k = min(len(sorted_values) - 1, max(0, int(round(q / 100 * (len(sorted_values) - 1)))))
+    return sorted_values[k]
+
+
+def latency_report(latencies, elapsed, errors=None):
+    latencies = sorted(latencies)
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        "requests": len(latencies),
+        "errors": errors or {},
+        "elapsed": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 1) if elapsed > 0 else 0.0,
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p90_ms": ms(percentile(latencies, 90)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "max_ms": ms(latencies[-1] if latencies else None),
+    }
+
+
+# ==================== CPU ПРОЦЕССА ====================
+
+def process_tree_cpu(pid):
+    """Процессорное время (сек) процесса и всех его потомков по /proc (Linux), иначе None."""
+    ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+    try:
+        stats = {}
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            try:
+                with open(f"/proc/{name}/stat", "r") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            # после имени: state ppid ... utime(12) stime(13)
+            stats[int(name)] = (int(fields[1]), int(fields[11]) + int(fields[12]))
+    except OSError:
+        return None
+    tree = {pid}
+    changed = True
+    while changed:
+        changed = False
+        for child, (ppid, _) in stats.items():
+            if ppid in tree and child not in tree:
+                tree.add(child)
+                changed = True
+    return sum(stats[p][1] for p in tree if p in stats) / ticks
+
+
+# ==================== СЦЕНАРИИ ====================
+
+def serve(api_url, host, port, mode, workers):
+    """Запускает main.py против поддельного API (вызывается в отдельном процессе из run)."""
+    import config
+    config.API_BASE_URL = api_url
+    config.HOST = host
+    config.PORT = port
+    # Журналы и состояние - в рабочем каталоге стенда, не в боевых каталогах
+    for name in ("INVEST", "SOTR", "CHECK", "ISP", "IQ"):
+        setattr(config, f"LOGS_DIR_{name}", os.path.join("logs", name.lower()))
+    if getattr(config, "BOTS", None):
+        config.BOTS = [dict(entry, log_dir=os.path.join("logs", entry["name"])) for entry in config.BOTS]
+
+    import main
+    if mode == "prefork":
+        main.run_prefork_production(workers)
+    elif mode == "asgi":
+        from asgi_app import run_asgi
+        run_asgi(host, port, health=main.health_status, metrics_text=main.metrics_text)
+    else:
+        main.run_production()
+
+
+def _wait_port(host, port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(host, port, timeout=1)
+            conn.request("GET", "/health")
+            conn.getresponse().read()
+            conn.close()
+            return True
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.2)
+    return False
+
+
+def _free_port(host):
+    import socket
+    with socket.socket() as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+def run_benchmark(args):
+    api = FakeMaxAPI(latency=args.api_latency, jitter=args.api_jitter, error_429=args.api_429).start()
+    host = "127.0.0.1"
+    port = args.port or _free_port(host)
+    workdir = tempfile.mkdtemp(prefix="maxbench-")
+    command = [sys.executable, os.path.abspath(__file__), "serve", "--api", api.url, "--host", host,
+               "--port", str(port), "--mode", args.mode, "--workers", str(args.workers)]
+    # Модули проекта находятся по каталогу скрипта (sys.path[0]), рабочий каталог - временный
+    server = subprocess.Popen(command, cwd=workdir,
+                              stdout=subprocess.DEVNULL if not args.verbose else None,
+                              stderr=subprocess.DEVNULL if not args.verbose else None)
+    # Если у ботов задан секрет, сервер примет только подписанные запросы - подписываем тем же ключом
+    from bot_registry import BOTS_BY_ROUTE
+    from webhook_auth import auth
+    signers = {route: auth.verifier(bot) for route, bot in BOTS_BY_ROUTE.items() if auth.verifier(bot)}
+    try:
+        if not _wait_port(host, port):
+            raise RuntimeError(f"Server under test did not start on {host}:{port} (run with --verbose)")
+        # Прогрев: соединения, кэши, JIT шаблонов - не в счёт
+        LoadGenerator(host, port, args.concurrency, signers=signers).run(
+            payload_stream(min(500, args.requests), seed=0))
+        api_before = api.stats()
+        cpu_before = process_tree_cpu(server.pid)
+
+        report = LoadGenerator(host, port, args.concurrency, signers=signers, forged=args.forged).run(
+            payload_stream(args.requests, seed=args.seed))
+
+        cpu_after = process_tree_cpu(server.pid)
+        # Исходящие вызовы досылаются асинхронно - ждём, пока поток к API не затихнет
+        outbound = _drain(api, args.drain)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        api.stop()
+
+    if cpu_before is not None and cpu_after is not None:
+        cpu = cpu_after - cpu_before
+        report["server_cpu_s"] = round(cpu, 3)
+        report["cpu_per_event_ms"] = round(cpu / max(1, report["requests"]) * 1000, 4)
+    api_after = outbound
+    report["outbound"] = {name: api_after.get(name, 0) - api_before.get(name, 0) for name in api_after}
+    report["config"] = {"mode": args.mode, "workers": args.workers, "concurrency": args.concurrency,
+                        "api_latency": args.api_latency, "api_429": args.api_429, "seed": args.seed,
+                        "signed": bool(signers), "forged": args.forged}
+    report["workdir"] = workdir
+    return report
+
+
+def _drain(api, timeout):
+    deadline = time.monotonic() + timeout
+    previous = None
+    while time.monotonic() < deadline:
+        current = api.stats()
+        if current == previous:
+            return current
+        previous = current
+        time.sleep(1.0)
+    return api.stats()
+
+
+def run_outbound(args):
+    """Задержка reqv_to_bot.send_message против поддельного API (пул соединений, keep-alive)."""
+    api = FakeMaxAPI(latency=args.api_latency, jitter=args.api_jitter, error_429=args.api_429).start()
+    import config
+    config.API_BASE_URL = api.url
+    import reqv_to_bot as reqv
+
+    body = json.dumps({"text": "benchmark"}).encode("utf-8")
+    token = "bench-token"
+    lock = threading.Lock()
+    latencies = []
+    errors = {}
+    counter = itertools.count()
+
+    def worker():
+        local = []
+        while next(counter) < args.requests:
+            started = time.perf_counter()
+            response = reqv.send_message(1, body, token)
+            local.append(time.perf_counter() - started)
+            status = response.status_code if response is not None else "error"
+            if status != 200:
+                with lock:
+                    errors[str(status)] = errors.get(str(status), 0) + 1
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    cpu_before = time.process_time()
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    report = latency_report(latencies, elapsed, errors)
+    report["client_cpu_per_call_ms"] = round((time.process_time() - cpu_before) / max(1, len(latencies)) * 1000, 4)
+    from max_client import client
+    report["http_pools"] = client.stats()
+    api.stop()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк вебхуков и исходящих вызовов")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def api_options(p):
+        p.add_argument("--api-latency", type=float, default=0.02, help="Задержка поддельного API (сек)")
+        p.add_argument("--api-jitter", type=float, default=0.0)
+        p.add_argument("--api-429", type=float, default=0.0, help="Доля ответов 429")
+
+    run = sub.add_parser("run", help="Нагрузка на вебхуки main.py")
+    api_options(run)
+    run.add_argument("--requests", type=int, default=10000)
+    run.add_argument("--concurrency", type=int, default=16)
+    run.add_argument("--mode", choices=("waitress", "prefork", "asgi"), default="waitress")
+    run.add_argument("--workers", type=int, default=2, help="Процессов в режиме prefork")
+    run.add_argument("--port", type=int, default=0)
+    run.add_argument("--seed", type=int, default=1)
+    run.add_argument("--drain", type=float, default=30, help="Ожидание досылки исходящих (сек)")
+    run.add_argument("--forged", type=float, default=0.0,
+                     help="Доля запросов с неверной подписью (если у ботов задан секрет)")
+    run.add_argument("--output", help="Сохранить отчёт в JSON-файл")
+    run.add_argument("--verbose", action="store_true", help="Показывать вывод сервера")
+
+    outbound = sub.add_parser("outbound", help="Задержка reqv_to_bot.send_message")
+    api_options(outbound)
+    outbound.add_argument("--requests", type=int, default=2000)
+    outbound.add_argument("--concurrency", type=int, default=8)
+    outbound.add_argument("--output")
+
+    fake = sub.add_parser("fake-api", help="Только поддельный MAX API")
+    api_options(fake)
+    fake.add_argument("--port", type=int, default=8900)
+    fake.add_argument("--updates-per-poll", type=int, default=0)
+
+    srv = sub.add_parser("serve", help=argparse.SUPPRESS)
+    srv.add_argument("--api", required=True)
+    srv.add_argument("--host", default="127.0.0.1")
+    srv.add_argument("--port", type=int, required=True)
+    srv.add_argument("--mode", default="waitress")
+    srv.add_argument("--workers", type=int, default=2)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    if args.command == "serve":
+        serve(args.api, args.host, args.port, args.mode, args.workers)
+        return 0
+    if args.command == "fake-api":
+        api = FakeMaxAPI(port=args.port, latency=args.api_latency, jitter=args.api_jitter,
+                         error_429=args.api_429, updates_per_poll=args.updates_per_poll).start()
+        print(f"Fake MAX API on {api.url} (Ctrl+C to stop)")
+        try:
+            while True:
+                time.sleep(10)
+                print(json.dumps(api.stats()))
+        except KeyboardInterrupt:
+            api.stop()
+        return 0
+
+    report = run_benchmark(args) if args.command == "run" else run_outbound(args)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
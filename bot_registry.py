@@ -0,0 +1,52 @@
+import config
+
+
+class Bot:
+    """Описание одного бота: имя, путь вебхука, токен, каталог журнала и секрет подписи."""
+
+    __slots__ = ("name", "route", "token", "log_dir", "secret")
+
+    def __init__(self, name, route, token, log_dir, secret=None):
+        self.name = name
+        self.route = route
+        self.token = token
+        self.log_dir = log_dir
+        # Общий SECRET_KEY проверяется в режиме WEBHOOK_SIGNATURE_MODE (по умолчанию "log" - без отказов)
+        self.secret = secret if secret is not None else getattr(config, "SECRET_KEY", None)
+
+    def __repr__(self):
+        return f"Bot({self.name!r}, /{self.route})"
+
+
+def mask_token(token):
+    """Короткая безопасная метка токена для логов и статистики."""
+    token = str(token or "")
+    return token[:6] + "…" if len(token) > 6 else token
+
+
+def _default_bots():
+    return [
+        Bot("invest", "webhook", config.BOT_TOKEN_INVEST, config.LOGS_DIR_INVEST),
+        Bot("sotr", "webhook1", config.BOT_TOKEN_SOTR, config.LOGS_DIR_SOTR),
+        Bot("check", "webhook2", config.BOT_TOKEN_CHECK, config.LOGS_DIR_CHECK),
+        Bot("isp", "webhook3", config.BOT_TOKEN_ISP, config.LOGS_DIR_ISP),
+        Bot("iq", "webhook4", config.BOT_TOKEN_IQ, config.LOGS_DIR_IQ),
+    ]
+
+
+def load_bots():
+    """
+    Реестр ботов. Новый бот добавляется записью в config.BOTS, например:
+        BOTS = [{"name": "invest", "route": "webhook", "token": "...", "log_dir": "logs/invest"}, ...]
+    Без config.BOTS используются пять ботов из BOT_TOKEN_* / LOGS_DIR_*.
+    """
+    entries = getattr(config, "BOTS", None)
+    if not entries:
+        return _default_bots()
+    return [Bot(**entry) for entry in entries]
+
+
+BOTS = load_bots()
+BOTS_BY_ROUTE = {bot.route: bot for bot in BOTS}
+BOTS_BY_NAME = {bot.name: bot for bot in BOTS}
+BOTS_BY_TOKEN = {bot.token: bot for bot in BOTS}
@@ -0,0 +1,199 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import config
+from bot_registry import BOTS_BY_NAME
+from outbound_queue import BULK, OutboundDispatcher
+from rate_limit import RATE_LIMIT_BACKEND, create_limiter
+from subscribers import registry as subscribers
+from template_cache import templates
+
+logger = logging.getLogger(__name__)
+
+# ==================== КОНФИГУРАЦИЯ ====================
+BROADCAST_DIR = getattr(config, "BROADCAST_DIR", os.path.join("data", "broadcasts"))  # Чекпоинты рассылок
+BROADCAST_CONCURRENCY = getattr(config, "BROADCAST_CONCURRENCY", 16)  # Одновременных запросов к API
+BROADCAST_REPORT_INTERVAL = getattr(config, "BROADCAST_REPORT_INTERVAL", 5.0)  # Отчёт о скорости (сек)
+BROADCAST_DRAIN_TIMEOUT = getattr(config, "BROADCAST_DRAIN_TIMEOUT", 300)  # Досылка при остановке (сек)
+
+AUDIENCE_FILE = "audience.json"
+PROGRESS_FILE = "progress.log"
+REPORT_FILE = "report.json"
+
+
+def audience(bot):
+    """
+    [(user_id, chat_id)] активных подписчиков бота из реестра subscribers.
+    При первом запуске реестр сам заполняется по событиям bot_started/bot_stopped из журналов ботов.
+    """
+    return sorted(subscribers.active(bot.name), key=lambda item: str(item[0]))
+
+
+class Broadcast:
+    """
+    Рассылка шаблона всем подписчикам бота.
+    Аудитория фиксируется при первом запуске (audience.json), каждая завершённая отправка
+    дописывается в progress.log - после сбоя повторный запуск с тем же campaign продолжает с места остановки.
+    Отправка идёт через отдельный OutboundDispatcher этого процесса (полоса bulk) с лимитами в SQLite
+    (rate_limit.py): они общие с сервером в pre-fork режиме или при RATE_LIMIT_BACKEND = "sqlite".
+    """
+
+    def __init__(self, bot, template, campaign=None, concurrency=BROADCAST_CONCURRENCY,
+                 directory=BROADCAST_DIR, retry_failed=False, rate_limiter=None):
+        self.bot = bot
+        self.template = template
+        self.campaign = campaign or f"{bot.name}-{template}-{time.strftime('%Y%m%d-%H%M%S')}"
+        self.path = os.path.join(directory, self.campaign)
+        self._concurrency = concurrency
+        self._retry_failed = retry_failed
+        self._limiter = rate_limiter or create_limiter("sqlite")
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._progress = None
+        self._stats = {"total": 0, "skipped": 0, "sent": 0, "failed": 0, "dropped": 0}
+        self._statuses = {}
+
+    def run(self):
+        prepared = templates.get_prepared(self.template)
+        if prepared is None:
+            raise ValueError(f"Template {self.template} not found")
+        os.makedirs(self.path, exist_ok=True)
+
+        recipients = self._load_audience()
+        done = self._load_progress()
+        pending = [(user_id, chat_id) for user_id, chat_id in recipients if str(user_id) not in done]
+        self._stats["total"] = len(recipients)
+        self._stats["skipped"] = len(recipients) - len(pending)
+        logger.info("Broadcast %s: %s of %s recipients to send", self.campaign, len(pending), len(recipients))
+
+        dispatcher = OutboundDispatcher(workers=self._concurrency, bulk_maxsize=self._concurrency * 4,
+                                        rate_limiter=self._limiter)
+        reporter = threading.Thread(target=self._report, name="broadcast-report", daemon=True)
+        started = time.monotonic()
+        self._progress = open(os.path.join(self.path, PROGRESS_FILE), "a", encoding="utf-8")
+        try:
+            reporter.start()
+            for user_id, chat_id in pending:
+                if self._stopping.is_set():
+                    break
+                body = prepared.render({"user_id": user_id, "chat_id": chat_id})
+                # block=True: не больше concurrency*4 заданий в памяти, остальные ждут своей очереди
+                if not dispatcher.send_message(user_id, body, self.bot.token, lane=BULK, block=True,
+                                               callback=lambda ok, status, u=user_id: self._done(u, ok, status)):
+                    self._count("dropped")
+        except KeyboardInterrupt:
+            logger.warning("Broadcast %s interrupted, finishing jobs in flight", self.campaign)
+        finally:
+            dispatcher.shutdown(BROADCAST_DRAIN_TIMEOUT)
+            self._stopping.set()
+            self._progress.close()
+            report = self._write_report(time.monotonic() - started)
+        logger.info("Broadcast %s finished: %s", self.campaign, report)
+        return report
+
+    def stop(self):
+        self._stopping.set()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    # ---------- Внутреннее ----------
+
+    def _load_audience(self):
+        path = os.path.join(self.path, AUDIENCE_FILE)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                return [tuple(item) for item in json.load(f)]
+        recipients = audience(self.bot)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(recipients, f)
+        os.replace(tmp, path)
+        return recipients
+
+    def _load_progress(self):
+        """user_id, по которым отправка уже завершена (с неудачными - если не retry_failed)."""
+        done = set()
+        try:
+            with open(os.path.join(self.path, PROGRESS_FILE), "r", encoding="utf-8") as f:
+                for line in f:
+                    parts = line.rstrip("\n").split("\t")
+                    if len(parts) < 2:
+                        continue  # строка, оборванная сбоем
+                    if parts[1] == "ok" or not self._retry_failed:
+                        done.add(parts[0])
+                    else:
+                        done.discard(parts[0])
+        except FileNotFoundError:
+            pass
+        return done
+
+    def _done(self, user_id, ok, status):
+        with self._lock:
+            self._stats["sent" if ok else "failed"] += 1
+            if not ok:
+                self._statuses[str(status)] = self._statuses.get(str(status), 0) + 1
+            # Строка на отправку: после сбоя теряется не больше заданий, чем было в полёте
+            self._progress.write(f"{user_id}\t{'ok' if ok else 'fail'}\t{status}\n")
+            self._progress.flush()
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _report(self):
+        previous = 0
+        while not self._stopping.wait(BROADCAST_REPORT_INTERVAL):
+            stats = self.stats()
+            finished = stats["sent"] + stats["failed"]
+            rate = (finished - previous) / BROADCAST_REPORT_INTERVAL
+            previous = finished
+            logger.info("Broadcast %s: %s/%s (%.1f/s), failed %s", self.campaign, finished + stats["skipped"],
+                        stats["total"], rate, stats["failed"])
+
+    def _write_report(self, elapsed):
+        with self._lock:
+            report = dict(self._stats)
+            report["failures_by_status"] = dict(self._statuses)
+        report["campaign"] = self.campaign
+        report["elapsed"] = round(elapsed, 3)
+        report["per_second"] = round((report["sent"] + report["failed"]) / elapsed, 2) if elapsed > 0 else 0.0
+        with open(os.path.join(self.path, REPORT_FILE), "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Рассылка шаблона всем подписчикам бота")
+    parser.add_argument("bot", choices=sorted(BOTS_BY_NAME), help="Имя бота из bot_registry")
+    parser.add_argument("template", nargs="?", help="Имя шаблона из templates/")
+    parser.add_argument("--campaign", help="Идентификатор рассылки (для продолжения после сбоя)")
+    parser.add_argument("--concurrency", type=int, default=BROADCAST_CONCURRENCY)
+    parser.add_argument("--retry-failed", action="store_true", help="Повторить неудачные отправки")
+    parser.add_argument("--dry-run", action="store_true", help="Только посчитать аудиторию")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    bot = BOTS_BY_NAME[args.bot]
+    if RATE_LIMIT_BACKEND == "memory":
+        logger.warning("Rate limits are shared with the server only in pre-fork mode or with RATE_LIMIT_BACKEND=sqlite")
+    if args.dry_run:
+        print(f"{len(audience(bot))} active subscribers")
+        return 0
+    if not args.template:
+        parser.error("нужно имя шаблона")
+
+    report = Broadcast(bot, args.template, campaign=args.campaign, concurrency=args.concurrency,
+                       retry_failed=args.retry_failed).run()
+    print(json.dumps(report, ensure_ascii=False))
+    return 0 if report["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+import re
+
+import config
+import outbound_queue
+from conversation_state import conversations
+from template_cache import PreparedPayload, templates
+
+logger = logging.getLogger(__name__)
+
+# ==================== КОНФИГУРАЦИЯ ====================
+CALLBACK_ROUTES_FILE = getattr(
+    config, "CALLBACK_ROUTES_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "callbacks.json")
+)
+
+ACTION_TYPES = ("reply", "delete", "edit", "menu", "state")
+
+_VALUE_RE = re.compile(r"\{(\w+)\}")
+
+
+class Route:
+    """Скомпилированное правило: список действий + имя правила для логов."""
+
+    __slots__ = ("name", "actions", "regex", "step")
+
+    def __init__(self, name, actions, regex=None, step=None):
+        self.name = name
+        self.actions = actions
+        self.regex = regex
+        # Правило действует, только если диалог пользователя на этом шаге (None - на любом)
+        self.step = step
+
+
+class CallbackRouter:
+    """
+    Маршрутизатор payload кнопок.
+    Правила компилируются при загрузке в три структуры:
+        match   - dict точных payload, O(1);
+        prefix  - dict по длинам префиксов, проверка только существующих длин (от длинной к короткой);
+        pattern - все регулярные выражения, склеенные в одно с именованными группами.
+    Приоритет: точное совпадение, затем самый длинный префикс, затем первое подходящее выражение.
+    Действие "state" переводит диалог пользователя (conversation_state) на следующий шаг,
+    поля состояния доступны в текстах и меню как {имя}.
+    """
+
+    def __init__(self, routes=(), menus=None):
+        self.menus = {name: PreparedPayload.from_value(body) for name, body in (menus or {}).items()}
+        self._exact = {}
+        self._prefixes = {}  # длина -> {префикс: Route}
+        self._prefix_lengths = ()
+        self._patterns = []
+        self._combined = None
+        for i, spec in enumerate(routes):
+            self._add(i, spec)
+        self._compile()
+
+    # ---------- Загрузка ----------
+
+    @classmethod
+    def from_file(cls, path=CALLBACK_ROUTES_FILE):
+        """Загружает правила из JSON-файла. Без файла - пустой маршрутизатор."""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                spec = json.load(f)
+        except FileNotFoundError:
+            logger.warning("Callback routes file %s not found, no button actions configured", path)
+            return cls()
+        router = cls(spec.get("routes", []), spec.get("menus", {}))
+        logger.info("Loaded %s callback routes from %s", len(spec.get('routes', [])), path)
+        return router
+
+    def _add(self, i, spec):
+        actions = spec.get("actions") or []
+        for action in actions:
+            if action.get("type") not in ACTION_TYPES:
+                raise ValueError(f"Callback route #{i}: unknown action {action.get('type')!r}")
+            # Тело reply/edit сериализуем один раз; {поля} подставляются при нажатии
+            if action["type"] in ("reply", "edit") and "menu" not in action:
+                body = {"text": action.get("text", "")}
+                if "attachments" in action:
+                    body["attachments"] = action["attachments"]
+                action["_prepared"] = PreparedPayload.from_value(body)
+        step = spec.get("step")
+        if "match" in spec:
+            self._exact[spec["match"]] = Route(spec["match"], actions, step=step)
+        elif "prefix" in spec:
+            prefix = spec["prefix"]
+            self._prefixes.setdefault(len(prefix), {})[prefix] = Route(prefix + "*", actions, step=step)
+        elif "pattern" in spec:
+            regex = re.compile(spec["pattern"])
+            self._patterns.append(Route(spec["pattern"], actions, regex, step))
+        else:
+            raise ValueError(f"Callback route #{i} needs 'match', 'prefix' or 'pattern'")
+
+    def _compile(self):
+        self._prefix_lengths = tuple(sorted(self._prefixes, reverse=True))
+        if not self._patterns:
+            return
+        combined = "|".join(f"(?P<_r{i}>{route.regex.pattern})" for i, route in enumerate(self._patterns))
+        try:
+            self._combined = re.compile(combined)
+        except re.error:
+            # Одинаковые имена групп в разных выражениях - проверяем их по очереди
+            self._combined = None
+
+    # ---------- Поиск ----------
+
+    def resolve(self, payload):
+        """Возвращает (Route, параметры из выражения) или (None, None)."""
+        route = self._exact.get(payload)
+        if route is not None:
+            return route, {}
+
+        for length in self._prefix_lengths:
+            if length <= len(payload):
+                route = self._prefixes[length].get(payload[:length])
+                if route is not None:
+                    return route, {"suffix": payload[length:]}
+
+        if self._combined is not None:
+            m = self._combined.fullmatch(payload)
+            if m is not None:
+                route = self._patterns[int(m.lastgroup[2:])]
+                return route, route.regex.fullmatch(payload).groupdict()
+        else:
+            for route in self._patterns:
+                m = route.regex.fullmatch(payload)
+                if m is not None:
+                    return route, m.groupdict()
+        return None, None
+
+    # ---------- Выполнение ----------
+
+    def dispatch(self, ctx):
+        """Выполняет действия правила для нажатой кнопки. False - правило не найдено."""
+        if not isinstance(ctx.payload, str):
+            return False
+        route, params = self.resolve(ctx.payload)
+        if route is None:
+            logger.info("No callback route for payload %r", ctx.payload)
+            return False
+
+        state = conversations.get(ctx.bot.name, ctx.user_id)
+        if route.step is not None and (state is None or state.step != route.step):
+            logger.info("Callback route %s ignored: user %s is at step %r, expected %r",
+                        route.name, ctx.user_id, state.step if state else None, route.step)
+            return False
+
+        values = dict(state.data) if state is not None else {}
+        values.update(params, payload=ctx.payload, user_id=ctx.user_id, chat_id=ctx.chat_id)
+        for action in route.actions:
+            self._run_action(action, ctx, values)
+        return True
+
+    def _message_body(self, action, values):
+        if "menu" in action:
+            # Меню из callbacks.json, иначе шаблон с тем же именем (templates/<menu>.json)
+            prepared = self.menus.get(action["menu"]) or templates.get_prepared(action["menu"])
+            if prepared is None:
+                raise KeyError(f"Unknown menu {action['menu']!r}")
+            return prepared.render(values)
+        return action["_prepared"].render(values)
+
+    def _run_action(self, action, ctx, values):
+        kind = action["type"]
+        if kind == "state":
+            data = {name: _VALUE_RE.sub(lambda m: str(values.get(m.group(1), "")), value)
+                    if isinstance(value, str) else value
+                    for name, value in (action.get("set") or {}).items()}
+            conversations.set(ctx.bot.name, ctx.user_id, action.get("step"), data)
+            values.update(data)
+            return
+        token = ctx.bot.token
+        dispatcher = outbound_queue.dispatcher
+        if kind == "delete":
+            dispatcher.delete_message(ctx.message_id, token)
+        elif kind == "reply":
+            dispatcher.send_message(ctx.user_id, self._message_body(action, values), token)
+        elif kind == "edit":
+            dispatcher.edit_message(ctx.message_id, self._message_body(action, values), token)
+        elif kind == "menu":
+            # Следующее меню: по умолчанию заменяем текущее сообщение, иначе отправляем новое
+            body = self._message_body(action, values)
+            if action.get("mode", "edit") == "edit" and ctx.message_id:
+                dispatcher.edit_message(ctx.message_id, body, token)
+            else:
+                dispatcher.send_message(ctx.user_id, body, token)
+
+
+router = CallbackRouter.from_file()
@@ -0,0 +1,301 @@
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# ==================== КОНФИГУРАЦИЯ ====================
+CONVERSATION_STATE_TTL = getattr(config, "CONVERSATION_STATE_TTL", 86400)  # Сброс диалога после простоя (сек)
+CONVERSATION_STATE_MAX_SIZE = getattr(config, "CONVERSATION_STATE_MAX_SIZE", 100000)  # Диалогов в памяти
+# Отложенная запись состояний в SQLite (переживают перезапуск и вытеснение из памяти)
+CONVERSATION_STATE_PERSIST = getattr(config, "CONVERSATION_STATE_PERSIST", False)
+CONVERSATION_STATE_DB_PATH = getattr(config, "CONVERSATION_STATE_DB_PATH", os.path.join("data", "conversation_state.db"))
+CONVERSATION_STATE_FLUSH_INTERVAL = getattr(config, "CONVERSATION_STATE_FLUSH_INTERVAL", 1.0)  # Сброс в SQLite (сек)
+
+_DELETED = object()
+
+
+class ConversationState:
+    """Состояние диалога одного пользователя с ботом: шаг сценария + произвольные поля."""
+
+    __slots__ = ("step", "data", "expires")
+
+    def __init__(self, step=None, data=None, expires=0.0):
+        self.step = step
+        self.data = data if data is not None else {}
+        self.expires = expires
+
+
+class SqliteStateStore:
+    """Хранилище состояний на диске: одна строка на (бот, пользователь), запись пачками."""
+
+    def __init__(self, path=CONVERSATION_STATE_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS conversation_state ("
+            "bot TEXT NOT NULL, user_id TEXT NOT NULL, step TEXT, data TEXT NOT NULL, expires REAL NOT NULL, "
+            "PRIMARY KEY (bot, user_id)) WITHOUT ROWID"
+        )
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def load(self, bot, user_id, now):
+        row = self._conn().execute(
+            "SELECT step, data, expires FROM conversation_state WHERE bot = ? AND user_id = ? AND expires > ?",
+            (bot, str(user_id), now),
+        ).fetchone()
+        if row is None:
+            return None
+        return ConversationState(row[0], json.loads(row[1]), row[2])
+
+    def write(self, changes, now):
+        """changes: {(бот, пользователь): ConversationState или _DELETED} - одной транзакцией."""
+        upserts = []
+        deletes = []
+        for (bot, user_id), state in changes.items():
+            if state is _DELETED:
+                deletes.append((bot, str(user_id)))
+            else:
+                upserts.append((bot, str(user_id), state.step,
+                                json.dumps(state.data, ensure_ascii=False), state.expires))
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "INSERT INTO conversation_state (bot, user_id, step, data, expires) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(bot, user_id) DO UPDATE SET step = excluded.step, data = excluded.data, "
+                "expires = excluded.expires",
+                upserts,
+            )
+            conn.executemany("DELETE FROM conversation_state WHERE bot = ? AND user_id = ?", deletes)
+            conn.execute("DELETE FROM conversation_state WHERE expires < ?", (now,))
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+
+    def truncate(self, bots=None):
+        """Удаляет состояния всех ботов или только перечисленных."""
+        if bots is None:
+            self._conn().execute("DELETE FROM conversation_state")
+        else:
+            self._conn().executemany("DELETE FROM conversation_state WHERE bot = ?", [(bot,) for bot in bots])
+
+    def _after_fork(self):
+        self._local = threading.local()
+
+
+class ConversationStore:
+    """
+    Состояния диалогов по ключу (бот, user_id).
+    В памяти - OrderedDict в порядке последнего обращения: TTL отсчитывается от последнего обращения
+    и одинаков для всех, поэтому самые давние (и первыми истекающие) записи всегда в начале -
+    просроченные и лишние сверх max_size вытесняются за амортизированное O(1).
+    С persist изменения (и продления TTL при чтении) копятся и пишутся в SQLite фоновым потоком раз в flush_interval;
+    при промахе в памяти состояние читается с диска.
+    Память у каждого процесса своя: в pre-fork режиме запросы одного пользователя
+    могут попасть в разные процессы, общим для них будет только состояние на диске.
+    """
+
+    def __init__(self, ttl=CONVERSATION_STATE_TTL, max_size=CONVERSATION_STATE_MAX_SIZE,
+                 store=None, flush_interval=CONVERSATION_STATE_FLUSH_INTERVAL):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._store = store
+        self._flush_interval = flush_interval
+        self._items = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._stats = {"hits": 0, "misses": 0, "loaded": 0, "evicted": 0, "expired": 0, "flushed": 0}
+        if store is not None:
+            self._start()
+
+    # ---------- Публичный API ----------
+
+    def get(self, bot, user_id):
+        """Состояние диалога или None. Обращение продлевает TTL."""
+        key = (bot, user_id)
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            state = self._items.get(key)
+            if state is not None:
+                self._items.move_to_end(key)
+                state.expires = now + self.ttl
+                if self._store is not None:
+                    # Продлённый срок тоже сохраняем: иначе после вытеснения или перезапуска
+                    # диалог, который только читали, на диске окажется просроченным
+                    self._pending[key] = state
+                self._stats["hits"] += 1
+                return state
+            self._stats["misses"] += 1
+            pending = self._pending.get(key)
+        if self._store is None or pending is _DELETED:
+            return None
+        state = pending if pending is not None else self._load(bot, user_id, now)
+        if state is None:
+            return None
+        with self._lock:
+            # Пока читали с диска, состояние мог записать другой поток - его и оставляем
+            current = self._items.get(key)
+            if current is not None:
+                return current
+            state.expires = now + self.ttl
+            self._put(key, state)
+            self._pending[key] = state
+        return state
+
+    def set(self, bot, user_id, step, data=None):
+        """Переводит диалог на шаг step; data (словарь) дополняет поля состояния."""
+        key = (bot, user_id)
+        if self._store is not None and key not in self._items:
+            self.get(bot, user_id)  # Подтягиваем с диска, чтобы не потерять поля состояния
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            state = self._items.get(key)
+            if state is None:
+                state = ConversationState()
+                self._put(key, state)
+            else:
+                self._items.move_to_end(key)
+            state.step = step
+            if data:
+                state.data.update(data)
+            state.expires = now + self.ttl
+            if self._store is not None:
+                self._pending[key] = state
+        return state
+
+    def clear(self, bot, user_id):
+        key = (bot, user_id)
+        with self._lock:
+            self._items.pop(key, None)
+            if self._store is not None:
+                self._pending[key] = _DELETED
+
+    def flush(self):
+        """Записывает накопленные изменения в SQLite."""
+        if self._store is None:
+            return
+        with self._lock:
+            # Копии: обработчики продолжают менять живые записи, пока идёт запись на диск
+            changes = {key: state if state is _DELETED else ConversationState(state.step, dict(state.data),
+                                                                              state.expires)
+                       for key, state in self._pending.items()}
+            self._pending = {}
+        if not changes:
+            return
+        try:
+            self._store.write(changes, time.time())
+        except sqlite3.Error as e:
+            logger.error("Conversation state flush failed: %s", e)
+            with self._lock:
+                # Вернуть несохранённое, не затирая более свежие изменения
+                for key, state in changes.items():
+                    self._pending.setdefault(key, state)
+            return
+        with self._lock:
+            self._stats["flushed"] += len(changes)
+
+    def reset(self, bots=None):
+        """Забывает состояния всех ботов (или только перечисленных в bots), в том числе на диске."""
+        with self._lock:
+            if bots is None:
+                self._items.clear()
+                self._pending = {}
+            else:
+                bots = set(bots)
+                for key in [key for key in self._items if key[0] in bots]:
+                    del self._items[key]
+                self._pending = {key: state for key, state in self._pending.items() if key[0] not in bots}
+        if self._store is not None:
+            self._store.truncate(bots)
+
+    def close(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(5)
+        self.flush()
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._items)
+            stats["pending"] = len(self._pending)
+        stats["persist"] = self._store.path if self._store is not None else None
+        return stats
+
+    # ---------- Внутреннее ----------
+
+    def _put(self, key, state):
+        self._items[key] = state
+        if len(self._items) > self.max_size:
+            # Вытесненное из памяти с persist не теряется: оно уже в _pending или на диске
+            self._items.popitem(last=False)
+            self._stats["evicted"] += 1
+
+    def _expire(self, now):
+        items = self._items
+        while items:
+            key, state = next(iter(items.items()))
+            if state.expires > now:
+                break
+            items.popitem(last=False)
+            self._stats["expired"] += 1
+
+    def _load(self, bot, user_id, now):
+        try:
+            state = self._store.load(bot, user_id, now)
+        except sqlite3.Error as e:
+            logger.error("Conversation state load failed: %s", e)
+            return None
+        if state is not None:
+            with self._lock:
+                self._stats["loaded"] += 1
+        return state
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name="conversation-flush", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopping.wait(self._flush_interval):
+            self.flush()
+
+    def _after_fork(self):
+        # Несброшенные изменения родителя сбросит сам родитель
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._stopping = threading.Event()
+        if self._store is not None:
+            self._store._after_fork()
+            self._start()
+
+
+conversations = ConversationStore(store=SqliteStateStore() if CONVERSATION_STATE_PERSIST else None)
+atexit.register(conversations.close)
+os.register_at_fork(after_in_child=conversations._after_fork)
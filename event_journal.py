@@ -0,0 +1,394 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+import config
+import journal_archive
+import journal_index
+
+logger = logging.getLogger(__name__)
+
+# ==================== КОНФИГУРАЦИЯ ====================
+JOURNAL_QUEUE_SIZE = getattr(config, "JOURNAL_QUEUE_SIZE", 10000)  # Событий в памяти на бота
+JOURNAL_BATCH_SIZE = getattr(config, "JOURNAL_BATCH_SIZE", 256)  # Сбрасывать на диск каждые N событий
+JOURNAL_FLUSH_INTERVAL = getattr(config, "JOURNAL_FLUSH_INTERVAL", 0.5)  # ...или не реже, чем раз в N сек
+JOURNAL_SEGMENT_BYTES = getattr(config, "JOURNAL_SEGMENT_BYTES", 64 * 1024 * 1024)  # Размер сегмента
+# Политика fsync: "never" - полагаемся на ОС, "batch" - после каждой пачки, "rotate" - при закрытии сегмента
+JOURNAL_FSYNC = getattr(config, "JOURNAL_FSYNC", "rotate")
+# Кодировка записи; старые сегменты в cp1251 читаются через запасную LEGACY_ENCODING
+JOURNAL_ENCODING = getattr(config, "JOURNAL_ENCODING", "utf-8")
+LEGACY_ENCODING = "cp1251"
+JOURNAL_INDEX = getattr(config, "JOURNAL_INDEX", True)  # Вести индекс chat_id/user_id/mid/callback_id
+
+SEGMENT_PREFIX = "journal-"
+SEGMENT_SUFFIX = ".jsonl"
+# journal-00000001.jsonl или journal-00000001-w3.jsonl (сегмент процесса-обработчика №3 в pre-fork режиме);
+# закрытые сегменты сжимаются в journal-00000001.jsonl.gz / .zst (journal_archive.py)
+_SEGMENT_RE = re.compile(r"^journal-(\d+)(?:-(w\d+))?\.jsonl(\.gz|\.zst)?$")
+
+_STOP = object()
+_ANY = object()
+
+# Метка процесса, пишущего журналы (None - единственный процесс)
+_worker_tag = None
+
+
+def set_worker_tag(tag):
+    """Задаёт метку процесса для имён сегментов (вызывается в процессе-обработчике до первой записи)."""
+    global _worker_tag
+    _worker_tag = tag
+
+
+def segment_name(seq, tag=None):
+    suffix = f"-{tag}" if tag else ""
+    return f"{SEGMENT_PREFIX}{seq:08d}{suffix}{SEGMENT_SUFFIX}"
+
+
+def list_segments(directory, tag=_ANY):
+    """
+    Возвращает [(номер, путь)] сегментов журнала по возрастанию номера.
+    tag ограничивает выборку сегментами одного процесса (None - сегменты без метки).
+    """
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    segments = {}
+    for name in names:
+        m = _SEGMENT_RE.match(name)
+        if m and (tag is _ANY or m.group(2) == tag):
+            key = (int(m.group(1)), m.group(2) or "")
+            # Пока сжатие не закончилось, есть оба файла - читаем несжатый
+            if key not in segments or not m.group(3):
+                segments[key] = os.path.join(directory, name)
+    return [(seq, segments[seq, tag]) for seq, tag in sorted(segments)]
+
+
+def segment_stem(path):
+    """Путь сегмента без расширений (journal-N.jsonl.gz -> journal-N) - основа имён индекса."""
+    return journal_archive.strip_suffix(path)[:-len(SEGMENT_SUFFIX)]
+
+
+def sealed_segments(directory):
+    """Несжатые сегменты, в которые уже никто не пишет (все, кроме последнего у каждого процесса)."""
+    sealed = []
+    for tag in journal_tags(directory):
+        sealed.extend(path for _, path in list_segments(directory, tag=tag)[:-1]
+                      if journal_archive.codec_for(path) is None)
+    return sealed
+
+
+def decode_line(raw, encoding=None):
+    """Строка журнала -> текст. Сегменты, записанные до перехода на UTF-8, - в cp1251."""
+    try:
+        return raw.decode(encoding or JOURNAL_ENCODING)
+    except UnicodeDecodeError:
+        return raw.decode(LEGACY_ENCODING, errors="ignore")
+
+
+def journal_tags(directory):
+    """Метки процессов, писавших журнал каталога (None - сегменты без метки)."""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    tags = set()
+    for name in names:
+        m = _SEGMENT_RE.match(name)
+        if m:
+            tags.add(m.group(2))
+    return sorted(tags, key=lambda tag: tag or "")
+
+
+def iter_records(directory, encoding=None, tag=_ANY):
+    """
+    Потоково читает записи журнала каталога ({"ts", "key", "data"}) по сегментам.
+    С tag - только сегменты одного процесса, они идут в хронологическом порядке.
+    Сжатые сегменты распаковываются по мере чтения.
+    Недописанная последняя строка (журнал сейчас пишется) пропускается.
+    """
+    for _, path in list_segments(directory, tag=tag):
+        with journal_archive.open_stream(path) as f:
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break
+                try:
+                    yield json.loads(decode_line(raw, encoding))
+                except ValueError:
+                    continue
+
+
+def legacy_log_files(directory):
+    """Логи старого формата: файл {ключ}.txt на чат, строка - JSON update."""
+    try:
+        return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith(".txt")]
+    except FileNotFoundError:
+        return []
+
+
+def iter_legacy_file(path, encoding="cp1251"):
+    """Записи одного лога старого формата в виде iter_records; ts - из timestamp update (мс)."""
+    key = os.path.basename(path)[:-len(".txt")]
+    with open(path, "r", encoding=encoding, errors="ignore") as f:
+        for line in f:
+            try:
+                data = json.loads(line)
+            except ValueError:
+                continue
+            timestamp = data.get("timestamp") if isinstance(data, dict) else None
+            yield {"ts": timestamp / 1000 if timestamp else 0, "key": key, "data": data}
+
+
+def iter_legacy_records(directory, encoding="cp1251"):
+    """Все логи старого формата каталога подряд (файл за файлом)."""
+    for path in legacy_log_files(directory):
+        yield from iter_legacy_file(path, encoding)
+
+
+class JournalWriter:
+    """
+    Append-only журнал событий одного бота.
+    Потоки запросов только кладут событие в очередь; фоновый поток копит пачку,
+    пишет её одним write() в текущий сегмент и переключает сегменты по размеру.
+    """
+
+    def __init__(self, directory, batch_size=JOURNAL_BATCH_SIZE, flush_interval=JOURNAL_FLUSH_INTERVAL,
+                 segment_bytes=JOURNAL_SEGMENT_BYTES, fsync=JOURNAL_FSYNC, encoding=JOURNAL_ENCODING,
+                 queue_size=JOURNAL_QUEUE_SIZE, index=JOURNAL_INDEX, tag=_ANY):
+        if fsync not in ("never", "batch", "rotate"):
+            raise ValueError(f"Unknown JOURNAL_FSYNC policy: {fsync}")
+        self.directory = directory
+        self._tag = _worker_tag if tag is _ANY else tag
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._segment_bytes = segment_bytes
+        self._fsync = fsync
+        self._encoding = encoding
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._file = None
+        self._path = None
+        self._index = journal_index.IndexWriter() if index else None
+        self._seq = 0
+        self._size = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._stats = {
+            "enqueued": 0,
+            "written": 0,
+            "batches": 0,
+            "bytes": 0,
+            "rotations": 0,
+            "errors": 0,
+        }
+        self._thread = threading.Thread(
+            target=self._run, name=f"journal-{os.path.basename(directory)}", daemon=True
+        )
+        self._thread.start()
+
+    # ---------- Публичный API ----------
+
+    def append(self, key, data):
+        """Ставит событие в очередь на запись (без обращения к диску)."""
+        if self._closed:
+            logger.warning("Journal %s is closed, event %s dropped", self.directory, key)
+            return False
+        # put() блокирует только при переполнении очереди - это и есть backpressure
+        self._queue.put((time.time(), key, data))
+        with self._lock:
+            self._stats["enqueued"] += 1
+        return True
+
+    def flush(self, timeout=None):
+        """Дожидается записи всего, что уже поставлено в очередь."""
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout=None):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self._queue.qsize()
+        stats["segment"] = self._seq
+        return stats
+
+    # ---------- Фоновый поток ----------
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP or isinstance(item, threading.Event):
+                self._write(batch)
+                batch, deadline = [], None
+                if item is _STOP:
+                    self._close_segment()
+                    return
+                item.set()
+                continue
+
+            if item is not None:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self._flush_interval
+
+            if batch and (len(batch) >= self._batch_size or time.monotonic() >= deadline):
+                self._write(batch)
+                batch, deadline = [], None
+
+    def _write(self, batch):
+        if not batch:
+            return
+        try:
+            if self._file is None:
+                self._open_segment()
+            chunk = []
+            chunk_size = 0
+            for ts, key, data in batch:
+                record = {"ts": ts, "key": key, "data": data}
+                try:
+                    raw = (json.dumps(record, ensure_ascii=False) + "\n").encode(self._encoding)
+                except UnicodeEncodeError:
+                    # Символ не представим в кодировке (или одиночный суррогат) - \uXXXX, без потерь
+                    raw = (json.dumps(record) + "\n").encode("ascii")
+                if self._size + chunk_size + len(raw) > self._segment_bytes and self._size + chunk_size > 0:
+                    self._write_chunk(chunk)
+                    chunk, chunk_size = [], 0
+                    self._rotate()
+                if self._index is not None:
+                    self._index.add(self._size + chunk_size, len(raw), data)
+                chunk.append(raw)
+                chunk_size += len(raw)
+            self._write_chunk(chunk)
+            if self._fsync == "batch":
+                os.fsync(self._file.fileno())
+            with self._lock:
+                self._stats["written"] += len(batch)
+                self._stats["batches"] += 1
+        except Exception as e:
+            with self._lock:
+                self._stats["errors"] += 1
+            logger.exception("Error writing journal batch to %s: %s", self.directory, e)
+
+    def _write_chunk(self, chunk):
+        if not chunk:
+            return
+        data = b"".join(chunk)
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+        # Индекс пишем после данных, чтобы он не ссылался на ещё не записанные байты
+        if self._index is not None:
+            self._index.commit()
+        with self._lock:
+            self._stats["bytes"] += len(data)
+
+    def _open_segment(self):
+        os.makedirs(self.directory, exist_ok=True)
+        segments = list_segments(self.directory, tag=self._tag)
+        if segments:
+            self._seq, path = segments[-1]
+            if journal_archive.codec_for(path) is not None:
+                self._seq += 1
+            elif os.path.getsize(path) >= self._segment_bytes:
+                if self._index is not None and os.path.exists(journal_index.index_path(path)):
+                    journal_index.seal_segment(path)
+                self._seq += 1
+            # Дожимаем сегменты, сжатие которых прервала остановка процесса
+            for _, sealed in segments[:-1] if self._seq == segments[-1][0] else segments:
+                if journal_archive.codec_for(sealed) is None:
+                    journal_archive.compress_later(sealed)
+        else:
+            self._seq = 1
+        self._open_file()
+
+    def _open_file(self):
+        path = os.path.join(self.directory, segment_name(self._seq, self._tag))
+        self._path = path
+        self._file = open(path, "ab")
+        self._size = self._file.tell()
+        if self._index is not None:
+            self._index.open(path)
+
+    def _close_segment(self, seal=False):
+        if self._file is None:
+            return
+        try:
+            self._file.flush()
+            if self._fsync != "never":
+                os.fsync(self._file.fileno())
+        finally:
+            self._file.close()
+            self._file = None
+            if self._index is not None:
+                self._index.close(seal=seal)
+
+    def _rotate(self):
+        # Закрытый сегмент больше не меняется - сортируем его индекс для бинарного поиска
+        self._close_segment(seal=True)
+        journal_archive.compress_later(self._path)
+        self._seq += 1
+        self._open_file()
+        with self._lock:
+            self._stats["rotations"] += 1
+
+
+_journals = {}
+_journals_lock = threading.Lock()
+
+
+def get_journal(directory):
+    """Журнал для каталога бота (один писатель на каталог)."""
+    journal = _journals.get(directory)
+    if journal is not None:
+        return journal
+    with _journals_lock:
+        journal = _journals.get(directory)
+        if journal is None:
+            journal = JournalWriter(directory)
+            _journals[directory] = journal
+    return journal
+
+
+def journal_stats():
+    with _journals_lock:
+        journals = list(_journals.items())
+    return {directory: journal.stats() for directory, journal in journals}
+
+
+def close_all():
+    """Сбрасывает на диск и закрывает все журналы (вызывается при остановке)."""
+    with _journals_lock:
+        journals = list(_journals.values())
+    for journal in journals:
+        journal.close()
+
+
+atexit.register(close_all)
+
+
+def _after_fork():
+    """Потоки журналов родителя в дочернем процессе не существуют - заводим свои журналы."""
+    global _journals, _journals_lock
+    _journals = {}
+    _journals_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork)
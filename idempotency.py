@@ -0,0 +1,231 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# ==================== КОНФИГУРАЦИЯ ====================
+IDEMPOTENCY_TTL = getattr(config, "IDEMPOTENCY_TTL", 3600)  # секунд
+IDEMPOTENCY_MAX_SIZE = getattr(config, "IDEMPOTENCY_MAX_SIZE", 200000)  # Жёсткий предел записей
+# "memory" - кэш своего процесса, "sqlite" - общий для всех процессов на хосте
+IDEMPOTENCY_BACKEND = getattr(config, "IDEMPOTENCY_BACKEND", "memory")
+IDEMPOTENCY_DB_PATH = getattr(config, "IDEMPOTENCY_DB_PATH", os.path.join("data", "idempotency.db"))
+IDEMPOTENCY_PURGE_EVERY = getattr(config, "IDEMPOTENCY_PURGE_EVERY", 1000)  # Чистить просроченные раз в N вставок
+
+# Все кэши и хранилища процесса - для одного обработчика fork на модуль (без утечки хуков на экземпляр)
+_instances = weakref.WeakSet()
+
+
+class IdempotencyCache:
+    """
+    Кэш уже обработанных update с TTL и жёстким пределом размера.
+    TTL у всех записей одинаковый, поэтому порядок вставки совпадает с порядком истечения:
+    просроченные записи всегда в начале OrderedDict и удаляются за амортизированное O(1).
+    """
+
+    def __init__(self, ttl=IDEMPOTENCY_TTL, max_size=IDEMPOTENCY_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.evicted = 0
+        _instances.add(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def seen(self, key):
+        """Проверяет ключ и запоминает его. True - такой update уже обрабатывался."""
+        if not key:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            ts = self._items.get(key)
+            if ts is not None:
+                self.hits += 1
+                return True
+            self._items[key] = now
+            if len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evicted += 1
+            return False
+
+    def forget(self, key):
+        """Снимает отметку: update не обработан (упал обработчик), повторная доставка его не отбросит."""
+        if not key:
+            return
+        with self._lock:
+            self._items.pop(key, None)
+
+    def _expire(self, now):
+        items = self._items
+        limit = now - self.ttl
+        while items:
+            key, ts = next(iter(items.items()))
+            if ts > limit:
+                break
+            items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        return {"size": len(self._items), "hits": self.hits, "evicted": self.evicted}
+
+
+class SqliteIdempotencyStore:
+    """
+    Общее хранилище ключей идемпотентности для нескольких процессов на одном хосте.
+    SQLite в режиме WAL: проверка и запись ключа - один атомарный UPSERT,
+    просроченный ключ считается новым и перезаписывается.
+    """
+
+    def __init__(self, path=IDEMPOTENCY_DB_PATH, ttl=IDEMPOTENCY_TTL, purge_every=IDEMPOTENCY_PURGE_EVERY):
+        self.path = path
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._local = threading.local()
+        self._inserts = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        _instances.add(self)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS processed (key TEXT PRIMARY KEY, expires REAL NOT NULL) WITHOUT ROWID"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS processed_expires ON processed (expires)")
+
+    def _conn(self):
+        """Своё соединение на каждый поток (sqlite3 не разделяет соединения между потоками)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def seen(self, key):
+        if not key:
+            return False
+        now = time.time()
+        try:
+            cursor = self._conn().execute(
+                "INSERT INTO processed (key, expires) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET expires = excluded.expires WHERE processed.expires < ?",
+                (key, now + self.ttl, now),
+            )
+        except sqlite3.Error as e:
+            # Хранилище недоступно - лучше обработать дубль, чем потерять update
+            logger.error("Idempotency store error: %s", e)
+            return False
+        if cursor.rowcount == 0:
+            with self._lock:
+                self.hits += 1
+            return True
+        with self._lock:
+            self._inserts += 1
+            purge = self._inserts % self.purge_every == 0
+        if purge:
+            self.purge(now)
+        return False
+
+    def forget(self, key):
+        if not key:
+            return
+        try:
+            self._conn().execute("DELETE FROM processed WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            logger.error("Idempotency store error: %s", e)
+
+    def _after_fork(self):
+        """Соединение SQLite нельзя использовать после fork - открываем свои."""
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def purge(self, now=None):
+        """Удаляет просроченные ключи (по индексу expires, без полного прохода)."""
+        now = time.time() if now is None else now
+        try:
+            self._conn().execute("DELETE FROM processed WHERE expires < ?", (now,))
+        except sqlite3.Error as e:
+            logger.error("Idempotency purge error: %s", e)
+
+    def stats(self):
+        return {"backend": "sqlite", "path": self.path, "hits": self.hits}
+
+
+class SharedIdempotencyCache:
+    """
+    Общий кэш с локальным фронтом: повтор, уже виденный этим процессом,
+    отсекается в памяти, остальные ключи проверяются в общем хранилище.
+    """
+
+    def __init__(self, shared, local=None):
+        self.shared = shared
+        self.local = local or IdempotencyCache()
+
+    def seen(self, key):
+        if not key:
+            return False
+        return self.local.seen(key) or self.shared.seen(key)
+
+    def forget(self, key):
+        self.local.forget(key)
+        self.shared.forget(key)
+
+    def __len__(self):
+        return len(self.local)
+
+    def stats(self):
+        return {"local": self.local.stats(), "shared": self.shared.stats()}
+
+
+def create_cache(backend=IDEMPOTENCY_BACKEND):
+    """Кэш идемпотентности выбранного в config бэкенда."""
+    if backend == "memory":
+        return IdempotencyCache()
+    if backend == "sqlite":
+        return SharedIdempotencyCache(SqliteIdempotencyStore())
+    raise ValueError(f"Unknown IDEMPOTENCY_BACKEND: {backend}")
+
+
+def update_key(bot, data):
+    """
+    Ключ идемпотентности для update: mid для сообщений, callback_id для кнопок,
+    для остальных типов - тип + чат + пользователь + timestamp.
+    None, если однозначно определить update нельзя (такой update не отбрасываем).
+    """
+    if not isinstance(data, dict):
+        return None
+    update_type = data.get("update_type")
+    if update_type == "message_created":
+        mid = ((data.get("message") or {}).get("body") or {}).get("mid")
+        return f"{bot}:m:{mid}" if mid else None
+    if update_type == "message_callback":
+        callback_id = (data.get("callback") or {}).get("callback_id")
+        return f"{bot}:c:{callback_id}" if callback_id else None
+    timestamp = data.get("timestamp")
+    if not timestamp:
+        return None
+    user_id = (data.get("user") or {}).get("user_id")
+    return f"{bot}:{update_type}:{data.get('chat_id')}:{user_id}:{timestamp}"
+
+
+def _after_fork():
+    for instance in list(_instances):
+        instance._after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,262 @@
+"""
+Сжатие закрытых сегментов журнала событий.
+
+Закрытый сегмент journal-N.jsonl сжимается блоками по JOURNAL_COMPRESSION_BLOCK байт
+(каждый блок - отдельный gzip-member / zstd-frame) в journal-N.jsonl.gz (.zst), а таблица
+блоков пишется в journal-N.blk. Поэтому сжатый сегмент читается и потоком целиком,
+и с произвольного смещения из индекса (journal_index.py) - распаковывается один блок.
+
+Сжать уже закрытые сегменты вручную:
+    python journal_archive.py LOGS_DIR [LOGS_DIR ...]
+"""
+import argparse
+import bisect
+import gzip
+import io
+import logging
+import os
+import struct
+import sys
+import threading
+import zlib
+
+import config
+
+try:
+    import zstandard
+except ImportError:  # zstd необязателен, без него сжимаем gzip
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# ==================== КОНФИГУРАЦИЯ ====================
+JOURNAL_COMPRESSION = getattr(config, "JOURNAL_COMPRESSION", "gzip")  # "gzip", "zstd" или "none"
+JOURNAL_COMPRESSION_LEVEL = getattr(config, "JOURNAL_COMPRESSION_LEVEL", None)  # None - по умолчанию кодека
+JOURNAL_COMPRESSION_BLOCK = getattr(config, "JOURNAL_COMPRESSION_BLOCK", 1024 * 1024)  # Несжатых байт в блоке
+
+# Смещение блока в несжатом сегменте (8 байт) + смещение в сжатом файле (8 байт)
+BLOCK = struct.Struct("<QQ")
+BLOCKS_SUFFIX = ".blk"
+
+
+class GzipCodec:
+    suffix = ".gz"
+
+    def __init__(self, level=None):
+        self.level = 6 if level is None else level
+
+    def compress(self, data):
+        return gzip.compress(data, compresslevel=self.level, mtime=0)
+
+    def decompress(self, data):
+        return zlib.decompress(data, wbits=31)
+
+    def open(self, path):
+        # GzipFile читает подряд все members файла
+        return gzip.open(path, "rb")
+
+
+class ZstdCodec:
+    suffix = ".zst"
+
+    def __init__(self, level=None):
+        self.level = 3 if level is None else level
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    def open(self, path):
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True,
+                                                            closefd=True)
+        return io.BufferedReader(reader)
+
+
+CODECS = {GzipCodec.suffix: GzipCodec, ZstdCodec.suffix: ZstdCodec}
+
+
+def default_codec(name=JOURNAL_COMPRESSION, level=JOURNAL_COMPRESSION_LEVEL):
+    """Кодек для новых архивов; None - сжатие выключено."""
+    if name in (None, "none"):
+        return None
+    if name == "zstd":
+        if zstandard is not None:
+            return ZstdCodec(level)
+        logger.warning("JOURNAL_COMPRESSION=zstd requires the zstandard package, using gzip")
+        return GzipCodec()
+    if name == "gzip":
+        return GzipCodec(level)
+    raise ValueError(f"Unknown JOURNAL_COMPRESSION: {name}")
+
+
+def codec_for(path):
+    """Кодек по расширению файла; None - файл не сжат."""
+    codec = CODECS.get(os.path.splitext(path)[1])
+    if codec is ZstdCodec and zstandard is None:
+        raise RuntimeError(f"Reading {path} requires the zstandard package")
+    return codec() if codec is not None else None
+
+
+def strip_suffix(path):
+    """Путь без расширения сжатия (journal-N.jsonl.gz -> journal-N.jsonl)."""
+    root, ext = os.path.splitext(path)
+    return root if ext in CODECS else path
+
+
+def blocks_path(path):
+    return os.path.splitext(strip_suffix(path))[0] + BLOCKS_SUFFIX
+
+
+def open_stream(path):
+    """Бинарный поток несжатых данных сегмента; распаковка идёт по мере чтения."""
+    codec = codec_for(path)
+    return codec.open(path) if codec is not None else open(path, "rb")
+
+
+def compress_segment(path, codec=None):
+    """
+    Сжимает закрытый сегмент и удаляет исходный файл. Возвращает путь архива.
+    Исходник удаляется только после fsync архива и таблицы блоков; при сбое посередине
+    остаются оба файла, и list_segments читает несжатый.
+    """
+    codec = codec or default_codec()
+    if codec is None:
+        return None
+    target = path + codec.suffix
+    tmp = target + ".tmp"
+    blocks = []
+    offset = 0
+    with open(path, "rb") as src, open(tmp, "wb") as dst:
+        while True:
+            chunk = src.read(JOURNAL_COMPRESSION_BLOCK)
+            if not chunk:
+                break
+            # Блок заканчивается на границе строки - запись почти всегда читается из одного блока
+            if not chunk.endswith(b"\n"):
+                chunk += src.readline()
+            blocks.append(BLOCK.pack(offset, dst.tell()))
+            dst.write(codec.compress(chunk))
+            offset += len(chunk)
+        dst.flush()
+        os.fsync(dst.fileno())
+    _write_synced(blocks_path(path), b"".join(blocks))
+    os.replace(tmp, target)
+    os.remove(path)
+    return target
+
+
+def _write_synced(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+_compressing = set()
+_compressing_lock = threading.Lock()
+
+
+def compress_later(path, codec=None):
+    """Сжимает сегмент в фоновом потоке, чтобы не задерживать запись журнала."""
+    with _compressing_lock:
+        if path in _compressing:
+            return
+        _compressing.add(path)
+
+    def run():
+        try:
+            size = os.path.getsize(path)
+            target = compress_segment(path, codec)
+            if target is not None:
+                logger.info("Compressed %s: %s -> %s bytes", path, size, os.path.getsize(target))
+        except Exception as e:
+            logger.exception("Failed to compress journal segment %s: %s", path, e)
+        finally:
+            with _compressing_lock:
+                _compressing.discard(path)
+
+    threading.Thread(target=run, name="journal-compress", daemon=True).start()
+
+
+class SegmentReader:
+    """Чтение записи по смещению и длине из индекса - в сжатом или обычном сегменте."""
+
+    def __init__(self, path):
+        self.path = path
+        self._codec = codec_for(path)
+        self._file = open(path, "rb")
+        self._cached = (None, b"")
+        if self._codec is not None:
+            self._starts, self._positions = self._load_blocks()
+
+    def read(self, offset, length):
+        if self._codec is None:
+            self._file.seek(offset)
+            return self._file.read(length)
+        parts = []
+        while length > 0:
+            i = bisect.bisect_right(self._starts, offset) - 1
+            if i < 0:
+                break
+            piece = self._block(i)[offset - self._starts[i]:offset - self._starts[i] + length]
+            if not piece:
+                break
+            parts.append(piece)
+            offset += len(piece)
+            length -= len(piece)
+        return b"".join(parts)
+
+    def close(self):
+        self._file.close()
+
+    def _load_blocks(self):
+        try:
+            with open(blocks_path(self.path), "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            # Без таблицы весь архив - один блок (распаковывается целиком)
+            logger.warning("No block table for %s, decompressing the whole segment", self.path)
+            return [0], [None]
+        pairs = list(BLOCK.iter_unpack(raw[:len(raw) - len(raw) % BLOCK.size]))
+        return [start for start, _ in pairs], [position for _, position in pairs]
+
+    def _block(self, i):
+        if self._cached[0] == i:
+            return self._cached[1]
+        if self._positions[i] is None:
+            with self._codec.open(self.path) as stream:
+                data = stream.read()
+        else:
+            end = self._positions[i + 1] if i + 1 < len(self._positions) else None
+            self._file.seek(self._positions[i])
+            data = self._codec.decompress(self._file.read(-1 if end is None else end - self._positions[i]))
+        self._cached = (i, data)
+        return data
+
+
+def main(argv=None):
+    import event_journal
+
+    parser = argparse.ArgumentParser(description="Сжатие закрытых сегментов журнала")
+    parser.add_argument("directory", nargs="+", help="Каталог журнала бота (LOGS_DIR_*)")
+    parser.add_argument("--codec", choices=("gzip", "zstd"), default=JOURNAL_COMPRESSION
+                        if JOURNAL_COMPRESSION != "none" else "gzip")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    codec = default_codec(args.codec)
+    before = after = 0
+    for directory in args.directory:
+        for path in event_journal.sealed_segments(directory):
+            before += os.path.getsize(path)
+            after += os.path.getsize(compress_segment(path, codec))
+    print(f"Compressed {before} -> {after} bytes", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
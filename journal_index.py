@@ -0,0 +1,268 @@
+"""
+Индекс журнала событий: chat_id / user_id / mid / callback_id -> смещение записи в сегменте.
+
+Рядом с каждым сегментом journal-N.jsonl (journal-N.jsonl.gz после сжатия) лежат:
+    journal-N.idx  - записи индекса в порядке поступления (дописывается журналом на лету)
+    journal-N.sidx - те же записи, отсортированные по ключу (создаётся при ротации сегмента)
+Смещения - в несжатом сегменте; сжатый читается по таблице блоков (journal_archive.py).
+
+Запрос из консоли:
+    python journal_index.py LOGS_DIR --chat-id 123456
+    python journal_index.py LOGS_DIR --rebuild
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+import event_journal
+import journal_archive
+
+# Поле (1 байт) + хэш значения (8 байт) + смещение (8 байт) + длина записи (4 байта)
+RECORD = struct.Struct("<BQQI")
+
+FIELDS = {
+    "chat_id": 1,
+    "user_id": 2,
+    "mid": 3,
+    "callback_id": 4,
+}
+
+
+def key_hash(value):
+    """Стабильный 64-битный хэш значения ключа (одинаковый для 123 и "123")."""
+    digest = hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def extract_keys(data):
+    """Достаёт из update все индексируемые значения: {поле: {значения}}."""
+    keys = {field: set() for field in FIELDS}
+    if not isinstance(data, dict):
+        return keys
+
+    def put(field, value):
+        if value is not None and value != {} and value != "":
+            keys[field].add(str(value))
+
+    message = data.get("message") or {}
+    recipient = message.get("recipient") or {}
+    sender = message.get("sender") or {}
+    callback = data.get("callback") or {}
+    user = data.get("user") or {}
+
+    put("chat_id", data.get("chat_id"))
+    put("chat_id", recipient.get("chat_id"))
+    put("user_id", recipient.get("user_id"))
+    put("user_id", sender.get("user_id"))
+    put("user_id", user.get("user_id"))
+    put("user_id", (callback.get("user") or {}).get("user_id"))
+    put("mid", (message.get("body") or {}).get("mid"))
+    put("callback_id", callback.get("callback_id"))
+    return keys
+
+
+def index_entries(offset, length, data):
+    """Записи индекса (упакованные) для одного события."""
+    entries = []
+    for field, values in extract_keys(data).items():
+        code = FIELDS[field]
+        for value in values:
+            entries.append(RECORD.pack(code, key_hash(value), offset, length))
+    return entries
+
+
+def index_path(segment_path):
+    return event_journal.segment_stem(segment_path) + ".idx"
+
+
+def sorted_index_path(segment_path):
+    return event_journal.segment_stem(segment_path) + ".sidx"
+
+
+def seal_segment(segment_path):
+    """Сливает .idx (и старый .sidx, если есть) в отсортированный .sidx для бинарного поиска."""
+    raw = b""
+    for path in (sorted_index_path(segment_path), index_path(segment_path)):
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                raw += f.read()
+    raw = raw[:len(raw) - len(raw) % RECORD.size]
+    records = sorted(set(RECORD.iter_unpack(raw)))
+    tmp = sorted_index_path(segment_path) + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(b"".join(RECORD.pack(*r) for r in records))
+    os.replace(tmp, sorted_index_path(segment_path))
+    if os.path.exists(index_path(segment_path)):
+        os.remove(index_path(segment_path))
+
+
+class IndexWriter:
+    """Инкрементальная запись индекса; вызывается только из потока журнала."""
+
+    def __init__(self):
+        self._file = None
+        self._segment_path = None
+        self._pending = []
+
+    def open(self, segment_path):
+        self._segment_path = segment_path
+        self._file = open(index_path(segment_path), "ab")
+
+    def add(self, offset, length, data):
+        self._pending.extend(index_entries(offset, length, data))
+
+    def commit(self):
+        """Дописывает накопленные записи (после того, как данные уже в сегменте)."""
+        if self._pending and self._file is not None:
+            self._file.write(b"".join(self._pending))
+            self._file.flush()
+        self._pending = []
+
+    def close(self, seal=False):
+        self.commit()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            if seal:
+                seal_segment(self._segment_path)
+
+
+def build_index(directory, encoding=None):
+    """
+    Полностью перестраивает индекс каталога по сегментам журнала.
+    Запускать, когда журнал каталога не пишется (например, после сбоя).
+    """
+    count = 0
+    for _, segment_path in event_journal.list_segments(directory):
+        entries = []
+        offset = 0
+        with journal_archive.open_stream(segment_path) as f:
+            for raw in f:
+                if raw.endswith(b"\n"):
+                    try:
+                        record = json.loads(event_journal.decode_line(raw, encoding))
+                        entries.extend(index_entries(offset, len(raw), record.get("data")))
+                        count += 1
+                    except ValueError:
+                        pass
+                offset += len(raw)
+        with open(index_path(segment_path), "wb") as f:
+            f.write(b"".join(entries))
+        if os.path.exists(sorted_index_path(segment_path)):
+            os.remove(sorted_index_path(segment_path))
+        seal_segment(segment_path)
+    return count
+
+
+class JournalIndex:
+    """Поиск событий журнала одного бота по индексу."""
+
+    def __init__(self, directory, encoding=None):
+        self.directory = directory
+        self.encoding = encoding
+
+    def lookup(self, field, value):
+        """[(путь сегмента, смещение, длина)] в хронологическом порядке."""
+        code = FIELDS[field]
+        h = key_hash(value)
+        hits = []
+        for _, segment_path in event_journal.list_segments(self.directory):
+            found = set(self._search_sorted(sorted_index_path(segment_path), code, h))
+            found.update(self._scan(index_path(segment_path), code, h))
+            hits.extend((segment_path, offset, length) for offset, length in sorted(found))
+        return hits
+
+    def history(self, field, value):
+        """Записи журнала ({"ts", "key", "data"}) с данным значением ключа."""
+        value = str(value)
+        opened = {}
+        try:
+            for segment_path, offset, length in self.lookup(field, value):
+                reader = opened.get(segment_path)
+                if reader is None:
+                    reader = opened[segment_path] = journal_archive.SegmentReader(segment_path)
+                raw = reader.read(offset, length)
+                try:
+                    record = json.loads(event_journal.decode_line(raw, self.encoding))
+                except ValueError:
+                    continue
+                # Отсекаем коллизии хэша
+                if value in extract_keys(record.get("data"))[field]:
+                    yield record
+        finally:
+            for reader in opened.values():
+                reader.close()
+
+    @staticmethod
+    def _scan(path, code, h):
+        if not os.path.exists(path):
+            return []
+        with open(path, "rb") as f:
+            raw = f.read()
+        raw = raw[:len(raw) - len(raw) % RECORD.size]
+        return [(offset, length) for c, kh, offset, length in RECORD.iter_unpack(raw)
+                if c == code and kh == h]
+
+    @staticmethod
+    def _search_sorted(path, code, h):
+        if not os.path.exists(path) or os.path.getsize(path) < RECORD.size:
+            return []
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            n = len(mm) // RECORD.size
+            lo, hi = 0, n
+            # Бинарный поиск первой записи >= (code, h)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                c, kh, _, _ = RECORD.unpack_from(mm, mid * RECORD.size)
+                if (c, kh) < (code, h):
+                    lo = mid + 1
+                else:
+                    hi = mid
+            result = []
+            while lo < n:
+                c, kh, offset, length = RECORD.unpack_from(mm, lo * RECORD.size)
+                if (c, kh) != (code, h):
+                    break
+                result.append((offset, length))
+                lo += 1
+            return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Поиск событий в журнале бота по индексу")
+    parser.add_argument("directory", help="Каталог журнала бота (LOGS_DIR_*)")
+    parser.add_argument("--chat-id")
+    parser.add_argument("--user-id")
+    parser.add_argument("--mid")
+    parser.add_argument("--callback-id")
+    parser.add_argument("--rebuild", action="store_true", help="Перестроить индекс по сегментам")
+    args = parser.parse_args(argv)
+
+    if args.rebuild:
+        started = time.perf_counter()
+        count = build_index(args.directory)
+        print(f"Indexed {count} events in {(time.perf_counter() - started) * 1000:.1f} ms", file=sys.stderr)
+        return 0
+
+    queries = [(field, getattr(args, field)) for field in FIELDS if getattr(args, field) is not None]
+    if not queries:
+        parser.error("нужен хотя бы один ключ: --chat-id, --user-id, --mid или --callback-id")
+
+    index = JournalIndex(args.directory)
+    started = time.perf_counter()
+    found = 0
+    for field, value in queries:
+        for record in index.history(field, value):
+            print(json.dumps(record, ensure_ascii=False))
+            found += 1
+    print(f"{found} events in {(time.perf_counter() - started) * 1000:.1f} ms", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
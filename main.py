@@ -1,40 +1,31 @@
 from flask import Flask, request, jsonify
 from waitress import serve
 from werkzeug.middleware.proxy_fix import ProxyFix
-import logging.handlers
+import logging
 from config import *
-import os
-import json
-import re
-import hmac
-import hashlib
 import time
 from datetime import datetime
-import reqv_to_bot as reqv
+import outbound_queue
+import rate_limit
+from outbound_queue import dispatcher
+from max_client import client as max_client
+from event_journal import journal_stats, close_all as close_journals
+from bot_registry import BOTS_BY_ROUTE
+from template_cache import templates
+from subscribers import registry as subscribers
+from conversation_state import conversations
+import update_handlers
+from update_handlers import DUPLICATE, FAILED, process_update
+from idempotency import IDEMPOTENCY_BACKEND, create_cache
+import prefork
+import app_logging
+import metrics
+import profiler
+from webhook_auth import SignatureMiddleware, auth as webhook_auth
 
 # ==================== НАСТРОЙКА ЛОГИРОВАНИЯ ====================
-# Создаем папку для логов
-LOG_DIR = 'logs'
-os.makedirs(LOG_DIR, exist_ok=True)
-
-# Ротация логов: 10 файлов по 5 МБ каждый
-file_handler = logging.handlers.RotatingFileHandler(
-    os.path.join(LOG_DIR, 'app.log'),
-    maxBytes=5 * 1024 * 1024,
-    backupCount=10,
-    encoding='utf-8'
-)
-file_handler.setFormatter(logging.Formatter(
-    '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-))
-
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
-
-logging.basicConfig(
-    level=logging.INFO,
-    handlers=[file_handler, console_handler]
-)
+# Файл logs/app.log (у pre-fork воркеров - app-wN.log) с ротацией и консоль; запись - в отдельном потоке (app_logging.py)
+app_logging.setup_logging()
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
@@ -42,333 +33,49 @@ app = Flask(__name__)
 # ==================== ПРОКСИ-НАСТРОЙКИ (для Nginx) ====================
 # Доверяем заголовкам от обратного прокси
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1, x_prefix=1)
+# Подпись вебхука проверяется по сырому телу раньше всего остального (webhook_auth.py)
+app.wsgi_app = SignatureMiddleware(app.wsgi_app)
 
 # ==================== КОНФИГУРАЦИЯ ====================
 
 #os.makedirs(LOGS_DIR, exist_ok=True)
 
-# Простой in-memory кэш для идемпотентности (в продакшене лучше Redis!)
-# Формат: {message_id: timestamp}
-_processed_messages = {}
-IDEMPOTENCY_TTL = 3600  # секунд
-
-
-def cleanup_old_ids():
-    """Удаляет старые записи из кэша идемпотентности."""
-    now = time.time()
-    old_ids = [mid for mid, ts in _processed_messages.items() if now - ts > IDEMPOTENCY_TTL]
-    for mid in old_ids:
-        del _processed_messages[mid]
-    if old_ids:
-        logger.debug(f"Cleaned up {len(old_ids)} old message IDs")
-
-
-def sanitize_filename(name):
-    """Оставляет в имени файла только безопасные символы (цифры и буквы)."""
-    if name is None:
-        return "unknown"
-    # Разрешаем только цифры, буквы, дефис и подчеркивание
-    return re.sub(r'[^\w\-]', '', str(name))
-
-
-
-def is_message_processed(message_id):
-    """Проверяет, обрабатывалось ли уже это сообщение (идемпотентность)."""
-    if not message_id:
-        return False
-    cleanup_old_ids()
-    if message_id in _processed_messages:
-        return True
-    _processed_messages[message_id] = time.time()
-    return False
-
 
 def get_response_text(filename, default_text):
-    """Читает текст ответа из файла. Если файла нет, возвращает default_text."""
-    try:
-        if os.path.exists(filename):
-            with open(filename, 'r', encoding='cp1251') as f:
-                return f.read().strip()
-    except Exception as e:
-        logger.error(f"Error reading file {filename}: {e}")
-    return default_text
+    """Текст ответа из файла (через кэш шаблонов). Если файла нет, возвращает default_text."""
+    return templates.get_text(filename, default_text, encoding='cp1251')
 
 
-def save_message_to_log(filename, data, dir):
-    """Сохраняет входящее сообщение в файл с именем chat_id."""
-    try:
-        if not os.path.exists(dir):
-            os.makedirs(dir)
-
-        safe_filename = sanitize_filename(filename)
-        file_path = os.path.join(dir, f"{safe_filename}.txt")  #
-
-        with open(file_path, 'a', encoding='cp1251', errors='ignore') as f:
-            f.write(json.dumps(data, ensure_ascii=False) + '\n')
-
-    except Exception as e:
-        logger.exception(f"Error saving log for {filename}: {e}")
-
-
-def verify_signature(payload, header_signature, secret):
-    """
-    Проверяет HMAC-подпись вебхука.
-    Возвращает True, если подпись верна.
-    """
-    if not secret or not header_signature:
-        return False
-
-    # Ожидаем формат: sha256=hexdigest или просто hexdigest
-    if '=' in header_signature:
-        header_signature = header_signature.split('=')[1]
-
-    expected = hmac.new(
-        secret.encode('utf-8'),
-        payload,
-        hashlib.sha256
-    ).hexdigest()
-
-    return hmac.compare_digest(expected, header_signature)
-
 def create_message_from_json(json_file):
-    with open(json_file, "r", encoding="utf-8") as f:
-        payload = json.load(f)
-    return payload
+    """JSON-сообщение из кэша шаблонов (общий объект - не изменять)."""
+    return templates.get_json(json_file)
 
 # ==================== ВЕБХУК ЛОГИКА ====================
+# Один endpoint на всех ботов: бот определяется по пути через BOTS_BY_ROUTE,
+# обработчик - по update_type через таблицу UPDATE_HANDLERS (update_handlers.py).
 
-@app.route('/webhook', methods=['GET', 'POST'])
-def webhook():
-    """Основной webhook endpoint для MaxBot."""
-    # GET - health check для балансировщика
-    if request.method == 'GET':
-        return jsonify({"status": "webhook_active"}), 200
-
-    # === 1. Проверка подписи (БЕЗОПАСНОСТЬ) ===
-    if SECRET_KEY:
-        signature = request.headers.get('X-Hub-Signature-256') or request.headers.get('X-Hub-Signature')
-        #if not verify_signature(request.data, signature, SECRET_KEY):
-           # logger.warning(f"Invalid signature from {request.remote_addr}")
-          #  return jsonify({"error": "Forbidden"}), 403
-
-    # === 2. Валидация входных данных ===
-    if not request.is_json:
-        logger.warning("Received non-JSON request")
-        return jsonify({"error": "Content-Type must be application/json"}), 400
-
-    try:
-        data = request.get_json()
-    except Exception as e:
-        logger.error(f"Failed to parse JSON: {e}")
-        return jsonify({"error": "Invalid JSON"}), 400
-
-    # === 3. Идемпотентность (защита от дублей) ===
-
-      # 200, чтобы отправитель не повторял
-
-    # === 4. Быстрое логирование (минимум времени) ===
-    try:
-        response = ''
-        update_type = data.get('update_type')
-
-
-
-        # Сохраняем в файл (асинхронно в идеале, но пока синхронно)
-        if update_type == "message_created":
-            message = data.get('message', {})
-            message_id = data.get('message', {}).get('body', {}).get('mid')
-            chat_id = message.get('recipient', {}).get('chat_id')
-            user_id = message.get('recipient', {}).get('user_id')
-            sender = message.get('sender', {}).get('name', 'Unknown')
-            text = message.get('body', {}).get('text', '')
-
-            #save_message_to_log("message_" + message_id + '_chat_id_' + str(chat_id), data, LOGS_DIR_INVEST)
-            save_message_to_log("message_" + message_id + '_chat_id_' + str(chat_id), data, LOGS_DIR_INVEST)
-        
-        elif update_type == "message_callback":
-            callback = data.get('callback', {})
-            payload = callback.get('payload', {})
-            callback_id = callback.get('callback_id')
-            message = data.get('message', {})
-            message_id = data.get('message', {}).get('body', {}).get('mid')
-            user_id = message.get('recipient', {}).get('user_id')
-            chat_id = message.get('recipient', {}).get('chat_id')
-            save_message_to_log("callback_id_" + callback_id + "_chat_id_" + str(chat_id), data, LOGS_DIR_INVEST)
-            pressed_button = callback.get("payload")
-
-            if pressed_button:
-                if pressed_button == "CITY_TGN":
-                    resp_text = "Вы выбрали Таганрог!"
-                    reqv.delete_message(message_id, BOT_TOKEN_INVEST)
-                    # print("✅ Отправлен ответ: Таганрог")
-
-                elif pressed_button == "CITY_ARM":
-                    resp_text = "Вы выбрали Армавир!"
-                    reqv.delete_message(message_id, BOT_TOKEN_INVEST)
-                    # print("✅ Отправлен ответ: Армавир")
-
-                elif pressed_button == "CITY_KZN":
-                    resp_text = "Вы выбрали Казань!"
-                    reqv.delete_message(message_id, BOT_TOKEN_INVEST)
-                    # print("✅ Отправлен ответ: Казань")
-
-                else:
-                    pass
-
-
-        
-        elif update_type == "bot_started":
-            chat_id = data.get('chat_id', {})
-            user = data.get('user', {})
-            user_id = user.get('user_id', {})
-            response = reqv.hello_message
-            reqv.send_message(user_id, response, BOT_TOKEN_INVEST)
-            save_message_to_log(f"start_{chat_id}", data, LOGS_DIR_INVEST)
-
+@app.route('/<hook>', methods=['GET', 'POST'])
+def webhook(hook):
+    """Webhook endpoint для любого бота из реестра (bot_registry.py)."""
+    bot = BOTS_BY_ROUTE.get(hook)
+    if bot is None:
+        return jsonify({"error": "Not found"}), 404
 
-        elif update_type == "bot_stopped":
-            chat_id = data.get('chat_id', {})
-
-            save_message_to_log(f"stop_{chat_id}", data, LOGS_DIR_INVEST)
-
-        else:
-            logger.info(f"Received unknown update type {update_type}")
-
-        if update_type and chat_id and data:
-            logger.info(f"Webhook [{update_type}]|{data}")
-
-
-
-    except Exception as e:
-        logger.exception("Error during logging phase:"+ str(e))
-        # Не прерываем обработку, если упало логирование
-    return jsonify(response), 200
-
-    # === 5. Формирование ответа (БЫСТРО!) ===
-    # Вся тяжелая логика должна быть вынесена в очередь задач!
-
-@app.route('/webhook1', methods=['GET', 'POST'])
-def webhook1():
-    """Основной webhook endpoint для MaxBot."""
     # GET - health check для балансировщика
     if request.method == 'GET':
         return jsonify({"status": "webhook_active"}), 200
 
-    # === 1. Проверка подписи (БЕЗОПАСНОСТЬ) ===
-    if SECRET_KEY:
-        signature = request.headers.get('X-Hub-Signature-256') or request.headers.get('X-Hub-Signature')
-        # if not verify_signature(request.data, signature, SECRET_KEY):
-        # logger.warning(f"Invalid signature from {request.remote_addr}")
-        #  return jsonify({"error": "Forbidden"}), 403
-
-    # === 2. Валидация входных данных ===
-    if not request.is_json:
-        logger.warning("Received non-JSON request")
-        return jsonify({"error": "Content-Type must be application/json"}), 400
-
-    try:
-        data = request.get_json()
-    except Exception as e:
-        logger.error(f"Failed to parse JSON: {e}")
-        return jsonify({"error": "Invalid JSON"}), 400
-
-    # === 3. Идемпотентность (защита от дублей) ===
-
-    # 200, чтобы отправитель не повторял
-
-    # === 4. Быстрое логирование (минимум времени) ===
-    try:
-        response = ''
-        update_type = data.get('update_type')
-
-        # Сохраняем в файл (асинхронно в идеале, но пока синхронно)
-        if update_type == "message_created":
-            message = data.get('message', {})
-            message_id = data.get('message', {}).get('body', {}).get('mid')
-            chat_id = message.get('recipient', {}).get('chat_id')
-            user_id = message.get('recipient', {}).get('user_id')
-            sender = message.get('sender', {}).get('name', 'Unknown')
-            text = message.get('body', {}).get('text', '')
-
-            # save_message_to_log("message_" + message_id + '_chat_id_' + str(chat_id), data, LOGS_DIR_SOTR)
-            save_message_to_log("message_" + message_id + '_chat_id_' + str(chat_id), data, LOGS_DIR_SOTR)
-
-        elif update_type == "message_callback":
-            callback = data.get('callback', {})
-            payload = callback.get('payload', {})
-            callback_id = callback.get('callback_id')
-            message = data.get('message', {})
-            message_id = data.get('message', {}).get('body', {}).get('mid')
-            user_id = message.get('recipient', {}).get('user_id')
-            chat_id = message.get('recipient', {}).get('chat_id')
-            save_message_to_log("callback_id_" + callback_id + "_chat_id_" + str(chat_id), data, LOGS_DIR_SOTR)
-            pressed_button = callback.get("payload")
+    started = time.perf_counter()
+    response, status = handle_webhook_post(bot)
+    metrics.webhook_seconds.observe(time.perf_counter() - started, bot.name)
+    metrics.webhook_requests.inc(bot.name, str(status))
+    return response, status
 
-            if pressed_button:
-                if pressed_button == "CITY_TGN":
-                    resp_text = "Вы выбрали Таганрог!"
-                    reqv.delete_message(message_id, BOT_TOKEN_SOTR)
-                    # print("✅ Отправлен ответ: Таганрог")
-
-                elif pressed_button == "CITY_ARM":
-                    resp_text = "Вы выбрали Армавир!"
-                    reqv.delete_message(message_id, BOT_TOKEN_SOTR)
-                    # print("✅ Отправлен ответ: Армавир")
-
-                elif pressed_button == "CITY_KZN":
-                    resp_text = "Вы выбрали Казань!"
-                    reqv.delete_message(message_id, BOT_TOKEN_SOTR)
-                    # print("✅ Отправлен ответ: Казань")
-
-                else:
-                    pass
-
-
-
-        elif update_type == "bot_started":
-            chat_id = data.get('chat_id', {})
-            user = data.get('user', {})
-            user_id = user.get('user_id', {})
-            response = reqv.hello_message
-            reqv.send_message(user_id, response, BOT_TOKEN_SOTR)
-            save_message_to_log(f"start_{chat_id}", data, LOGS_DIR_SOTR)
-
-
-        elif update_type == "bot_stopped":
-            chat_id = data.get('chat_id', {})
-
-            save_message_to_log(f"stop_{chat_id}", data, LOGS_DIR_SOTR)
-
-        else:
-            logger.info(f"Received unknown update type {update_type}")
-
-        if update_type and chat_id and data:
-            logger.info(f"Webhook [{update_type}]|{data}")
-
-
-
-    except Exception as e:
-        logger.exception("Error during logging phase:" + str(e))
-        # Не прерываем обработку, если упало логирование
-    return jsonify(response), 200
-
-    # === 5. Формирование ответа (БЫСТРО!) ===
-    # Вся тяжелая логика должна быть вынесена в очередь задач!
-
-
-@app.route('/webhook2', methods=['GET', 'POST'])
-def webhook2():
-    """Основной webhook endpoint для MaxBot."""
-    # GET - health check для балансировщика
-    if request.method == 'GET':
-        return jsonify({"status": "webhook_active"}), 200
 
+def handle_webhook_post(bot):
+    """POST с update для бота: (ответ, HTTP-статус)."""
     # === 1. Проверка подписи (БЕЗОПАСНОСТЬ) ===
-    if SECRET_KEY:
-        signature = request.headers.get('X-Hub-Signature-256') or request.headers.get('X-Hub-Signature')
-        # if not verify_signature(request.data, signature, SECRET_KEY):
-        # logger.warning(f"Invalid signature from {request.remote_addr}")
-        #  return jsonify({"error": "Forbidden"}), 403
+    # Выполнена до Flask в SignatureMiddleware (webhook_auth.py) - сюда доходят только подписанные запросы
 
     # === 2. Валидация входных данных ===
     if not request.is_json:
@@ -378,342 +85,142 @@ def webhook2():
     try:
         data = request.get_json()
     except Exception as e:
-        logger.error(f"Failed to parse JSON: {e}")
+        logger.error("Failed to parse JSON: %s", e)
         return jsonify({"error": "Invalid JSON"}), 400
 
-    # === 3. Идемпотентность (защита от дублей) ===
-
-    # 200, чтобы отправитель не повторял
-
-    # === 4. Быстрое логирование (минимум времени) ===
-    try:
-        response = ''
-        update_type = data.get('update_type')
-
-        # Сохраняем в файл (асинхронно в идеале, но пока синхронно)
-        if update_type == "message_created":
-            message = data.get('message', {})
-            message_id = data.get('message', {}).get('body', {}).get('mid')
-            chat_id = message.get('recipient', {}).get('chat_id')
-            user_id = message.get('recipient', {}).get('user_id')
-            sender = message.get('sender', {}).get('name', 'Unknown')
-            text = message.get('body', {}).get('text', '')
-
-            # save_message_to_log("message_" + message_id + '_chat_id_' + str(chat_id), data, LOGS_DIR_CHECK)
-            save_message_to_log("message_" + message_id + '_chat_id_' + str(chat_id), data, LOGS_DIR_CHECK)
-
-        elif update_type == "message_callback":
-            callback = data.get('callback', {})
-            payload = callback.get('payload', {})
-            callback_id = callback.get('callback_id')
-            message = data.get('message', {})
-            message_id = data.get('message', {}).get('body', {}).get('mid')
-            user_id = message.get('recipient', {}).get('user_id')
-            chat_id = message.get('recipient', {}).get('chat_id')
-            save_message_to_log("callback_id_" + callback_id + "_chat_id_" + str(chat_id), data, LOGS_DIR_CHECK)
-            pressed_button = callback.get("payload")
-
-            if pressed_button:
-                if pressed_button == "CITY_TGN":
-                    resp_text = "Вы выбрали Таганрог!"
-                    reqv.delete_message(message_id, BOT_TOKEN_CHECK)
-                    # print("✅ Отправлен ответ: Таганрог")
-
-                elif pressed_button == "CITY_ARM":
-                    resp_text = "Вы выбрали Армавир!"
-                    reqv.delete_message(message_id, BOT_TOKEN_CHECK)
-                    # print("✅ Отправлен ответ: Армавир")
-
-                elif pressed_button == "CITY_KZN":
-                    resp_text = "Вы выбрали Казань!"
-                    reqv.delete_message(message_id, BOT_TOKEN_CHECK)
-                    # print("✅ Отправлен ответ: Казань")
-
-                else:
-                    pass
-
-
-
-        elif update_type == "bot_started":
-            chat_id = data.get('chat_id', {})
-            user = data.get('user', {})
-            user_id = user.get('user_id', {})
-            response = reqv.hello_message
-            reqv.send_message(user_id, response, BOT_TOKEN_CHECK)
-            save_message_to_log(f"start_{chat_id}", data, LOGS_DIR_CHECK)
-
-
-        elif update_type == "bot_stopped":
-            chat_id = data.get('chat_id', {})
-
-            save_message_to_log(f"stop_{chat_id}", data, LOGS_DIR_CHECK)
-
-        else:
-            logger.info(f"Received unknown update type {update_type}")
-
-        if update_type and chat_id and data:
-            logger.info(f"Webhook [{update_type}]|{data}")
-
-
-
-    except Exception as e:
-        logger.exception("Error during logging phase:" + str(e))
-        # Не прерываем обработку, если упало логирование
+    # === 3. Идемпотентность и обработка (тяжёлые вызовы API - в очереди) ===
+    response = process_update(bot, data)
+    if response is DUPLICATE:
+        return jsonify({"status": "duplicate"}), 200  # 200, чтобы отправитель не повторял
+    if response is FAILED:
+        return jsonify(''), 200  # Ошибка уже в логе; ответ отправителю - как и раньше
+    if isinstance(response, bytes):
+        # Уже сериализованный JSON (например, приветствие из кэша шаблонов)
+        return app.response_class(response, mimetype='application/json'), 200
     return jsonify(response), 200
 
-    # === 5. Формирование ответа (БЫСТРО!) ===
-    # Вся тяжелая логика должна быть вынесена в очередь задач!
-
-
-@app.route('/webhook3', methods=['GET', 'POST'])
-def webhook3():
-    """Основной webhook endpoint для MaxBot."""
-    # GET - health check для балансировщика
-    if request.method == 'GET':
-        return jsonify({"status": "webhook_active"}), 200
-
-    # === 1. Проверка подписи (БЕЗОПАСНОСТЬ) ===
-    if SECRET_KEY:
-        signature = request.headers.get('X-Hub-Signature-256') or request.headers.get('X-Hub-Signature')
-        # if not verify_signature(request.data, signature, SECRET_KEY):
-        # logger.warning(f"Invalid signature from {request.remote_addr}")
-        #  return jsonify({"error": "Forbidden"}), 403
 
-    # === 2. Валидация входных данных ===
-    if not request.is_json:
-        logger.warning("Received non-JSON request")
-        return jsonify({"error": "Content-Type must be application/json"}), 400
-
-    try:
-        data = request.get_json()
-    except Exception as e:
-        logger.error(f"Failed to parse JSON: {e}")
-        return jsonify({"error": "Invalid JSON"}), 400
-
-    # === 3. Идемпотентность (защита от дублей) ===
-
-    # 200, чтобы отправитель не повторял
-
-    # === 4. Быстрое логирование (минимум времени) ===
+def health_status():
+    """Состояние процесса для /health (общее для Flask- и ASGI-режима)."""
+    return {
+        "status": "healthy",
+        "timestamp": datetime.utcnow().isoformat(),
+        "processed_cache_size": len(update_handlers.processed_updates),
+        "idempotency": update_handlers.processed_updates.stats(),
+        "outbound": outbound_queue.dispatcher.stats(),
+        "http_pools": max_client.stats(),
+        "journals": journal_stats(),
+        "templates": templates.stats(),
+        "subscribers": subscribers.stats(),
+        "conversations": conversations.stats(),
+        "logging": app_logging.stats(),
+        "signatures": webhook_auth.stats()
+    }
+
+
+def metrics_text():
+    """Метрики для /metrics; в pre-fork режиме - сумма по всем процессам-обработчикам."""
+    others = prefork.cluster_metrics()
+    if others is None:
+        return metrics.render()
+    return metrics.render(metrics.merge(others + [metrics.snapshot()]))
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Метрики в текстовом формате Prometheus."""
+    return app.response_class(metrics_text(), content_type=metrics.CONTENT_TYPE), 200
+
+
+@app.route('/admin/profile', methods=['GET'])
+def profile_endpoint():
+    """
+    Профиль потоков этого процесса на ?seconds=N в формате collapsed stacks (profiler.py).
+    Нужен заголовок X-Admin-Token = PROFILER_TOKEN; без токена в конфиге эндпоинта нет.
+    """
+    if not profiler.authorized(request.headers.get('X-Admin-Token')):
+        return jsonify({"error": "Not found"}), 404
     try:
-        response = ''
-        update_type = data.get('update_type')
-
-        # Сохраняем в файл (асинхронно в идеале, но пока синхронно)
-        if update_type == "message_created":
-            message = data.get('message', {})
-            message_id = data.get('message', {}).get('body', {}).get('mid')
-            chat_id = message.get('recipient', {}).get('chat_id')
-            user_id = message.get('recipient', {}).get('user_id')
-            sender = message.get('sender', {}).get('name', 'Unknown')
-            text = message.get('body', {}).get('text', '')
-
-            # save_message_to_log("message_" + message_id + '_chat_id_' + str(chat_id), data, LOGS_DIR_ISP)
-            save_message_to_log("message_" + message_id + '_chat_id_' + str(chat_id), data, LOGS_DIR_ISP)
-
-        elif update_type == "message_callback":
-            callback = data.get('callback', {})
-            payload = callback.get('payload', {})
-            callback_id = callback.get('callback_id')
-            message = data.get('message', {})
-            message_id = data.get('message', {}).get('body', {}).get('mid')
-            user_id = message.get('recipient', {}).get('user_id')
-            chat_id = message.get('recipient', {}).get('chat_id')
-            save_message_to_log("callback_id_" + callback_id + "_chat_id_" + str(chat_id), data, LOGS_DIR_ISP)
-            pressed_button = callback.get("payload")
-
-            if pressed_button:
-                if pressed_button == "CITY_TGN":
-                    resp_text = "Вы выбрали Таганрог!"
-                    reqv.delete_message(message_id, BOT_TOKEN_ISP)
-                    # print("✅ Отправлен ответ: Таганрог")
+        seconds, interval = profiler.parse_params(request.args.get('seconds', profiler.PROFILER_DEFAULT_SECONDS),
+                                                  request.args.get('interval', profiler.PROFILER_INTERVAL))
+    except ValueError:
+        return jsonify({"error": "seconds and interval must be finite numbers"}), 400
+    result = profiler.profile(seconds, interval, request.args.get('threads'))
+    if result is None:
+        return jsonify({"error": "Profiler is already running"}), 409
+    text, samples = result
+    response = app.response_class(text, content_type='text/plain; charset=utf-8')
+    response.headers['X-Profile-Samples'] = str(samples)
+    return response, 200
 
-                elif pressed_button == "CITY_ARM":
-                    resp_text = "Вы выбрали Армавир!"
-                    reqv.delete_message(message_id, BOT_TOKEN_ISP)
-                    # print("✅ Отправлен ответ: Армавир")
 
-                elif pressed_button == "CITY_KZN":
-                    resp_text = "Вы выбрали Казань!"
-                    reqv.delete_message(message_id, BOT_TOKEN_ISP)
-                    # print("✅ Отправлен ответ: Казань")
-
-                else:
-                    pass
-
-
-
-        elif update_type == "bot_started":
-            chat_id = data.get('chat_id', {})
-            user = data.get('user', {})
-            user_id = user.get('user_id', {})
-            response = reqv.hello_message
-            reqv.send_message(user_id, response, BOT_TOKEN_ISP)
-            save_message_to_log(f"start_{chat_id}", data, LOGS_DIR_ISP)
-
-
-        elif update_type == "bot_stopped":
-            chat_id = data.get('chat_id', {})
-
-            save_message_to_log(f"stop_{chat_id}", data, LOGS_DIR_ISP)
-
-        else:
-            logger.info(f"Received unknown update type {update_type}")
-
-        if update_type and chat_id and data:
-            logger.info(f"Webhook [{update_type}]|{data}")
+@app.route('/health', methods=['GET'])
+def health_check():
+    """Эндпоинт для проверки работоспособности (для Nginx/мониторинга)."""
+    status = health_status()
+    cluster = prefork.cluster_status()
+    if cluster is not None:
+        # Pre-fork режим: сводка по всем процессам-обработчикам
+        status["cluster"] = cluster
+    return jsonify(status), 200
 
 
+# ==================== ЗАПУСК ====================
 
-    except Exception as e:
-        logger.exception("Error during logging phase:" + str(e))
-        # Не прерываем обработку, если упало логирование
-    return jsonify(response), 200
+WAITRESS_OPTIONS = dict(
+    threads=WAITRESS_THREADS,
+    channel_timeout=30,  # Таймаут канала (сек)
+    connection_limit=100,  # Макс соединений
+    recv_bytes=10485760,  # Макс размер тела запроса (10 MB)
+)
 
-    # === 5. Формирование ответа (БЫСТРО!) ===
-    # Вся тяжелая логика должна быть вынесена в очередь задач!
 
+def shutdown_background():
+    """Досылаем то, что уже принято в очередь, и сбрасываем журналы на диск."""
+    outbound_queue.dispatcher.shutdown()
+    max_client.close()
+    close_journals()
 
-@app.route('/webhook4', methods=['GET', 'POST'])
-def webhook4():
-    """Основной webhook endpoint для MaxBot."""
-    # GET - health check для балансировщика
-    if request.method == 'GET':
-        return jsonify({"status": "webhook_active"}), 200
 
-    # === 1. Проверка подписи (БЕЗОПАСНОСТЬ) ===
-    if SECRET_KEY:
-        signature = request.headers.get('X-Hub-Signature-256') or request.headers.get('X-Hub-Signature')
-        # if not verify_signature(request.data, signature, SECRET_KEY):
-        # logger.warning(f"Invalid signature from {request.remote_addr}")
-        #  return jsonify({"error": "Forbidden"}), 403
+def run_production():
+    """Запуск через Waitress для продакшена."""
+    host = HOST  # Только localhost! SSL терминирует Nginx
+    port = PORT
 
-    # === 2. Валидация входных данных ===
-    if not request.is_json:
-        logger.warning("Received non-JSON request")
-        return jsonify({"error": "Content-Type must be application/json"}), 400
+    logger.info("Starting Waitress server on %s:%s with %s threads", host, port, WAITRESS_OPTIONS['threads'])
+    logger.info("⚠️  SSL should be handled by Nginx reverse proxy")
 
+    dispatcher.start()
+    templates.start()
+    profiler.install_signal_handler()
     try:
-        data = request.get_json()
-    except Exception as e:
-        logger.error(f"Failed to parse JSON: {e}")
-        return jsonify({"error": "Invalid JSON"}), 400
+        # Waitress не поддерживает SSL напрямую - используем HTTP за Nginx
+        serve(app, host=host, port=port, **WAITRESS_OPTIONS)
+    finally:
+        shutdown_background()
 
-    # === 3. Идемпотентность (защита от дублей) ===
 
-    # 200, чтобы отправитель не повторял
-
-    # === 4. Быстрое логирование (минимум времени) ===
+def serve_worker(sock):
+    """Процесс-обработчик pre-fork режима: Waitress на сокете, полученном от мастера."""
+    templates.start()
+    profiler.install_signal_handler()
     try:
-        response = ''
-        update_type = data.get('update_type')
-
-        # Сохраняем в файл (асинхронно в идеале, но пока синхронно)
-        if update_type == "message_created":
-            message = data.get('message', {})
-            message_id = data.get('message', {}).get('body', {}).get('mid')
-            chat_id = message.get('recipient', {}).get('chat_id')
-            user_id = message.get('recipient', {}).get('user_id')
-            sender = message.get('sender', {}).get('name', 'Unknown')
-            text = message.get('body', {}).get('text', '')
-
-            # save_message_to_log("message_" + message_id + '_chat_id_' + str(chat_id), data, LOGS_DIR_IQ)
-            save_message_to_log("message_" + message_id + '_chat_id_' + str(chat_id), data, LOGS_DIR_IQ)
-
-        elif update_type == "message_callback":
-            callback = data.get('callback', {})
-            payload = callback.get('payload', {})
-            callback_id = callback.get('callback_id')
-            message = data.get('message', {})
-            message_id = data.get('message', {}).get('body', {}).get('mid')
-            user_id = message.get('recipient', {}).get('user_id')
-            chat_id = message.get('recipient', {}).get('chat_id')
-            save_message_to_log("callback_id_" + callback_id + "_chat_id_" + str(chat_id), data, LOGS_DIR_IQ)
-            pressed_button = callback.get("payload")
-
-            if pressed_button:
-                if pressed_button == "CITY_TGN":
-                    resp_text = "Вы выбрали Таганрог!"
-                    reqv.delete_message(message_id, BOT_TOKEN_IQ)
-                    # print("✅ Отправлен ответ: Таганрог")
-
-                elif pressed_button == "CITY_ARM":
-                    resp_text = "Вы выбрали Армавир!"
-                    reqv.delete_message(message_id, BOT_TOKEN_IQ)
-                    # print("✅ Отправлен ответ: Армавир")
-
-                elif pressed_button == "CITY_KZN":
-                    resp_text = "Вы выбрали Казань!"
-                    reqv.delete_message(message_id, BOT_TOKEN_IQ)
-                    # print("✅ Отправлен ответ: Казань")
-
-                else:
-                    pass
-
-
+        serve(app, sockets=[sock], **WAITRESS_OPTIONS)
+    finally:
+        shutdown_background()
 
-        elif update_type == "bot_started":
-            chat_id = data.get('chat_id', {})
-            user = data.get('user', {})
-            user_id = user.get('user_id', {})
-            response = reqv.hello_message
-            reqv.send_message(user_id, response, BOT_TOKEN_IQ)
-            save_message_to_log(f"start_{chat_id}", data, LOGS_DIR_IQ)
-
-
-        elif update_type == "bot_stopped":
-            chat_id = data.get('chat_id', {})
-
-            save_message_to_log(f"stop_{chat_id}", data, LOGS_DIR_IQ)
-
-        else:
-            logger.info(f"Received unknown update type {update_type}")
-
-        if update_type and chat_id and data:
-            logger.info(f"Webhook [{update_type}]|{data}")
-
-
-
-    except Exception as e:
-        logger.exception("Error during logging phase:" + str(e))
-        # Не прерываем обработку, если упало логирование
-    return jsonify(response), 200
-
-    # === 5. Формирование ответа (БЫСТРО!) ===
-    # Вся тяжелая логика должна быть вынесена в очередь задач!
-
-
-@app.route('/health', methods=['GET'])
-def health_check():
-    """Эндпоинт для проверки работоспособности (для Nginx/мониторинга)."""
-    return jsonify({
-        "status": "healthy",
-        "timestamp": datetime.utcnow().isoformat(),
-        "processed_cache_size": len(_processed_messages)
-    }), 200
-
-
-# ==================== ЗАПУСК ====================
-
-def run_production():
-    """Запуск через Waitress для продакшена."""
-    host = HOST  # Только localhost! SSL терминирует Nginx
-    port = PORT
-    threads = WAITRESS_THREADS
-
-    logger.info(f"Starting Waitress server on {host}:{port} with {threads} threads")
-    logger.info("⚠️  SSL should be handled by Nginx reverse proxy")
 
-    # Waitress не поддерживает SSL напрямую - используем HTTP за Nginx
-    serve(
-        app,
-        host=host,
-        port=port,
-        threads=threads,
-        channel_timeout=30,  # Таймаут канала (сек)
-        connection_limit=100,  # Макс соединений
-        recv_bytes=10485760,  # Макс размер тела запроса (10 MB)
-    )
+def run_prefork_production(workers=prefork.PREFORK_WORKERS):
+    """Запуск N процессов Waitress на одном порту под присмотром мастер-процесса."""
+    if IDEMPOTENCY_BACKEND == "memory":
+        # У каждого процесса свой кэш в памяти пропустил бы дубли, пришедшие в разные процессы
+        logger.warning("IDEMPOTENCY_BACKEND=memory is per-process, using sqlite in pre-fork mode")
+        update_handlers.processed_updates = create_cache("sqlite")
+    if rate_limit.RATE_LIMIT_BACKEND == "memory":
+        # Иначе каждый процесс расходует лимит токена целиком: N процессов шлют в N раз быстрее
+        logger.warning("RATE_LIMIT_BACKEND=memory is per-process, using sqlite in pre-fork mode")
+        rate_limit.limiter = rate_limit.create_limiter("sqlite")
+    prefork.run_prefork(serve_worker, HOST, PORT, workers=workers, status=health_status, metrics=metrics.snapshot)
 
 
 if __name__ == '__main__':
@@ -723,5 +230,16 @@ if __name__ == '__main__':
     if len(sys.argv) > 1 and sys.argv[1] == '--dev':
         logger.warning("⚠️  Running in DEVELOPMENT mode with app.run()")
         app.run(host='0.0.0.0', port=80, debug=True)
+    elif len(sys.argv) > 1 and sys.argv[1] == '--prefork':
+        # Несколько процессов на одном порту: python main.py --prefork [N]
+        run_prefork_production(int(sys.argv[2]) if len(sys.argv) > 2 else prefork.PREFORK_WORKERS)
+    elif len(sys.argv) > 1 and sys.argv[1] == '--asgi':
+        # Асинхронный режим (uvicorn + aiohttp): те же маршруты, без пула потоков
+        from asgi_app import run_asgi
+        profiler.install_signal_handler()
+        try:
+            run_asgi(HOST, PORT, health=health_status, metrics_text=metrics_text)
+        finally:
+            close_journals()
     else:
         run_production()
\ No newline at end of file
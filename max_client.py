@@ -0,0 +1,125 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import config
+from bot_registry import mask_token
+
+# ==================== КОНФИГУРАЦИЯ ====================
+HTTP_POOL_CONNECTIONS = getattr(config, "HTTP_POOL_CONNECTIONS", 2)  # Пулов (хостов) на сессию
+HTTP_POOL_MAXSIZE = getattr(config, "HTTP_POOL_MAXSIZE", 10)  # Соединений в пуле на хост
+HTTP_POOL_BLOCK = getattr(config, "HTTP_POOL_BLOCK", False)  # Ждать свободное соединение вместо нового
+HTTP_KEEPALIVE = getattr(config, "HTTP_KEEPALIVE", True)  # Держать соединения открытыми
+# Повторов на уровне HTTP (urllib3). По умолчанию 0: временные ошибки повторяет диспетчер
+# (outbound_queue, DISPATCH_MAX_RETRIES) и цикл опроса (MessegeGetter) - с учётом лимитов и 429.
+# Повторы здесь умножаются на повторы диспетчера: 2 и 3 дают до 12 попыток на задание
+HTTP_RETRY_TOTAL = getattr(config, "HTTP_RETRY_TOTAL", 0)
+HTTP_RETRY_BACKOFF = getattr(config, "HTTP_RETRY_BACKOFF", 0.3)  # backoff_factor для urllib3
+HTTP_RETRY_STATUSES = getattr(config, "HTTP_RETRY_STATUSES", (502, 503, 504))
+# POST не идемпотентен: повтор отправки может продублировать сообщение
+HTTP_RETRY_METHODS = getattr(config, "HTTP_RETRY_METHODS", ("GET", "DELETE"))
+
+
+class MaxClient:
+    """
+    Пул HTTP-сессий к MAX API: одна requests.Session с keep-alive на каждый токен бота.
+    Повторные запросы идут по уже открытым TCP+TLS соединениям.
+    """
+
+    def __init__(self, pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE,
+                 pool_block=HTTP_POOL_BLOCK, keepalive=HTTP_KEEPALIVE, retry_total=HTTP_RETRY_TOTAL,
+                 retry_backoff=HTTP_RETRY_BACKOFF, retry_statuses=HTTP_RETRY_STATUSES,
+                 retry_methods=HTTP_RETRY_METHODS):
+        self._pool_connections = pool_connections
+        self._pool_maxsize = pool_maxsize
+        self._pool_block = pool_block
+        self._keepalive = keepalive
+        self._retry = Retry(
+            total=retry_total,
+            connect=retry_total,
+            backoff_factor=retry_backoff,
+            status_forcelist=tuple(retry_statuses),
+            allowed_methods=frozenset(retry_methods),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def session(self, token):
+        """Возвращает (и при первом обращении создаёт) сессию для токена."""
+        session = self._sessions.get(token)
+        if session is not None:
+            return session
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None:
+                session = self._create_session(token)
+                self._sessions[token] = session
+        return session
+
+    def _create_session(self, token):
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self._pool_connections,
+            pool_maxsize=self._pool_maxsize,
+            pool_block=self._pool_block,
+            max_retries=self._retry,
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({
+            "Authorization": token,
+            "Content-Type": "application/json",
+        })
+        if not self._keepalive:
+            session.headers["Connection"] = "close"
+        return session
+
+    def request(self, method, url, token, **kwargs):
+        return self.session(token).request(method, url, **kwargs)
+
+    def stats(self):
+        """
+        Счётчики переиспользования соединений по каждому токену.
+        reused = запросы, обслуженные уже открытым соединением.
+        """
+        with self._lock:
+            sessions = list(self._sessions.items())
+        result = {}
+        for token, session in sessions:
+            requests_count = 0
+            connections = 0
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is None:
+                        continue
+                    requests_count += pool.num_requests
+                    connections += pool.num_connections
+            result[mask_token(token)] = {
+                "requests": requests_count,
+                "connections_opened": connections,
+                "connections_reused": max(0, requests_count - connections),
+            }
+        return result
+
+    def _after_fork(self):
+        """Соединения родителя в дочернем процессе не используем - пулы создаются заново."""
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.close()
+
+
+client = MaxClient()
+os.register_at_fork(after_in_child=client._after_fork)
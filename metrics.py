@@ -0,0 +1,162 @@
+"""
+Метрики процесса в текстовом формате Prometheus (GET /metrics).
+
+Счётчики и гистограммы хранятся в словарях {значения меток: число}; запись - одна
+блокировка и несколько операций со словарём (единицы микросекунд). В pre-fork режиме
+каждый процесс публикует снимок своих метрик (prefork.py), /metrics суммирует их.
+"""
+import bisect
+import os
+import threading
+
+# Границы гистограмм задержек (сек)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def snapshot(self):
+        with self._lock:
+            values = [[list(labels), value] for labels, value in self._values.items()]
+        return {"type": self.kind, "help": self.documentation, "labels": list(self.labelnames), "values": values}
+
+    def _reset(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, *labels):
+        # Счётчики по корзинам не накопительные; накопительными их делает экспорт
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def snapshot(self):
+        with self._lock:
+            values = [[list(labels), [list(counts), total]] for labels, (counts, total) in self._values.items()]
+        return {"type": self.kind, "help": self.documentation, "labels": list(self.labelnames),
+                "buckets": list(self.buckets), "values": values}
+
+    def _reset(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+
+def snapshot():
+    """Все метрики процесса в JSON-совместимом виде (для публикации в pre-fork режиме)."""
+    return {metric.name: metric.snapshot() for metric in _registry}
+
+
+def merge(snapshots):
+    """Сумма снимков нескольких процессов."""
+    merged = {}
+    for snap in snapshots:
+        for name, metric in snap.items():
+            target = merged.get(name)
+            if target is None:
+                target = merged[name] = dict(metric, values={})
+            for labels, value in metric["values"]:
+                key = tuple(labels)
+                current = target["values"].get(key)
+                if metric["type"] == "histogram":
+                    if current is None:
+                        target["values"][key] = [list(value[0]), value[1]]
+                    else:
+                        current[0] = [a + b for a, b in zip(current[0], value[0])]
+                        current[1] += value[1]
+                else:
+                    target["values"][key] = (current or 0) + value
+    for metric in merged.values():
+        metric["values"] = [[list(labels), value] for labels, value in metric["values"].items()]
+    return merged
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render(snap=None):
+    """Текстовый формат Prometheus 0.0.4 для снимка (по умолчанию - метрики этого процесса)."""
+    snap = snapshot() if snap is None else snap
+    lines = []
+    for name, metric in sorted(snap.items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        names = metric["labels"]
+        for labels, value in sorted(metric["values"]):
+            if metric["type"] != "histogram":
+                lines.append(f"{name}{_labels(names, labels)} {value}")
+                continue
+            counts, total = value
+            cumulative = 0
+            for bound, count in zip(list(metric["buckets"]) + ["+Inf"], counts):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{name}_bucket{_labels(names, labels, le)} {cumulative}")
+            lines.append(f"{name}_sum{_labels(names, labels)} {total}")
+            lines.append(f"{name}_count{_labels(names, labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# ==================== МЕТРИКИ ПРИЛОЖЕНИЯ ====================
+
+webhook_requests = Counter("webhook_requests_total", "Webhook HTTP responses", ("bot", "status"))
+webhook_seconds = Histogram("webhook_request_seconds", "Webhook request handling time", ("bot",))
+updates = Counter("updates_total", "Processed updates", ("bot", "update_type", "result"))
+update_seconds = Histogram("update_handle_seconds", "Update handler time", ("bot", "update_type"))
+journal_seconds = Histogram("journal_append_seconds", "save_message_to_log time", ("bot",))
+outbound_requests = Counter("outbound_requests_total", "MAX API calls", ("bot", "method", "status"))
+outbound_seconds = Histogram("outbound_request_seconds", "MAX API call latency", ("bot", "method"))
+signature_checks = Counter("webhook_signature_checks_total", "Webhook signature checks", ("bot", "result"))
+
+
+def _after_fork():
+    """Дочерний процесс ведёт свои метрики с нуля (снимки процессов суммируются)."""
+    for metric in _registry:
+        metric._reset()
+
+
+os.register_at_fork(after_in_child=_after_fork)
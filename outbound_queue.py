@@ -0,0 +1,364 @@
+import atexit
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import config
+import reqv_to_bot as reqv
+import rate_limit
+from rate_limit import RATE_LIMIT_DEFAULT_RETRY_AFTER, parse_retry_after
+
+logger = logging.getLogger(__name__)
+
+# ==================== КОНФИГУРАЦИЯ ====================
+DISPATCH_QUEUE_SIZE = getattr(config, "DISPATCH_QUEUE_SIZE", 1000)  # Макс. заданий в очереди
+DISPATCH_WORKERS = getattr(config, "DISPATCH_WORKERS", 4)  # Потоков-отправителей
+DISPATCH_MAX_RETRIES = getattr(config, "DISPATCH_MAX_RETRIES", 3)  # Повторов при временных ошибках
+DISPATCH_BACKOFF = getattr(config, "DISPATCH_BACKOFF", 0.5)  # Базовая пауза между повторами (сек)
+DISPATCH_DRAIN_TIMEOUT = getattr(config, "DISPATCH_DRAIN_TIMEOUT", 30)  # Ожидание при остановке (сек)
+DISPATCH_BULK_QUEUE_SIZE = getattr(config, "DISPATCH_BULK_QUEUE_SIZE", 10000)  # Макс. заданий рассылок
+
+# Коды ответа MAX API, при которых имеет смысл повторить запрос
+TRANSIENT_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Полосы приоритета: ответы пользователю всегда обслуживаются раньше рассылок
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+_STOP = object()
+
+
+class OutboundJob:
+    """Задание на исходящий вызов Bot API (send/delete/edit)."""
+
+    __slots__ = ("kind", "args", "attempt", "lane", "callback")
+
+    def __init__(self, kind, args, lane=INTERACTIVE, callback=None):
+        self.kind = kind
+        self.args = args
+        self.attempt = 0
+        self.lane = lane
+        # callback(ok, status) - итог задания после всех повторов (status None - сетевая ошибка)
+        self.callback = callback
+
+    @property
+    def token(self):
+        return self.args[-1]
+
+    @property
+    def recipient(self):
+        """Получатель для лимита на пользователя (только у send)."""
+        return self.args[0] if self.kind == "send" else None
+
+
+class LaneQueue:
+    """
+    Очередь с полосами приоритета и отложенными заданиями.
+    Отложенные (ожидание лимита или паузы перед повтором) лежат в куче по времени готовности
+    и не занимают поток-отправитель; готовые возвращаются в начало своей полосы.
+    """
+
+    def __init__(self, maxsizes):
+        self._maxsizes = dict(maxsizes)
+        self._lanes = {lane: deque() for lane in self._maxsizes}
+        self._delayed = []
+        self._seq = itertools.count()
+        self._unfinished = 0
+        self._cond = threading.Condition()
+
+    def put(self, job, block=False, timeout=None):
+        """False, если полоса заполнена (и за timeout место не освободилось)."""
+        lane = self._lanes[job.lane]
+        maxsize = self._maxsizes[job.lane]
+        with self._cond:
+            if block:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while len(lane) >= maxsize:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            elif len(lane) >= maxsize:
+                return False
+            lane.append(job)
+            self._unfinished += 1
+            self._cond.notify_all()
+        return True
+
+    def put_delayed(self, job, ready_at):
+        """Откладывает уже принятое задание до ready_at (time.monotonic)."""
+        with self._cond:
+            heapq.heappush(self._delayed, (ready_at, next(self._seq), job))
+            self._unfinished += 1
+            self._cond.notify_all()
+
+    def put_stop(self):
+        with self._cond:
+            self._lanes[INTERACTIVE].appendleft(_STOP)
+            self._unfinished += 1
+            self._cond.notify_all()
+
+    def get(self):
+        with self._cond:
+            while True:
+                self._release_ready()
+                for lane in self._lanes.values():
+                    if lane:
+                        job = lane.popleft()
+                        self._cond.notify_all()
+                        return job
+                timeout = self._delayed[0][0] - time.monotonic() if self._delayed else None
+                self._cond.wait(timeout)
+
+    def task_done(self):
+        with self._cond:
+            self._unfinished -= 1
+            self._cond.notify_all()
+
+    def join(self, timeout):
+        """Ждёт, пока все задания (включая отложенные) не будут обработаны. True - дождались."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._unfinished:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def qsize(self):
+        with self._cond:
+            return sum(len(lane) for lane in self._lanes.values()) + len(self._delayed)
+
+    def depth(self):
+        with self._cond:
+            depth = {lane: len(jobs) for lane, jobs in self._lanes.items()}
+            depth["delayed"] = len(self._delayed)
+        return depth
+
+    def _release_ready(self):
+        now = time.monotonic()
+        ready = []
+        while self._delayed and self._delayed[0][0] <= now:
+            ready.append(heapq.heappop(self._delayed)[2])
+        # Дождавшиеся задания идут раньше новых в своей полосе, сохраняя порядок между собой
+        for job in reversed(ready):
+            self._lanes[job.lane].appendleft(job)
+
+
+def is_transient(response):
+    """True, если вызов стоит повторить (сетевая ошибка или 429/5xx)."""
+    return response is None or response.status_code in TRANSIENT_STATUS_CODES
+
+
+class OutboundDispatcher:
+    """
+    Ограниченная очередь исходящих вызовов + пул потоков-отправителей.
+    Вебхук только кладёт задание в очередь и сразу отвечает 200.
+    Перед каждым вызовом задание проходит через лимиты rate_limit (токен бота и получатель);
+    не уложившееся в лимит откладывается, а не блокирует поток.
+    """
+
+    def __init__(self, maxsize=DISPATCH_QUEUE_SIZE, workers=DISPATCH_WORKERS,
+                 max_retries=DISPATCH_MAX_RETRIES, backoff=DISPATCH_BACKOFF,
+                 bulk_maxsize=DISPATCH_BULK_QUEUE_SIZE, rate_limiter=None):
+        self._maxsizes = {INTERACTIVE: maxsize, BULK: bulk_maxsize}
+        self._queue = LaneQueue(self._maxsizes)
+        self._limiter = rate_limiter
+        self._workers_count = workers
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._threads = []
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._started = False
+        self._stats = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "retried": 0,
+            "dropped": 0,
+            "throttled": 0,
+            "rate_limited": 0,
+        }
+        self._handlers = {
+            "send": reqv.send_message,
+            "delete": reqv.delete_message,
+            "edit": reqv.edit_message,
+        }
+
+    # ---------- Публичный API ----------
+
+    @property
+    def limiter(self):
+        """Переданный планировщик или общий rate_limit.limiter (в pre-fork режиме его заменяет main.py)."""
+        return self._limiter or rate_limit.limiter
+
+    def start(self):
+        """Запускает потоки-отправители (повторный вызов ничего не делает)."""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            for i in range(self._workers_count):
+                t = threading.Thread(target=self._worker, name=f"outbound-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+        logger.info("Outbound dispatcher started with %s workers", self._workers_count)
+
+    def submit(self, kind, *args, lane=INTERACTIVE, block=False, timeout=None, callback=None):
+        """
+        Кладёт задание в полосу lane. Возвращает False, если полоса переполнена или очередь закрыта.
+        block=True - ждать места в полосе (для рассылок, которым нужно обратное давление).
+        callback(ok, status) вызывается в потоке-отправителе, когда задание завершено.
+        """
+        if self._stopping.is_set():
+            self._count("dropped")
+            logger.warning("Outbound dispatcher is stopping, job %s dropped", kind)
+            return False
+        if not self._started:
+            self.start()
+        if not self._queue.put(OutboundJob(kind, args, lane, callback), block=block, timeout=timeout):
+            self._count("dropped")
+            logger.warning("Outbound %s queue is full (%s), job %s dropped", lane, self._maxsizes[lane], kind)
+            return False
+        self._count("submitted")
+        return True
+
+    def send_message(self, user_id, payload, token, lane=INTERACTIVE, block=False, callback=None):
+        """Асинхронный аналог reqv.send_message."""
+        return self.submit("send", user_id, payload, token, lane=lane, block=block, callback=callback)
+
+    def delete_message(self, message_id, token):
+        """Асинхронный аналог reqv.delete_message."""
+        return self.submit("delete", message_id, token)
+
+    def edit_message(self, message_id, payload, token):
+        """Асинхронный аналог reqv.edit_message."""
+        return self.submit("edit", message_id, payload, token)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self._queue.qsize()
+        stats["lanes"] = self._queue.depth()
+        stats["workers"] = len(self._threads)
+        stats["rate_limits"] = self.limiter.stats()
+        return stats
+
+    def shutdown(self, timeout=DISPATCH_DRAIN_TIMEOUT):
+        """Перестаёт принимать задания, дожидается опустошения очереди и останавливает потоки."""
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        if not self._started:
+            return
+        logger.info("Draining outbound queue (%s jobs left)", self._queue.qsize())
+        deadline = time.monotonic() + timeout
+        if not self._queue.join(timeout):
+            logger.warning("Outbound queue not drained in %ss (%s jobs left)", timeout, self._queue.qsize())
+        for _ in self._threads:
+            self._queue.put_stop()
+        for t in self._threads:
+            t.join(max(0, deadline - time.monotonic()))
+        alive = [t.name for t in self._threads if t.is_alive()]
+        if alive:
+            logger.warning("Outbound workers did not stop in time: %s", alive)
+        else:
+            logger.info("Outbound dispatcher stopped")
+
+    def _after_fork(self):
+        """В дочернем процессе потоков родителя нет: начинаем с чистого состояния."""
+        self._queue = LaneQueue(self._maxsizes)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._started = False
+
+    # ---------- Внутреннее ----------
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._stats[name] += n
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is _STOP:
+                    return
+                self._run(job)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job):
+        wait = self.limiter.acquire(job.token, job.recipient)
+        if wait > 0:
+            self._count("throttled")
+            self._queue.put_delayed(job, time.monotonic() + wait)
+            return
+
+        try:
+            response = self._handlers[job.kind](*job.args)
+        except Exception as e:
+            logger.exception("Outbound %s failed: %s", job.kind, e)
+            response = None
+
+        if not is_transient(response):
+            if response.ok:
+                self._count("completed")
+            else:
+                self._count("failed")
+                logger.warning("Outbound %s rejected: %s", job.kind, response.status_code)
+            self._finish(job, response.ok, response.status_code)
+            return
+
+        retry_after = None
+        if response is not None and response.status_code == 429:
+            # Платформа сама говорит, сколько ждать: на это время притормаживаем весь токен
+            retry_after = parse_retry_after(response.headers.get("Retry-After")) or RATE_LIMIT_DEFAULT_RETRY_AFTER
+            self.limiter.penalize(job.token, retry_after)
+            self._count("rate_limited")
+
+        if job.attempt >= self._max_retries:
+            self._count("failed")
+            logger.error("Outbound %s gave up after %s attempts", job.kind, job.attempt + 1)
+            self._finish(job, False, response.status_code if response is not None else None)
+            return
+
+        delay = retry_after if retry_after is not None else self._backoff * (2 ** job.attempt)
+        job.attempt += 1
+        self._count("retried")
+        logger.info("Outbound %s retry %s in %.1fs", job.kind, job.attempt, delay)
+        self._queue.put_delayed(job, time.monotonic() + delay)
+
+    @staticmethod
+    def _finish(job, ok, status):
+        if job.callback is None:
+            return
+        try:
+            job.callback(ok, status)
+        except Exception as e:
+            logger.exception("Outbound %s callback failed: %s", job.kind, e)
+
+
+dispatcher = OutboundDispatcher()
+atexit.register(dispatcher.shutdown)
+os.register_at_fork(after_in_child=dispatcher._after_fork)
+
+
+def install(new_dispatcher):
+    """
+    Подменяет активный диспетчер (например, асинхронным в ASGI-режиме).
+    Обработчики обращаются к outbound_queue.dispatcher при каждом вызове.
+    """
+    global dispatcher
+    previous, dispatcher = dispatcher, new_dispatcher
+    return previous
@@ -0,0 +1,275 @@
+import json
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+import app_logging
+import config
+import event_journal
+
+logger = logging.getLogger(__name__)
+
+# ==================== КОНФИГУРАЦИЯ ====================
+PREFORK_WORKERS = getattr(config, "PREFORK_WORKERS", os.cpu_count() or 2)  # Процессов-обработчиков
+# True - у каждого процесса свой сокет с SO_REUSEPORT (ядро само распределяет соединения),
+# False - один сокет мастера, унаследованный всеми процессами
+PREFORK_REUSEPORT = getattr(config, "PREFORK_REUSEPORT", hasattr(socket, "SO_REUSEPORT"))
+PREFORK_BACKLOG = getattr(config, "PREFORK_BACKLOG", 1024)
+PREFORK_STATE_DIR = getattr(config, "PREFORK_STATE_DIR", os.path.join("run", "workers"))
+PREFORK_REPORT_INTERVAL = getattr(config, "PREFORK_REPORT_INTERVAL", 2.0)  # Публикация health (сек)
+PREFORK_GRACEFUL_TIMEOUT = getattr(config, "PREFORK_GRACEFUL_TIMEOUT", 30)  # Ожидание остановки (сек)
+PREFORK_MIN_UPTIME = getattr(config, "PREFORK_MIN_UPTIME", 5)  # Быстрее упал - перезапуск с паузой
+PREFORK_MAX_RESTART_DELAY = getattr(config, "PREFORK_MAX_RESTART_DELAY", 30)
+
+# Номер процесса-обработчика; None - процесс запущен не через run_prefork
+worker_id = None
+
+
+def listen_socket(host, port, reuseport):
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(PREFORK_BACKLOG)
+    return sock
+
+
+def _state_path(name):
+    return os.path.join(PREFORK_STATE_DIR, f"{name}.json")
+
+
+def _write_state(name, state):
+    """Атомарно публикует состояние процесса (tmp + rename)."""
+    path = _state_path(name)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, default=str)
+    os.replace(tmp, path)
+
+
+def _read_state(name):
+    try:
+        with open(_state_path(name), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def cluster_status():
+    """
+    Сводное состояние всех процессов для /health или None вне pre-fork режима.
+    Каждый процесс раз в PREFORK_REPORT_INTERVAL публикует свой health в PREFORK_STATE_DIR.
+    """
+    if worker_id is None:
+        return None
+    master = _read_state("master") or {}
+    workers = {}
+    now = time.time()
+    for n, pid in sorted((master.get("workers") or {}).items(), key=lambda item: int(item[0])):
+        state = _read_state(f"worker-{n}") or {}
+        age = now - state.get("reported_at", 0)
+        workers[n] = {
+            "pid": pid,
+            "alive": state.get("pid") == pid and age < PREFORK_REPORT_INTERVAL * 3,
+            "report_age": round(age, 1),
+            "health": state.get("health"),
+        }
+    return {
+        "master_pid": master.get("pid"),
+        "restarts": master.get("restarts", 0),
+        "this_worker": worker_id,
+        "workers": workers,
+    }
+
+
+def cluster_metrics():
+    """
+    Снимки метрик остальных живых процессов-обработчиков (metrics.snapshot()) или None вне
+    pre-fork режима. Свои метрики вызывающий берёт напрямую; чужие отстают не больше чем на
+    PREFORK_REPORT_INTERVAL.
+    """
+    if worker_id is None:
+        return None
+    master = _read_state("master") or {}
+    snapshots = []
+    now = time.time()
+    for n, pid in (master.get("workers") or {}).items():
+        if int(n) == worker_id:
+            continue
+        state = _read_state(f"worker-{n}") or {}
+        if state.get("pid") == pid and now - state.get("reported_at", 0) < PREFORK_REPORT_INTERVAL * 3:
+            snapshots.append(state.get("metrics") or {})
+    return snapshots
+
+
+def _exit_on_sigterm(signum, frame):
+    raise SystemExit(0)
+
+
+class PreforkMaster:
+    """
+    Мастер-процесс: создаёт сокет(ы), запускает N процессов-обработчиков,
+    перезапускает упавшие (с нарастающей паузой при частых падениях) и останавливает их по SIGTERM/SIGINT.
+    """
+
+    def __init__(self, serve, host, port, workers=PREFORK_WORKERS, reuseport=PREFORK_REUSEPORT, status=None,
+                 metrics=None):
+        self._serve = serve
+        self._host = host
+        self._port = port
+        self._workers = workers
+        self._reuseport = reuseport
+        self._status = status
+        self._metrics = metrics
+        self._children = {}  # pid -> (номер, время запуска)
+        self._restart_delay = {}
+        self._pending = {}  # номер -> когда перезапустить
+        self._restarts = 0
+        self._stopping = False
+        self._sock = None
+
+    def run(self):
+        os.makedirs(PREFORK_STATE_DIR, exist_ok=True)
+        if not self._reuseport:
+            self._sock = listen_socket(self._host, self._port, reuseport=False)
+        logger.info("Pre-fork master %s starting %s workers on %s:%s (%s)", os.getpid(), self._workers,
+                    self._host, self._port, "SO_REUSEPORT" if self._reuseport else "shared socket")
+
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        for n in range(self._workers):
+            self._spawn(n)
+
+        while not self._stopping:
+            self._reap()
+            now = time.monotonic()
+            for n, restart_at in list(self._pending.items()):
+                if restart_at <= now:
+                    del self._pending[n]
+                    self._restarts += 1
+                    self._spawn(n)
+            self._publish()
+            time.sleep(0.5)
+
+        self._stop_children()
+
+    # ---------- Внутреннее ----------
+
+    def _on_stop(self, signum, frame):
+        logger.info("Pre-fork master got signal %s, stopping workers", signum)
+        self._stopping = True
+
+    def _spawn(self, n):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = self._worker_main(n)
+            except SystemExit:
+                code = 0
+            except BaseException:
+                logger.exception("Worker %s crashed", n)
+            finally:
+                os._exit(code)
+        self._children[pid] = (n, time.monotonic())
+        logger.info("Started worker %s (pid %s)", n, pid)
+        self._publish()
+
+    def _worker_main(self, n):
+        global worker_id
+        worker_id = n
+        # Процессы не должны писать в один и тот же сегмент журнала и файл логов
+        event_journal.set_worker_tag(f"w{n}")
+        app_logging.set_worker_tag(f"w{n}")
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        # SystemExit раскручивает serve(), чтобы отработали finally-блоки (досылка очереди, сброс журналов)
+        signal.signal(signal.SIGTERM, _exit_on_sigterm)
+
+        sock = listen_socket(self._host, self._port, reuseport=True) if self._reuseport else self._sock
+        if self._status is not None or self._metrics is not None:
+            threading.Thread(target=self._report, args=(n,), name="prefork-report", daemon=True).start()
+        self._serve(sock)
+        return 0
+
+    def _report(self, n):
+        while True:
+            try:
+                _write_state(f"worker-{n}", {
+                    "pid": os.getpid(),
+                    "reported_at": time.time(),
+                    "health": self._status() if self._status is not None else None,
+                    "metrics": self._metrics() if self._metrics is not None else None,
+                })
+            except Exception as e:
+                logger.error("Worker %s failed to publish health: %s", n, e)
+            time.sleep(PREFORK_REPORT_INTERVAL)
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            n, started = self._children.pop(pid, (None, None))
+            if n is None or self._stopping:
+                continue
+            uptime = time.monotonic() - started
+            logger.error("Worker %s (pid %s) exited with status %s after %.1fs", n, pid, status, uptime)
+            # Частые падения - увеличиваем паузу перед перезапуском, стабильная работа её сбрасывает
+            if uptime < PREFORK_MIN_UPTIME:
+                delay = min(PREFORK_MAX_RESTART_DELAY, self._restart_delay.get(n, 0.5) * 2)
+            else:
+                delay = 0
+            self._restart_delay[n] = delay or 0.5
+            if delay:
+                logger.warning("Worker %s is crash-looping, restarting in %.1fs", n, delay)
+            self._pending[n] = time.monotonic() + delay
+
+    def _publish(self):
+        try:
+            _write_state("master", {
+                "pid": os.getpid(),
+                "restarts": self._restarts,
+                "workers": {str(n): pid for pid, (n, _) in self._children.items()},
+            })
+        except OSError as e:
+            logger.error("Failed to publish master state: %s", e)
+
+    def _stop_children(self):
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + PREFORK_GRACEFUL_TIMEOUT
+        while self._children and time.monotonic() < deadline:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid:
+                self._children.pop(pid, None)
+            else:
+                time.sleep(0.1)
+        for pid in list(self._children):
+            logger.warning("Worker pid %s did not stop in time, killing", pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        logger.info("Pre-fork master stopped")
+
+
+def run_prefork(serve, host, port, workers=PREFORK_WORKERS, status=None, metrics=None):
+    """
+    Запускает pre-fork кластер. serve(sock) обслуживает запросы на переданном сокете
+    в процессе-обработчике, status() - локальный health процесса для сводного /health,
+    metrics() - снимок метрик процесса для сводного /metrics.
+    """
+    PreforkMaster(serve, host, port, workers=workers, status=status, metrics=metrics).run()
@@ -0,0 +1,135 @@
+"""
+Статистический профайлер потоков по запросу.
+
+Пока профилирование не запрошено, не работает ничего: ни потока, ни хуков sys.setprofile.
+По запросу поток-сэмплер раз в PROFILER_INTERVAL снимает стеки всех потоков
+(sys._current_frames) и считает одинаковые стеки. Результат - collapsed stacks
+("поток;модуль.функция;... число"), формат flamegraph.pl и speedscope.
+
+Запуск:
+    curl -H "X-Admin-Token: ..." "http://127.0.0.1:8080/admin/profile?seconds=10&threads=waitress" > out.folded
+    kill -USR2 <pid>   # профиль на PROFILER_SIGNAL_SECONDS сек в PROFILER_DIR
+"""
+import hmac
+import logging
+import math
+import os
+import re
+import signal
+import sys
+import threading
+import time
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# ==================== КОНФИГУРАЦИЯ ====================
+PROFILER_TOKEN = getattr(config, "PROFILER_TOKEN", None)  # Токен /admin/profile; None - эндпоинт выключен
+PROFILER_INTERVAL = getattr(config, "PROFILER_INTERVAL", 0.005)  # Период снятия стеков (сек)
+PROFILER_MAX_INTERVAL = getattr(config, "PROFILER_MAX_INTERVAL", 1.0)
+PROFILER_DEFAULT_SECONDS = getattr(config, "PROFILER_DEFAULT_SECONDS", 10)
+PROFILER_MAX_SECONDS = getattr(config, "PROFILER_MAX_SECONDS", 120)
+PROFILER_MAX_DEPTH = getattr(config, "PROFILER_MAX_DEPTH", 100)  # Кадров стека (от вершины)
+PROFILER_SIGNAL = getattr(config, "PROFILER_SIGNAL", "SIGUSR2")  # None - без сигнала
+PROFILER_SIGNAL_SECONDS = getattr(config, "PROFILER_SIGNAL_SECONDS", 30)
+PROFILER_DIR = getattr(config, "PROFILER_DIR", os.path.join("data", "profiles"))
+
+# Номер в конце имени потока (waitress-3, poll-invest остаётся как есть) - потоки пула сливаются в один корень
+_THREAD_NUMBER_RE = re.compile(r"[-_]\d+$")
+
+# Одновременно - только один профиль
+_busy = threading.Lock()
+
+
+def authorized(token):
+    """Доступ к /admin/profile: PROFILER_TOKEN задан и совпадает."""
+    return bool(PROFILER_TOKEN) and bool(token) and hmac.compare_digest(str(token), str(PROFILER_TOKEN))
+
+
+def parse_params(seconds=PROFILER_DEFAULT_SECONDS, interval=PROFILER_INTERVAL):
+    """
+    Длительность и период профиля (из запроса - строки) -> числа в допустимых пределах.
+    ValueError для нечисел, inf и nan: inf прошёл бы max() и уронил бы time.sleep.
+    """
+    seconds, interval = float(seconds), float(interval)
+    if not (math.isfinite(seconds) and math.isfinite(interval)):
+        raise ValueError("seconds and interval must be finite")
+    return min(max(seconds, 0.0), PROFILER_MAX_SECONDS), min(max(interval, 0.001), PROFILER_MAX_INTERVAL)
+
+
+def _frame_name(code):
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    name = getattr(code, "co_qualname", code.co_name)
+    # ';' разделяет кадры, пробел отделяет число - в именах их быть не должно
+    return f"{module}.{name}".replace(";", ":").replace(" ", "_")
+
+
+def _stack(frame):
+    names = []
+    while frame is not None and len(names) < PROFILER_MAX_DEPTH:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+
+def profile(seconds=PROFILER_DEFAULT_SECONDS, interval=PROFILER_INTERVAL, threads=None):
+    """
+    Снимает стеки потоков в течение seconds (в вызывающем потоке, он сам в выборку не попадает).
+    threads - подстрока имени потока (например, "waitress"). Возвращает (collapsed-текст,
+    число выборок) или None, если уже идёт другой профиль.
+    """
+    seconds, interval = parse_params(seconds, interval)
+    if not _busy.acquire(blocking=False):
+        return None
+    try:
+        own = threading.get_ident()
+        stacks = {}
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                name = names.get(ident, f"thread-{ident}")
+                if threads and threads not in name:
+                    continue
+                key = ";".join([_THREAD_NUMBER_RE.sub("", name).replace(" ", "_")] + _stack(frame))
+                stacks[key] = stacks.get(key, 0) + 1
+            samples += 1
+            time.sleep(interval)
+    finally:
+        _busy.release()
+    text = "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+    return text, samples
+
+
+def profile_to_file(seconds=PROFILER_SIGNAL_SECONDS, directory=PROFILER_DIR):
+    """Профиль в файл PROFILER_DIR/profile-<pid>-<время>.folded; возвращает путь."""
+    result = profile(seconds)
+    if result is None:
+        logger.warning("Profiler is already running, request ignored")
+        return None
+    text, samples = result
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    logger.info("Profile of %s samples written to %s", samples, path)
+    return path
+
+
+def _on_signal(signum, frame):
+    # Обработчик сигнала должен вернуться сразу - профиль снимает отдельный поток
+    threading.Thread(target=profile_to_file, name="profiler", daemon=True).start()
+
+
+def install_signal_handler(name=PROFILER_SIGNAL):
+    """Профиль по сигналу (kill -USR2 <pid>). Вызывается из главного потока процесса."""
+    signum = getattr(signal, name, None) if name else None
+    if signum is None:
+        return False
+    signal.signal(signum, _on_signal)
+    return True
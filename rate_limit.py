@@ -0,0 +1,311 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+import config
+from bot_registry import mask_token
+
+logger = logging.getLogger(__name__)
+
+# ==================== КОНФИГУРАЦИЯ ====================
+RATE_LIMIT_PER_TOKEN = getattr(config, "RATE_LIMIT_PER_TOKEN", 30.0)  # Запросов в секунду на токен бота
+RATE_LIMIT_TOKEN_BURST = getattr(config, "RATE_LIMIT_TOKEN_BURST", 30)  # Допустимый всплеск
+RATE_LIMIT_PER_USER = getattr(config, "RATE_LIMIT_PER_USER", 1.0)  # Сообщений в секунду одному пользователю
+RATE_LIMIT_USER_BURST = getattr(config, "RATE_LIMIT_USER_BURST", 3)
+RATE_LIMIT_USER_BUCKETS = getattr(config, "RATE_LIMIT_USER_BUCKETS", 100000)  # Макс. корзин пользователей в памяти
+RATE_LIMIT_DEFAULT_RETRY_AFTER = getattr(config, "RATE_LIMIT_DEFAULT_RETRY_AFTER", 1.0)  # 429 без Retry-After (сек)
+# "memory" - корзины в памяти процесса (один процесс waitress/ASGI - без обращений к диску);
+# "sqlite" - общие для всех процессов на хосте. Pre-fork режим (main.py) и broadcast.py включают его сами
+RATE_LIMIT_BACKEND = getattr(config, "RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_DB_PATH = getattr(config, "RATE_LIMIT_DB_PATH", os.path.join("data", "rate_limit.db"))
+RATE_LIMIT_PURGE_EVERY = getattr(config, "RATE_LIMIT_PURGE_EVERY", 1000)  # Чистить восстановившиеся корзины раз в N
+
+
+class TokenBucket:
+    """Корзина токенов: rate пополнений в секунду, не больше burst."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+        self.blocked_until = 0.0
+
+    def wait_time(self, now):
+        """Сколько ждать до следующего разрешения (0 - можно сейчас). Корзину не расходует."""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def consume(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - 1
+        self.updated = now
+
+
+def parse_retry_after(value):
+    """Retry-After в секундах (число или HTTP-дата) или None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    """
+    Планировщик исходящих вызовов: корзина на каждый токен бота и на каждого получателя.
+    acquire() либо сразу расходует разрешение, либо говорит, сколько подождать -
+    вызывающий откладывает задание, не занимая поток.
+    Корзины в памяти процесса.
+    """
+
+    shared = False
+
+    def __init__(self, token_rate=RATE_LIMIT_PER_TOKEN, token_burst=RATE_LIMIT_TOKEN_BURST,
+                 user_rate=RATE_LIMIT_PER_USER, user_burst=RATE_LIMIT_USER_BURST,
+                 max_user_buckets=RATE_LIMIT_USER_BUCKETS):
+        self._token_rate = token_rate
+        self._token_burst = token_burst
+        self._user_rate = user_rate
+        self._user_burst = user_burst
+        self._max_user_buckets = max_user_buckets
+        self._tokens = {}
+        self._users = OrderedDict()
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, token, user_id=None):
+        """0 - вызов разрешён (разрешения списаны), иначе - через сколько секунд повторить."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._tokens.get(token)
+            if bucket is None:
+                bucket = self._tokens[token] = TokenBucket(self._token_rate, self._token_burst, now)
+            user_bucket = self._user_bucket((token, user_id), now) if user_id is not None else None
+
+            wait = bucket.wait_time(now)
+            if user_bucket is not None:
+                wait = max(wait, user_bucket.wait_time(now))
+            metrics = self._token_metrics(token)
+            if wait > 0:
+                metrics["throttled"] += 1
+                metrics["wait_seconds"] += wait
+                return wait
+            bucket.consume(now)
+            if user_bucket is not None:
+                user_bucket.consume(now)
+            metrics["allowed"] += 1
+            return 0.0
+
+    def penalize(self, token, retry_after):
+        """Ответ 429: не отправляем с этого токена, пока не истечёт Retry-After."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._tokens.get(token)
+            if bucket is None:
+                bucket = self._tokens[token] = TokenBucket(self._token_rate, self._token_burst, now)
+            bucket.blocked_until = max(bucket.blocked_until, now + retry_after)
+            bucket.tokens = 0
+            self._token_metrics(token)["http_429"] += 1
+
+    def stats(self):
+        with self._lock:
+            result = {mask_token(token): dict(m, wait_seconds=round(m["wait_seconds"], 3))
+                      for token, m in self._metrics.items()}
+            users = len(self._users)
+        return {"tokens": result, "user_buckets": users}
+
+    def _user_bucket(self, key, now):
+        bucket = self._users.get(key)
+        if bucket is None:
+            bucket = self._users[key] = TokenBucket(self._user_rate, self._user_burst, now)
+            # Вытесняем самые давно использованные корзины (у них токены уже восстановились)
+            while len(self._users) > self._max_user_buckets:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(key)
+        return bucket
+
+    def _token_metrics(self, token):
+        metrics = self._metrics.get(token)
+        if metrics is None:
+            metrics = self._metrics[token] = {"allowed": 0, "throttled": 0, "wait_seconds": 0.0, "http_429": 0}
+        return metrics
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+
+class SqliteRateLimiter(RateLimiter):
+    """
+    Те же корзины в SQLite (WAL) - общие для всех процессов на хосте: pre-fork воркеры
+    и broadcast.py вместе укладываются в лимит токена и получателя.
+    acquire() - одна транзакция BEGIN IMMEDIATE: прочитать корзины, списать, записать.
+    Токен бота в базе не хранится - только его хэш. Счётчики stats() по-прежнему свои у процесса.
+    """
+
+    shared = True
+
+    def __init__(self, path=RATE_LIMIT_DB_PATH, purge_every=RATE_LIMIT_PURGE_EVERY, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self._purge_every = purge_every
+        self._acquires = 0
+        self._local = threading.local()
+
+    def _conn(self):
+        """Своё соединение на каждый поток; база создаётся при первом вызове, а не при импорте."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, "
+                "updated REAL NOT NULL, blocked_until REAL NOT NULL) WITHOUT ROWID"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS buckets_updated ON buckets (updated)")
+            self._local.conn = conn
+        return conn
+
+    def acquire(self, token, user_id=None):
+        # Время стены, а не monotonic: корзины читают разные процессы
+        now = time.time()
+        token_key = _token_key(token)
+        keys = [token_key] if user_id is None else [token_key, f"{token_key}:{user_id}"]
+        try:
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                buckets = self._load(conn, keys, now)
+                wait = max(bucket.wait_time(now) for bucket in buckets)
+                if wait == 0:
+                    for bucket in buckets:
+                        bucket.consume(now)
+                    self._store(conn, keys, buckets)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            # Общие корзины недоступны - ограничиваем хотя бы свой процесс
+            logger.error("Rate limit store error, using in-process buckets: %s", e)
+            return super().acquire(token, user_id)
+        purge = False
+        with self._lock:
+            metrics = self._token_metrics(token)
+            if wait > 0:
+                metrics["throttled"] += 1
+                metrics["wait_seconds"] += wait
+            else:
+                metrics["allowed"] += 1
+                self._acquires += 1
+                purge = self._acquires % self._purge_every == 0
+        if purge:
+            self.purge(now)
+        return wait
+
+    def penalize(self, token, retry_after):
+        now = time.time()
+        key = _token_key(token)
+        try:
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                bucket, = self._load(conn, [key], now)
+                bucket.blocked_until = max(bucket.blocked_until, now + retry_after)
+                bucket.tokens = 0
+                self._store(conn, [key], [bucket])
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            logger.error("Rate limit store error, penalizing in-process bucket: %s", e)
+            super().penalize(token, retry_after)
+            return
+        with self._lock:
+            self._token_metrics(token)["http_429"] += 1
+
+    def purge(self, now=None):
+        """Удаляет корзины получателей, не тронутые дольше, чем нужно на полное восстановление."""
+        now = time.time() if now is None else now
+        idle = self._user_burst / self._user_rate if self._user_rate else 0
+        try:
+            self._conn().execute("DELETE FROM buckets WHERE updated < ? AND blocked_until < ? AND key LIKE '%:%'",
+                                 (now - idle, now))
+        except sqlite3.Error as e:
+            logger.error("Rate limit purge error: %s", e)
+
+    def stats(self):
+        stats = super().stats()
+        stats["backend"] = "sqlite"
+        stats["path"] = self.path
+        return stats
+
+    def _load(self, conn, keys, now):
+        rows = {key: (tokens, updated, blocked_until) for key, tokens, updated, blocked_until in conn.execute(
+            f"SELECT key, tokens, updated, blocked_until FROM buckets WHERE key IN ({','.join('?' * len(keys))})",
+            keys)}
+        buckets = []
+        for i, key in enumerate(keys):
+            bucket = (TokenBucket(self._token_rate, self._token_burst, now) if i == 0
+                      else TokenBucket(self._user_rate, self._user_burst, now))
+            if key in rows:
+                bucket.tokens, bucket.updated, bucket.blocked_until = rows[key]
+            buckets.append(bucket)
+        return buckets
+
+    @staticmethod
+    def _store(conn, keys, buckets):
+        conn.executemany(
+            "INSERT INTO buckets (key, tokens, updated, blocked_until) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated, "
+            "blocked_until = excluded.blocked_until",
+            [(key, bucket.tokens, bucket.updated, bucket.blocked_until) for key, bucket in zip(keys, buckets)],
+        )
+
+    def _after_fork(self):
+        """Соединение SQLite нельзя использовать после fork - открываем свои."""
+        super()._after_fork()
+        self._local = threading.local()
+
+
+def _token_key(token):
+    return hashlib.sha256(str(token).encode("utf-8")).hexdigest()[:32]
+
+
+def create_limiter(backend=RATE_LIMIT_BACKEND):
+    """Планировщик лимитов выбранного в config бэкенда."""
+    if backend == "memory":
+        return RateLimiter()
+    if backend == "sqlite":
+        return SqliteRateLimiter()
+    raise ValueError(f"Unknown RATE_LIMIT_BACKEND: {backend}")
+
+
+limiter = create_limiter()
+
+
+def _after_fork():
+    # limiter может быть заменён после импорта (run_prefork_production) - берём текущий
+    limiter._after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,236 @@
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import config
+import callback_router
+import event_journal
+import journal_index
+import outbound_queue
+import update_handlers
+from bot_registry import BOTS, BOTS_BY_NAME
+from conversation_state import (CONVERSATION_STATE_PERSIST, CONVERSATION_STATE_TTL, ConversationStore,
+                                SqliteStateStore)
+from idempotency import IdempotencyCache
+from subscribers import SubscriberRegistry, registry as live_subscribers
+
+logger = logging.getLogger(__name__)
+
+# ==================== КОНФИГУРАЦИЯ ====================
+# Логи старого формата сливаются потоково, пока файлов не больше этого, иначе сортируются в памяти
+REPLAY_MAX_OPEN_FILES = getattr(config, "REPLAY_MAX_OPEN_FILES", 256)
+
+
+class StubDispatcher:
+    """Заглушка вместо OutboundDispatcher: считает исходящие вызовы, в сеть ничего не уходит."""
+
+    def __init__(self):
+        self.calls = {}
+
+    def submit(self, kind, *args, lane=outbound_queue.INTERACTIVE, block=False, timeout=None, callback=None):
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        if callback is not None:
+            callback(True, 200)
+        return True
+
+    def send_message(self, user_id, payload, token, lane=outbound_queue.INTERACTIVE, block=False, callback=None):
+        return self.submit("send", user_id, payload, token, lane=lane, callback=callback)
+
+    def delete_message(self, message_id, token):
+        return self.submit("delete", message_id, token)
+
+    def edit_message(self, message_id, payload, token):
+        return self.submit("edit", message_id, payload, token)
+
+    def stats(self):
+        return {"mode": "stub", "calls": dict(self.calls)}
+
+    def shutdown(self, timeout=None):
+        pass
+
+
+def _bot_sources(bot):
+    """Хронологически упорядоченные потоки записей бота: по одному на процесс-писатель журнала + старые логи."""
+    sources = [event_journal.iter_records(bot.log_dir, tag=tag) for tag in event_journal.journal_tags(bot.log_dir)]
+    legacy = event_journal.legacy_log_files(bot.log_dir)
+    if len(legacy) <= REPLAY_MAX_OPEN_FILES:
+        # Каждый файл дописывался по порядку - достаточно слияния
+        sources.extend(event_journal.iter_legacy_file(path) for path in legacy)
+    elif legacy:
+        records = [record for path in legacy for record in event_journal.iter_legacy_file(path)]
+        records.sort(key=lambda record: record["ts"])
+        sources.append(iter(records))
+    return sources
+
+
+def _keyed(source, bot, counter):
+    # Номер из общего счётчика разводит записи с одинаковым ts, чтобы merge не сравнивал ботов
+    for record in source:
+        yield record.get("ts") or 0, next(counter), bot, record.get("data")
+
+
+def replay_stream(bots):
+    """(ts, бот, update) всех ботов в хронологическом порядке (слияние k потоков, O(k) памяти)."""
+    counter = itertools.count()
+    streams = [_keyed(source, bot, counter) for bot in bots for source in _bot_sources(bot)]
+    for ts, _, bot, data in heapq.merge(*streams):
+        if isinstance(data, dict):
+            yield ts, bot, data
+
+
+class Replay:
+    """
+    Прогоняет сохранённые update через обработчики вебхука (update_handlers.handle_update)
+    с заглушкой исходящих вызовов и без повторной записи в журнал.
+    rebuild=True пересобирает производное состояние ботов bots: реестр подписчиков, состояния диалогов
+    (на диске, если CONVERSATION_STATE_PERSIST) и индексы журналов. Иначе состояние строится
+    во временных объектах, боевые данные не трогаются (нагрузочный прогон).
+    """
+
+    def __init__(self, bots, speed=None, rebuild=False):
+        self.bots = bots
+        self.speed = speed  # None - как можно быстрее, 1.0 - в записанном темпе, 10 - в 10 раз быстрее
+        self.rebuild = rebuild
+        self.stub = StubDispatcher()
+        self._scratch = None  # Временный каталог состояния, если прогон не пересобирает живое
+        self.stats = {"events": 0, "duplicates": 0, "errors": 0, "by_type": {}, "max_lag": 0.0}
+
+    def run(self):
+        subscribers, conversations = self._prepare_state()
+        try:
+            return self._run(subscribers, conversations)
+        finally:
+            # Дописать лог подписчиков и закрыть его, затем удалить временное состояние
+            subscribers.close()
+            if self._scratch is not None:
+                self._scratch.cleanup()
+                self._scratch = None
+
+    def _run(self, subscribers, conversations):
+        last_seen = {}
+        saved = self._install(subscribers, conversations)
+        started = time.monotonic()
+        first_ts = None
+        try:
+            for ts, bot, data in replay_stream(self.bots):
+                if self.speed and ts:
+                    first_ts = first_ts if first_ts is not None else ts
+                    lag = time.monotonic() - started - (ts - first_ts) / self.speed
+                    if lag < 0:
+                        time.sleep(-lag)
+                    else:
+                        self.stats["max_lag"] = max(self.stats["max_lag"], lag)
+                self._process(bot, data)
+                user_id = update_handlers.UpdateContext(bot, data).user_id
+                if user_id is not None:
+                    last_seen[(bot.name, user_id)] = ts
+        finally:
+            self._restore(saved)
+        elapsed = time.monotonic() - started
+
+        # Диалоги, в которых не было событий дольше TTL, к моменту сбоя уже истекли бы
+        horizon = time.time() - CONVERSATION_STATE_TTL
+        for (bot_name, user_id), ts in last_seen.items():
+            if ts and ts < horizon:
+                conversations.clear(bot_name, user_id)
+        conversations.flush()
+
+        if self.rebuild:
+            for bot in self.bots:
+                journal_index.build_index(bot.log_dir)
+
+        report = dict(self.stats)
+        report["elapsed"] = round(elapsed, 3)
+        report["per_second"] = round(report["events"] / elapsed, 1) if elapsed > 0 else 0.0
+        report["max_lag"] = round(report["max_lag"], 3)
+        report["outbound"] = dict(self.stub.calls)
+        report["subscribers"] = {bot.name: subscribers.count(bot.name) for bot in self.bots}
+        report["conversations"] = len(conversations)
+        return report
+
+    # ---------- Внутреннее ----------
+
+    def _prepare_state(self):
+        if self.rebuild:
+            # Пересобираются только выбранные боты, состояние остальных остаётся как есть
+            names = [bot.name for bot in self.bots]
+            live_subscribers.reset(bots=names)
+            store = SqliteStateStore() if CONVERSATION_STATE_PERSIST else None
+            conversations = ConversationStore(store=store)
+            conversations.reset(bots=names)
+            return live_subscribers, conversations
+        self._scratch = tempfile.TemporaryDirectory(prefix="replay-")
+        return SubscriberRegistry(os.path.join(self._scratch.name, "subscribers")), ConversationStore()
+
+    def _install(self, subscribers, conversations):
+        """Подменяет зависимости обработчиков на время прогона; возвращает прежние."""
+        saved = {
+            "dispatcher": outbound_queue.install(self.stub),
+            "subscribers": update_handlers.subscribers,
+            "conversations": update_handlers.conversations,
+            "processed_updates": update_handlers.processed_updates,
+            "save_message_to_log": update_handlers.save_message_to_log,
+        }
+        update_handlers.subscribers = subscribers
+        update_handlers.conversations = callback_router.conversations = conversations
+        # Дубли отсекаем своим кэшем: боевой (в том числе общий SQLite) отбросил бы всё как уже виденное
+        update_handlers.processed_updates = IdempotencyCache(ttl=float("inf"))
+        # События и так лежат в журнале - повторно не пишем
+        update_handlers.save_message_to_log = lambda filename, data, dir: None
+        return saved
+
+    @staticmethod
+    def _restore(saved):
+        outbound_queue.install(saved["dispatcher"])
+        update_handlers.subscribers = saved["subscribers"]
+        update_handlers.conversations = callback_router.conversations = saved["conversations"]
+        update_handlers.processed_updates = saved["processed_updates"]
+        update_handlers.save_message_to_log = saved["save_message_to_log"]
+
+    def _process(self, bot, data):
+        update_type = data.get("update_type")
+        try:
+            result = update_handlers.process_update(bot, data)
+        except Exception as e:
+            result = update_handlers.FAILED
+            logger.exception("Replay of %s for %s failed: %s", update_type, bot.name, e)
+        if result is update_handlers.DUPLICATE:
+            self.stats["duplicates"] += 1
+            return
+        if result is update_handlers.FAILED:
+            # Трассировку обработчика process_update уже записал в лог
+            self.stats["errors"] += 1
+            return
+        self.stats["events"] += 1
+        self.stats["by_type"][update_type] = self.stats["by_type"].get(update_type, 0) + 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Повторный прогон сохранённых update через обработчики")
+    parser.add_argument("--bot", action="append", choices=sorted(BOTS_BY_NAME),
+                        help="Только этот бот (можно несколько раз); по умолчанию - все")
+    parser.add_argument("--speed", type=float,
+                        help="Темп относительно записанного (1 - как было, 10 - в 10 раз быстрее); "
+                             "без параметра - как можно быстрее")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Пересобрать подписчиков, состояния диалогов и индексы (сервер должен быть остановлен)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    # Строка на каждый update не нужна - только итоговый отчёт
+    logging.getLogger("update_handlers").setLevel(logging.WARNING)
+    logging.getLogger("callback_router").setLevel(logging.WARNING)
+    bots = [BOTS_BY_NAME[name] for name in args.bot] if args.bot else BOTS
+    report = Replay(bots, speed=args.speed, rebuild=args.rebuild).run()
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0 if report["errors"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
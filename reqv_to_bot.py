@@ -2,61 +2,96 @@ import config
 import os
 import json
 import requests
+import time
+import metrics
+from bot_registry import BOTS_BY_TOKEN
+from max_client import client
+from template_cache import templates
 
 def load_payload(filepath: str) -> dict:
-    """Загружает JSON-файл с полезной нагрузкой."""
-    try:
-        with open(filepath, "r", encoding="utf-8") as f:
-            payload =  json.load(f)
-
-    except FileNotFoundError:
-        print(f"❌ Файл {filepath} не найден!")
-    except json.JSONDecodeError as e:
-        print(f"❌ Ошибка парсинга JSON: {e}")
+    """Возвращает JSON-файл с полезной нагрузкой из кэша шаблонов (без чтения диска на каждый вызов)."""
+    payload = templates.get_json(filepath)
+    if payload is None:
+        print(f"❌ Файл {filepath} не найден или не разобран!")
     return payload
 
 
 
-def send_message(user_id: str, payload: dict, token: str) -> requests.Response:
-    """Отправляет сообщение в бота."""
+def observe_call(method, token, started, status):
+    """Задержка и статус вызова API в метриках (бот - по токену, status None - сетевая ошибка)."""
+    bot = BOTS_BY_TOKEN.get(token)
+    name = bot.name if bot is not None else "unknown"
+    metrics.outbound_seconds.observe(time.perf_counter() - started, name, method)
+    metrics.outbound_requests.inc(name, method, str(status) if status is not None else "error")
+
+
+def _body(payload):
+    """Аргументы тела запроса: готовые байты уходят как есть, dict сериализует requests."""
+    if isinstance(payload, (bytes, bytearray)):
+        return {"data": payload}
+    return {"json": payload}
+
+
+def send_message(user_id: str, payload, token: str) -> requests.Response:
+    """
+    Отправляет сообщение в бота. payload - dict или уже сериализованный JSON (bytes).
+    При сетевой ошибке возвращает None.
+    """
     url = f"{config.API_BASE_URL}messages?user_id={user_id}"
-    headers = {
-        "Authorization": token,
-        "Content-Type": "application/json"
-    }
+    started = time.perf_counter()
     try:
-        request = requests.post(
+        # Сессия токена держит соединение открытым (Authorization и Content-Type уже в заголовках)
+        request = client.request(
+            "POST",
             url,
-            json=payload,  # requests сам сериализует dict в JSON
-            headers=headers,
-            timeout=15
+            token,
+            timeout=15,
+            **_body(payload)
         )
     except requests.exceptions.RequestException as e:
         print(f"❌ Сетевая ошибка: {e}")
+        observe_call("send", token, started, None)
+        return None
+    observe_call("send", token, started, request.status_code)
     return request
 
 
 def delete_message(message_id, token):
-    """Удаление через HTTP DELETE метод."""
+    """Удаление через HTTP DELETE метод. При сетевой ошибке возвращает None."""
 
     url = f"{config.API_BASE_URL}messages?message_id={message_id}"
+    started = time.perf_counter()
 
-    headers = {
-        "Authorization": token,
-        "Content-Type": "application/json"
-    }
+    try:
+        response = client.request("DELETE", url, token, timeout=10)
+        observe_call("delete", token, started, response.status_code)
+
+        if not response.ok:
+            print(f"❌ Ошибка {response.status_code}: {response.text}")
+        return response
 
+    except requests.exceptions.RequestException as e:
+        print(f"❌ Сетевая ошибка: {e}")
+        observe_call("delete", token, started, None)
+        return None
+
+def edit_message(message_id, payload, token: str):
+    """Редактирует отправленное сообщение (dict или bytes). При сетевой ошибке возвращает None."""
+    url = f"{config.API_BASE_URL}messages?message_id={message_id}"
+    started = time.perf_counter()
 
     try:
-        response = requests.delete(url, headers=headers, timeout=10)
+        response = client.request("PUT", url, token, timeout=10, **_body(payload))
+        observe_call("edit", token, started, response.status_code)
 
         if not response.ok:
             print(f"❌ Ошибка {response.status_code}: {response.text}")
-        return False
+        return response
 
     except requests.exceptions.RequestException as e:
         print(f"❌ Сетевая ошибка: {e}")
-        return False
+        observe_call("edit", token, started, None)
+        return None
 
 hello_message = {
   "text": "Добро пожаловать! Пожалуйста, выберите город:",
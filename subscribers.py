@@ -0,0 +1,463 @@
+import argparse
+import atexit
+import fcntl
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import config
+import event_journal
+
+logger = logging.getLogger(__name__)
+
+# ==================== КОНФИГУРАЦИЯ ====================
+SUBSCRIBERS_DIR = getattr(config, "SUBSCRIBERS_DIR", os.path.join("data", "subscribers"))
+SUBSCRIBERS_COMPACT_EVERY = getattr(config, "SUBSCRIBERS_COMPACT_EVERY", 10000)  # Записей лога до нового снимка
+SUBSCRIBERS_REFRESH_INTERVAL = getattr(config, "SUBSCRIBERS_REFRESH_INTERVAL", 1.0)  # Подхват записей других процессов (сек)
+SUBSCRIBERS_FSYNC = getattr(config, "SUBSCRIBERS_FSYNC", False)  # fsync после каждой записи лога
+
+SNAPSHOT_FILE = "snapshot.json"
+LOG_FILE = "subscribers.log"
+LOCK_FILE = "subscribers.lock"
+
+
+def subscription_events(log_dir):
+    """
+    (timestamp мс, update_type, user_id, chat_id) для bot_started/bot_stopped из журнала бота
+    и логов старого формата, в хронологическом порядке.
+    """
+    events = []
+    for records in (event_journal.iter_records(log_dir), event_journal.iter_legacy_records(log_dir)):
+        for record in records:
+            data = record.get("data")
+            if not isinstance(data, dict):
+                continue
+            update_type = data.get("update_type")
+            if update_type not in ("bot_started", "bot_stopped"):
+                continue
+            user_id = (data.get("user") or {}).get("user_id")
+            if user_id is None:
+                continue
+            timestamp = data.get("timestamp") or int(record.get("ts", 0) * 1000)
+            events.append((timestamp, update_type, user_id, data.get("chat_id")))
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+def journal_state(bots):
+    """Подписчики по журналам ботов: {имя: каталог логов} -> {имя: {user_id: chat_id}}."""
+    state = {}
+    for name, log_dir in bots.items():
+        users = state[name] = {}
+        for _, update_type, user_id, chat_id in subscription_events(log_dir):
+            if update_type == "bot_started":
+                users[user_id] = chat_id
+            else:
+                users.pop(user_id, None)
+    return state
+
+
+def journal_dirs():
+    """{имя: каталог логов} всех ботов реестра."""
+    from bot_registry import BOTS
+
+    return {bot.name: bot.log_dir for bot in BOTS}
+
+
+class SubscriberRegistry:
+    """
+    Текущие подписчики каждого бота: {бот: {user_id: chat_id}} в памяти.
+    На диске - снимок (snapshot.json) + лог изменений (subscribers.log, строка JSON на событие).
+    Поток запроса только меняет состояние в памяти и ставит строку в очередь; фоновый поток
+    пишет накопленное одним write() с O_APPEND под общей блокировкой, так что несколько процессов
+    (pre-fork) пишут в один лог и подхватывают чужие изменения, дочитывая его хвост.
+    Снимок пересобирается тем же фоновым потоком под эксклюзивной блокировкой, когда лог разрастается.
+    seed - функция, возвращающая {бот: каталог логов}: если ни снимка, ни лога ещё нет (первый запуск),
+    реестр заполняется по событиям bot_started/bot_stopped из журналов ботов.
+    """
+
+    def __init__(self, directory=SUBSCRIBERS_DIR, compact_every=SUBSCRIBERS_COMPACT_EVERY,
+                 refresh_interval=SUBSCRIBERS_REFRESH_INTERVAL, fsync=SUBSCRIBERS_FSYNC, seed=None):
+        self.directory = directory
+        self._seed = seed
+        self._compact_every = compact_every
+        self._refresh_interval = refresh_interval
+        self._fsync = fsync
+        self._bots = {}
+        self._loaded = False
+        self._log_fd = None
+        self._log_ino = None
+        self._offset = 0
+        self._log_records = 0
+        self._refreshed = 0.0
+        self._unwritten = []  # Применено в памяти, ещё не в логе: (бот, user_id, chat_id, active, строка)
+        self._writing = []  # Пачка, которую сейчас пишет фоновый поток
+        self._lock = threading.RLock()
+        self._io_lock = threading.Lock()  # Запись лога и снимка - по одной за раз
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    # ---------- Публичный API ----------
+
+    def subscribe(self, bot, user_id, chat_id=None):
+        self._record(bot, user_id, chat_id, True)
+
+    def unsubscribe(self, bot, user_id):
+        self._record(bot, user_id, None, False)
+
+    def is_active(self, bot, user_id):
+        return user_id in self._users(bot)
+
+    def count(self, bot):
+        return len(self._users(bot))
+
+    def chat_id(self, bot, user_id):
+        return self._users(bot).get(user_id)
+
+    def active(self, bot):
+        """[(user_id, chat_id)] активных подписчиков бота (копия)."""
+        users = self._users(bot)
+        with self._lock:
+            return list(users.items())
+
+    def stats(self):
+        self._refresh()
+        with self._lock:
+            return {
+                "bots": {bot: len(users) for bot, users in self._bots.items()},
+                "log_records": self._log_records,
+                "unwritten": len(self._unwritten) + len(self._writing),
+            }
+
+    def rebuild(self, bots):
+        """Пересобирает реестр с нуля по журналам ботов ({имя: каталог логов}) и пишет снимок."""
+        state = journal_state(bots)
+        self.reset(state, bots=list(state))
+        return {name: len(users) for name, users in state.items()}
+
+    def reset(self, state=None, bots=None):
+        """
+        Заменяет содержимое реестра ({бот: {user_id: chat_id}}, по умолчанию пустое) и пишет снимок.
+        bots - заменяются только эти боты (нет в state - очищаются), подписчики остальных сохраняются.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        state = state or {}
+        with self._io_lock, self._lock, self._file_lock(fcntl.LOCK_EX):
+            if bots is None:
+                self._unwritten = []
+                self._bots = state
+            else:
+                # Не записанные ещё изменения заменяемых ботов теряют смысл, остальных - сохраняются
+                names = set(bots)
+                self._unwritten = [entry for entry in self._unwritten if entry[0] not in names]
+                self._read_state()  # Актуальное состояние остальных ботов, с записями других процессов
+                for bot in bots:
+                    self._bots.pop(bot, None)
+                    if bot in state:
+                        self._bots[bot] = state[bot]
+            self._write_snapshot(self._snapshot())
+            self._truncate_log()
+            self._loaded = True
+
+    def load(self):
+        with self._lock:
+            self._load()
+
+    def flush(self):
+        """Дописывает в лог всё, что ещё ждёт фонового потока."""
+        with self._io_lock:
+            self._write_pending()
+
+    def close(self):
+        """Останавливает фоновый поток, дописывает очередь и закрывает лог (вызывается при выходе)."""
+        thread = self._thread
+        if thread is not None:
+            self._stopping = True
+            self._wake.set()
+            thread.join(5)
+            self._thread = None
+        try:
+            self.flush()
+        except OSError as e:
+            logger.error("Failed to write %d subscriber log records: %s", len(self._unwritten), e)
+        with self._lock:
+            if self._log_fd is not None:
+                os.close(self._log_fd)
+                self._log_fd = None
+
+    # ---------- Внутреннее ----------
+
+    def _users(self, bot):
+        self._refresh()
+        return self._bots.get(bot) or {}
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _record(self, bot, user_id, chat_id, active):
+        if user_id is None:
+            return
+        line = (json.dumps({"ts": time.time(), "bot": bot, "user_id": user_id, "chat_id": chat_id,
+                            "active": active}, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            self._apply(bot, user_id, chat_id, active)
+            self._unwritten.append((bot, user_id, chat_id, active, line))
+            if self._thread is None:
+                self._start()
+        self._wake.set()
+
+    def _start(self):
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="subscribers-log", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            if self._stopping:
+                return  # Остаток допишет close()
+            with self._io_lock:
+                try:
+                    self._write_pending()
+                except OSError as e:
+                    logger.error("Subscriber log write failed, retrying in 1s: %s", e)
+                    time.sleep(1.0)
+                    self._wake.set()
+
+    def _write_pending(self):
+        """Пишет накопленные записи одним write(); вызывается под _io_lock."""
+        with self._lock:
+            batch = self._writing = self._unwritten
+            self._unwritten = []
+        if not batch:
+            return
+        data = b"".join(entry[4] for entry in batch)
+        try:
+            with self._file_lock(fcntl.LOCK_SH):
+                with self._lock:
+                    if self._log_fd is None or self._log_inode() != self._log_ino:
+                        # Лог пересобран другим процессом (или мы после fork). Без заполнения по журналам:
+                        # оно берёт LOCK_EX, а мы уже держим LOCK_SH
+                        self._load(seed=False)
+                    elif os.fstat(self._log_fd).st_size > self._offset:
+                        self._read_log(self._offset)  # Сначала чужие записи, чтобы смещение было на конце лога
+                    os.write(self._log_fd, data)
+                    # Свои строки не перечитываем: сдвигаем смещение, если никто не дописал параллельно.
+                    # Иначе строки вместе с чужими дочитает (и учтёт) _refresh
+                    if os.fstat(self._log_fd).st_size == self._offset + len(data):
+                        self._offset += len(data)
+                        self._log_records += len(batch)
+                    self._writing = []
+                    fd = self._log_fd
+                    compact = self._log_records >= self._compact_every
+                if self._fsync:
+                    os.fsync(fd)
+        except OSError:
+            with self._lock:
+                # Вернуть пачку в начало очереди - порядок записей сохраняется
+                if self._writing:
+                    self._unwritten[:0] = self._writing
+                    self._writing = []
+            raise
+        if compact:
+            self._compact()
+
+    def _apply(self, bot, user_id, chat_id, active):
+        users = self._bots.setdefault(bot, {})
+        if active:
+            users[user_id] = chat_id
+        else:
+            users.pop(user_id, None)
+
+    def _refresh(self):
+        """Не чаще refresh_interval дочитывает записи, добавленные другими процессами."""
+        now = time.monotonic()
+        if self._loaded and now - self._refreshed < self._refresh_interval:
+            return
+        with self._lock:
+            if not self._loaded:
+                self._load()
+                return
+            self._refreshed = now
+            try:
+                st = os.stat(self._path(LOG_FILE))
+            except FileNotFoundError:
+                return
+            if self._log_fd is None or st.st_ino != self._log_ino or st.st_size < self._offset:
+                self._load()  # Лог пересобран другим процессом
+            elif st.st_size > self._offset:
+                self._read_log(self._offset)
+
+    def _load(self, seed=True):
+        os.makedirs(self.directory, exist_ok=True)
+        started = time.perf_counter()
+        if seed and self._seed is not None and not self._persisted():
+            self._seed_from_journals()
+        with self._file_lock(fcntl.LOCK_SH):
+            self._read_state()
+        self._loaded = True
+        self._refreshed = time.monotonic()
+        logger.info("Loaded subscribers %s in %.1f ms", self._stats_line(), (time.perf_counter() - started) * 1000)
+
+    def _persisted(self):
+        return os.path.exists(self._path(SNAPSHOT_FILE)) or os.path.exists(self._path(LOG_FILE))
+
+    def _seed_from_journals(self):
+        """Первый запуск: снимок по журналам ботов, иначе рассылка до ручного --rebuild ушла бы в пустоту."""
+        with self._file_lock(fcntl.LOCK_EX):
+            if self._persisted():
+                return  # Успел другой процесс
+            started = time.perf_counter()
+            self._bots = journal_state(self._seed())
+            self._write_snapshot(self._snapshot())
+        logger.info("Seeded subscribers from journals %s in %.1f ms", self._stats_line(),
+                    (time.perf_counter() - started) * 1000)
+
+    def _read_state(self):
+        """Снимок + весь лог (под файловой блокировкой, которую держит вызывающий)."""
+        self._bots = {}
+        try:
+            with open(self._path(SNAPSHOT_FILE), "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            for bot, users in snapshot.get("bots", {}).items():
+                self._bots[bot] = {user_id: chat_id for user_id, chat_id in users}
+        except FileNotFoundError:
+            pass
+        self._log_records = 0
+        self._open_log()
+        self._read_log(0)
+
+    def _read_log(self, offset):
+        with open(self._path(LOG_FILE), "rb") as f:
+            f.seek(offset)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break  # Строка ещё дописывается
+                offset += len(raw)
+                try:
+                    entry = json.loads(raw)
+                except ValueError:
+                    continue
+                self._apply(entry["bot"], entry["user_id"], entry.get("chat_id"), entry["active"])
+                self._log_records += 1
+        self._offset = offset
+        # Свои изменения, ещё не дошедшие до лога, новее прочитанного - применяем поверх
+        for entry in self._writing + self._unwritten:
+            self._apply(*entry[:4])
+
+    def _log_inode(self):
+        try:
+            return os.stat(self._path(LOG_FILE)).st_ino
+        except FileNotFoundError:
+            return None
+
+    def _open_log(self):
+        if self._log_fd is not None:
+            os.close(self._log_fd)
+        self._log_fd = os.open(self._path(LOG_FILE), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._log_ino = os.fstat(self._log_fd).st_ino
+
+    def _compact(self):
+        """Новый снимок и пустой лог; вызывается фоновым потоком под _io_lock."""
+        started = time.perf_counter()
+        with self._file_lock(fcntl.LOCK_EX):
+            with self._lock:
+                if self._log_fd is None or self._log_inode() != self._log_ino:
+                    self._read_state()  # Лог уже пересобран другим процессом - наше смещение к нему не относится
+                else:
+                    self._read_log(self._offset)  # Всё, что успели дописать другие процессы
+                snapshot = self._snapshot()
+            # Снимок с fsync пишется без _lock: потоки запросов в это время читают и меняют память.
+            # Лог под LOCK_EX не меняется, поэтому _refresh ничего не дочитывает и не перезагружает
+            self._write_snapshot(snapshot)
+            with self._lock:
+                self._truncate_log()
+                line = self._stats_line()
+        logger.info("Compacted subscribers %s in %.1f ms", line, (time.perf_counter() - started) * 1000)
+
+    def _snapshot(self):
+        return {"created": time.time(), "bots": {bot: list(users.items()) for bot, users in self._bots.items()}}
+
+    def _write_snapshot(self, snapshot):
+        """Снимок (под LOCK_EX); затем лог очищается - повторное применение лога к снимку безопасно."""
+        tmp = self._path(SNAPSHOT_FILE + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path(SNAPSHOT_FILE))
+
+    def _truncate_log(self):
+        log_tmp = self._path(LOG_FILE + ".tmp")
+        open(log_tmp, "wb").close()
+        os.replace(log_tmp, self._path(LOG_FILE))
+        self._log_records = 0
+        self._open_log()
+        self._offset = 0
+
+    def _file_lock(self, mode):
+        return _FileLock(self._path(LOCK_FILE), mode)
+
+    def _stats_line(self):
+        return ", ".join(f"{bot}={len(users)}" for bot, users in self._bots.items()) or "(empty)"
+
+    def _after_fork(self):
+        # Незаписанное родителем допишет сам родитель
+        self._lock = threading.RLock()
+        self._io_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._unwritten = []
+        self._writing = []
+        self._log_fd = None
+        self._log_ino = None
+
+
+class _FileLock:
+    """flock на файле-блокировке: общий (LOCK_SH) для записи в лог, эксклюзивный - для снимка."""
+
+    def __init__(self, path, mode):
+        self._path = path
+        self._mode = mode
+        self._fd = None
+
+    def __enter__(self):
+        self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._fd, self._mode)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+
+
+registry = SubscriberRegistry(seed=journal_dirs)
+atexit.register(registry.close)
+os.register_at_fork(after_in_child=registry._after_fork)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Реестр подписчиков ботов")
+    parser.add_argument("--rebuild", action="store_true", help="Пересобрать реестр по журналам ботов")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    if args.rebuild:
+        counts = registry.rebuild(journal_dirs())
+    else:
+        counts = registry.stats()["bots"]
+    for name, count in counts.items():
+        print(f"{name}: {count}")
+    print(f"{(time.perf_counter() - started) * 1000:.1f} ms", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
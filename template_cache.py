@@ -0,0 +1,234 @@
+import json
+import logging
+import os
+import re
+import threading
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# ==================== КОНФИГУРАЦИЯ ====================
+TEMPLATES_DIR = getattr(
+    config, "TEMPLATES_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+)
+TEMPLATE_POLL_INTERVAL = getattr(config, "TEMPLATE_POLL_INTERVAL", 2.0)  # Проверка mtime раз в N сек, 0 - выкл.
+
+
+# Подстановка в готовое тело: {name} внутри JSON-строки (пустой объект {} не затрагивается)
+_PLACEHOLDER_RE = re.compile(rb"\{(\w+)\}")
+
+
+class PreparedPayload:
+    """
+    Тело запроса, сериализованное в JSON один раз.
+    Поля {name} заполняются склейкой байтов (значения экранируются как JSON-строки),
+    без повторного json.dumps всего сообщения. Без полей render() отдаёт готовые байты.
+    """
+
+    __slots__ = ("raw", "_parts")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._parts = _PLACEHOLDER_RE.split(raw) if _PLACEHOLDER_RE.search(raw) else None
+
+    @classmethod
+    def from_value(cls, value):
+        return cls(json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+    @property
+    def is_static(self):
+        return self._parts is None
+
+    def render(self, values=None):
+        if self._parts is None:
+            return self.raw
+        values = values or {}
+        out = []
+        # split() с группой: чётные элементы - текст, нечётные - имена полей
+        for i, part in enumerate(self._parts):
+            if i % 2 == 0:
+                out.append(part)
+                continue
+            name = part.decode("ascii")
+            if name in values and values[name] is not None:
+                out.append(json.dumps(str(values[name]), ensure_ascii=False)[1:-1].encode("utf-8"))
+            else:
+                out.append(b"{" + part + b"}")
+        return b"".join(out)
+
+
+class Template:
+    """Загруженный файл: разобранное значение + готовые байты для отправки."""
+
+    __slots__ = ("path", "mtime", "size", "encoding", "value", "raw", "prepared")
+
+    def __init__(self, path, mtime, size, encoding, value, raw):
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.encoding = encoding
+        self.value = value
+        self.raw = raw
+        self.prepared = PreparedPayload(raw)
+
+
+class TemplateCache:
+    """
+    Кэш файлов ответов в памяти.
+    JSON-файлы хранятся и разобранными, и сериализованными в байты (для отправки без json.dumps).
+    Изменения подхватываются фоновой проверкой mtime/размера файлов.
+    Ключ кэша - (путь, кодировка): один файл, читаемый в cp1251 и в utf-8, хранится в двух записях.
+    Значения общие для всех потоков - изменять полученные dict нельзя.
+    """
+
+    def __init__(self, directory=TEMPLATES_DIR, poll_interval=TEMPLATE_POLL_INTERVAL):
+        self.directory = os.path.abspath(directory)
+        self.poll_interval = poll_interval
+        self._items = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {"hits": 0, "misses": 0, "loads": 0, "reloads": 0, "errors": 0}
+
+    # ---------- Публичный API ----------
+
+    def preload(self):
+        """Загружает все файлы каталога шаблонов (вызывается при старте)."""
+        try:
+            names = sorted(os.listdir(self.directory))
+        except FileNotFoundError:
+            logger.warning("Templates directory %s not found", self.directory)
+            return 0
+        count = 0
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if os.path.isfile(path) and self._load(os.path.abspath(path)) is not None:
+                count += 1
+        logger.info("Preloaded %s templates from %s", count, self.directory)
+        return count
+
+    def start(self):
+        """Загружает шаблоны и запускает фоновую проверку изменений."""
+        self.preload()
+        if self.poll_interval and self._thread is None:
+            self._thread = threading.Thread(target=self._poll, name="template-poll", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def resolve(self, name, default_ext=""):
+        """
+        Имя шаблона или путь к файлу -> абсолютный путь. Имя без расширения дополняется default_ext
+        (".json" - у JSON-методов: get_json("hello_message") -> hello_message.json).
+        """
+        if os.sep in name or "/" in name or os.path.splitext(name)[1]:
+            return os.path.abspath(name)
+        return os.path.join(self.directory, name + default_ext)
+
+    def get(self, name, encoding=None, default_ext=""):
+        """Template по имени или пути (загружается при первом обращении) или None."""
+        path = self.resolve(name, default_ext)
+        item = self._items.get((path, encoding or "utf-8"))
+        if item is not None:
+            self._count("hits")
+            return item
+        self._count("misses")
+        return self._load(path, encoding)
+
+    def get_json(self, name, default=None):
+        item = self.get(name, default_ext=".json")
+        return default if item is None else item.value
+
+    def get_bytes(self, name, default=None):
+        """Готовое тело запроса (JSON в UTF-8) без повторной сериализации."""
+        item = self.get(name, default_ext=".json")
+        return default if item is None else item.raw
+
+    def get_prepared(self, name, default=None):
+        """PreparedPayload шаблона: готовые байты + быстрая подстановка полей {name}."""
+        item = self.get(name, default_ext=".json")
+        return default if item is None else item.prepared
+
+    def get_text(self, name, default=None, encoding="utf-8"):
+        item = self.get(name, encoding)
+        return default if item is None else item.value
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["templates"] = len(self._items)
+        return stats
+
+    def _after_fork(self):
+        """Поток проверки не переживает fork - запускаем его заново в дочернем процессе."""
+        self._lock = threading.Lock()
+        if self._thread is not None:
+            self._thread = None
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._poll, name="template-poll", daemon=True)
+            self._thread.start()
+
+    # ---------- Внутреннее ----------
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _load(self, path, encoding=None):
+        encoding = encoding or "utf-8"
+        key = (path, encoding)
+        try:
+            st = os.stat(path)
+            with open(path, "rb") as f:
+                data = f.read()
+            if path.endswith(".json"):
+                value = json.loads(data.decode(encoding))
+                raw = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            else:
+                value = data.decode(encoding).strip()
+                raw = value.encode("utf-8")
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            self._count("errors")
+            logger.error("Error reading template %s: %s", path, e)
+            # Битый файл после правки - продолжаем отдавать прошлую версию
+            return self._items.get(key)
+        item = Template(path, st.st_mtime_ns, st.st_size, encoding, value, raw)
+        with self._lock:
+            reloaded = key in self._items
+            self._items[key] = item
+            self._stats["reloads" if reloaded else "loads"] += 1
+        return item
+
+    def _poll(self):
+        while not self._stop.wait(self.poll_interval):
+            self._check()
+
+    def _check(self):
+        """Перечитывает изменившиеся файлы и подхватывает новые файлы каталога."""
+        for (path, encoding), item in list(self._items.items()):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if st.st_mtime_ns != item.mtime or st.st_size != item.size:
+                logger.info("Template %s changed, reloading", path)
+                self._load(path, encoding)
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        known = {path for path, _ in list(self._items)}
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if path not in known and os.path.isfile(path):
+                self._load(path)
+
+
+# Фоновую проверку запускают серверы (main.py, asgi_app.py, MessegeGetter.py), а не импорт:
+# утилитам (replay, broadcast, benchmark) поток не нужен, шаблоны подгружаются при первом обращении
+templates = TemplateCache()
+os.register_at_fork(after_in_child=templates._after_fork)
@@ -0,0 +1,95 @@
+"""
+Общая настройка тестов.
+
+config.py с токенами в репозитории нет - модули читают настройки через getattr(config, ...),
+поэтому тестам достаточно подставить модуль config с двумя ботами и путями во временном каталоге
+до импорта тестируемых модулей.
+"""
+import os
+import sys
+import tempfile
+import types
+
+_data_dir = tempfile.mkdtemp(prefix="max-bot-tests-")
+
+config = types.ModuleType("config")
+config.API_BASE_URL = "http://127.0.0.1:9/"
+config.SECRET_KEY = ""
+config.BOTS = [
+    {"name": "invest", "route": "webhook", "token": "invest-token", "secret": "invest-secret",
+     "log_dir": os.path.join(_data_dir, "logs", "invest")},
+    {"name": "sotr", "route": "webhook1", "token": "sotr-token", "secret": "",
+     "log_dir": os.path.join(_data_dir, "logs", "sotr")},
+]
+config.SUBSCRIBERS_DIR = os.path.join(_data_dir, "subscribers")
+config.IDEMPOTENCY_DB_PATH = os.path.join(_data_dir, "idempotency.db")
+config.RATE_LIMIT_DB_PATH = os.path.join(_data_dir, "rate_limit.db")
+config.CONVERSATION_STATE_DB_PATH = os.path.join(_data_dir, "conversation_state.db")
+sys.modules["config"] = config
+
+import pytest  # noqa: E402
+
+
+class FakeClock:
+    """Подменяет модуль time в тестируемом модуле: время двигается только через advance()."""
+
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+class RecordingDispatcher:
+    """Вместо OutboundDispatcher: запоминает исходящие вызовы [(kind, args)], в сеть ничего не уходит."""
+
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, kind, *args, lane=None, block=False, timeout=None, callback=None):
+        self.calls.append((kind, args))
+        if callback is not None:
+            callback(True, 200)
+        return True
+
+    def send_message(self, user_id, payload, token, lane=None, block=False, callback=None):
+        return self.submit("send", user_id, payload, token, callback=callback)
+
+    def delete_message(self, message_id, token):
+        return self.submit("delete", message_id, token)
+
+    def edit_message(self, message_id, payload, token):
+        return self.submit("edit", message_id, payload, token)
+
+
+@pytest.fixture
+def outbox():
+    outbound_queue = pytest.importorskip("outbound_queue")
+    recorder = RecordingDispatcher()
+    previous = outbound_queue.install(recorder)
+    yield recorder
+    outbound_queue.install(previous)
+
+
+@pytest.fixture
+def conversations(monkeypatch):
+    """Чистое хранилище диалогов в памяти для маршрутизатора кнопок."""
+    import callback_router
+    import conversation_state
+    store = conversation_state.ConversationStore(ttl=3600, max_size=100)
+    monkeypatch.setattr(callback_router, "conversations", store)
+    return store
@@ -0,0 +1,140 @@
+import json
+import os
+
+import pytest
+
+pytest.importorskip("requests")
+
+from bot_registry import Bot  # noqa: E402
+from callback_router import CallbackRouter  # noqa: E402
+
+
+class Ctx:
+    """Минимальный UpdateContext для маршрутизатора."""
+
+    def __init__(self, payload, user_id=7, chat_id=70, message_id="m1"):
+        self.bot = Bot("invest", "webhook", "invest-token", "unused", secret="")
+        self.payload = payload
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+
+def reply(text):
+    return {"type": "reply", "text": text}
+
+
+def sent(outbox):
+    """Тексты отправленных и отредактированных сообщений по порядку."""
+    return [(kind, json.loads(args[-2])["text"]) for kind, args in outbox.calls if kind in ("send", "edit")]
+
+
+def test_resolve_priority():
+    router = CallbackRouter([
+        {"pattern": r"CITY_(?P<code>\w+)", "actions": []},
+        {"prefix": "CITY_", "actions": []},
+        {"prefix": "CITY_K", "actions": []},
+        {"match": "CITY_KZN", "actions": []},
+    ])
+    assert router.resolve("CITY_KZN")[0].name == "CITY_KZN"
+    route, params = router.resolve("CITY_KRD")
+    assert (route.name, params) == ("CITY_K*", {"suffix": "RD"})
+    assert router.resolve("CITY_TGN")[0].name == "CITY_*"
+    assert router.resolve("OTHER") == (None, None)
+
+
+def test_pattern_params():
+    router = CallbackRouter([
+        {"pattern": r"PAGE_(?P<page>\d+)", "actions": []},
+        {"pattern": r"ITEM_(?P<id>\d+)_(?P<page>\d+)", "actions": []},
+    ])
+    route, params = router.resolve("ITEM_5_2")
+    assert route.name == r"ITEM_(?P<id>\d+)_(?P<page>\d+)"
+    assert params == {"id": "5", "page": "2"}
+    assert router.resolve("PAGE_3")[1] == {"page": "3"}
+    assert router.resolve("PAGE_x") == (None, None)
+
+
+@pytest.mark.parametrize("spec", [
+    {"actions": []},
+    {"match": "A", "actions": [{"type": "launch"}]},
+])
+def test_invalid_route_rejected(spec):
+    with pytest.raises(ValueError):
+        CallbackRouter([spec])
+
+
+def test_reply_and_delete(outbox, conversations):
+    router = CallbackRouter([{"match": "A", "actions": [{"type": "delete"}, reply("Вы нажали {payload}")]}])
+    assert router.dispatch(Ctx("A"))
+    assert outbox.calls[0] == ("delete", ("m1", "invest-token"))
+    assert sent(outbox) == [("send", "Вы нажали A")]
+    assert outbox.calls[1][1][0] == 7
+
+
+def test_unknown_payload_does_nothing(outbox, conversations):
+    router = CallbackRouter([{"match": "A", "actions": [reply("x")]}])
+    assert not router.dispatch(Ctx("B"))
+    assert not router.dispatch(Ctx(None))
+    assert outbox.calls == []
+
+
+def test_edit_uses_pattern_params(outbox, conversations):
+    router = CallbackRouter([{"pattern": r"PAGE_(?P<page>\d+)", "actions": [{"type": "edit", "text": "Стр. {page}"}]}])
+    router.dispatch(Ctx("PAGE_4"))
+    assert sent(outbox) == [("edit", "Стр. 4")]
+    assert outbox.calls[0][1][0] == "m1"
+
+
+def test_menu_edits_current_message_by_default(outbox, conversations):
+    menus = {"main": {"text": "Меню для {user_id}"}}
+    router = CallbackRouter([
+        {"match": "EDIT", "actions": [{"type": "menu", "menu": "main"}]},
+        {"match": "SEND", "actions": [{"type": "menu", "menu": "main", "mode": "send"}]},
+    ], menus)
+    router.dispatch(Ctx("EDIT"))
+    router.dispatch(Ctx("SEND"))
+    # Без сообщения, которое можно заменить, меню отправляется новым
+    router.dispatch(Ctx("EDIT", message_id=None))
+    assert sent(outbox) == [("edit", "Меню для 7"), ("send", "Меню для 7"), ("send", "Меню для 7")]
+
+
+def test_unknown_menu_raises(outbox, conversations):
+    router = CallbackRouter([{"match": "A", "actions": [{"type": "menu", "menu": "no_such_menu"}]}])
+    with pytest.raises(KeyError):
+        router.dispatch(Ctx("A"))
+
+
+def test_state_action_and_step_gating(outbox, conversations):
+    router = CallbackRouter([
+        {"pattern": r"CITY_(?P<code>\w+)", "actions": [
+            {"type": "state", "step": "city_selected", "set": {"city": "{code}"}},
+            reply("Город {city}"),
+        ]},
+        {"match": "CONFIRM", "step": "city_selected", "actions": [reply("Подтверждено: {city}")]},
+    ])
+    # До выбора города подтверждение не действует
+    assert not router.dispatch(Ctx("CONFIRM"))
+    router.dispatch(Ctx("CITY_KZN"))
+    state = conversations.get("invest", 7)
+    assert (state.step, state.data) == ("city_selected", {"city": "KZN"})
+    assert router.dispatch(Ctx("CONFIRM"))
+    assert sent(outbox) == [("send", "Город KZN"), ("send", "Подтверждено: KZN")]
+
+
+def test_repo_routes(outbox, conversations):
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "callbacks.json")
+    router = CallbackRouter.from_file(path)
+    router.dispatch(Ctx("CITY_ARM"))
+    assert [kind for kind, _ in outbox.calls] == ["delete", "send"]
+    assert conversations.get("invest", 7).data == {"city": "ARM"}
+    router.dispatch(Ctx("MENU_CITY"))
+    assert conversations.get("invest", 7).step == "start"
+    assert outbox.calls[-1][0] == "edit"
+    assert json.loads(outbox.calls[-1][1][1])["text"].startswith("Добро пожаловать")
+
+
+def test_missing_routes_file(tmp_path):
+    router = CallbackRouter.from_file(str(tmp_path / "callbacks.json"))
+    assert router.resolve("CITY_TGN") == (None, None)
+
@@ -0,0 +1,135 @@
+import pytest
+
+import conversation_state
+from conversation_state import ConversationStore, SqliteStateStore
+
+
+@pytest.fixture(autouse=True)
+def fake_time(clock, monkeypatch):
+    monkeypatch.setattr(conversation_state, "time", clock)
+
+
+@pytest.fixture
+def persisted(tmp_path):
+    """Фабрика хранилищ на одной базе; фоновый сброс не мешает - flush() вызывается явно."""
+    stores = []
+
+    def create(**kwargs):
+        store = ConversationStore(store=SqliteStateStore(str(tmp_path / "state.db")), flush_interval=3600, **kwargs)
+        stores.append(store)
+        return store
+
+    yield create
+    for store in stores:
+        store.close()
+
+
+def test_set_merges_data_and_get_returns_state():
+    store = ConversationStore(ttl=60, max_size=10)
+    store.set("invest", 1, "ask_name", {"lang": "ru"})
+    state = store.set("invest", 1, "ask_phone", {"name": "Ivan"})
+    assert state is store.get("invest", 1)
+    assert state.step == "ask_phone"
+    assert state.data == {"lang": "ru", "name": "Ivan"}
+    assert store.get("sotr", 1) is None
+
+
+def test_state_expires_after_idle_ttl(clock):
+    store = ConversationStore(ttl=60, max_size=10)
+    store.set("invest", 1, "a")
+    clock.advance(40)
+    assert store.get("invest", 1) is not None  # Обращение продлевает TTL
+    clock.advance(40)
+    assert store.get("invest", 1) is not None
+    clock.advance(61)
+    assert store.get("invest", 1) is None
+    assert store.stats()["expired"] == 1
+
+
+def test_least_recently_used_evicted(clock):
+    store = ConversationStore(ttl=60, max_size=2)
+    store.set("invest", 1, "a")
+    store.set("invest", 2, "a")
+    store.get("invest", 1)
+    store.set("invest", 3, "a")
+    assert store.get("invest", 2) is None
+    assert store.get("invest", 1) is not None
+    assert store.get("invest", 3) is not None
+    assert store.stats()["evicted"] == 1
+
+
+def test_clear_removes_state():
+    store = ConversationStore(ttl=60, max_size=10)
+    store.set("invest", 1, "a")
+    store.clear("invest", 1)
+    assert store.get("invest", 1) is None
+
+
+def test_flushed_state_survives_restart(persisted):
+    first = persisted(ttl=60)
+    first.set("invest", 1, "ask_phone", {"name": "Ivan"})
+    first.set("invest", 2, "ask_name")
+    first.clear("invest", 2)
+    first.flush()
+    second = persisted(ttl=60)
+    state = second.get("invest", 1)
+    assert (state.step, state.data) == ("ask_phone", {"name": "Ivan"})
+    assert second.get("invest", 2) is None
+    assert second.stats()["loaded"] == 1
+
+
+def test_evicted_state_is_read_back_from_disk(persisted):
+    store = persisted(ttl=60, max_size=1)
+    store.set("invest", 1, "a", {"x": 1})
+    store.set("invest", 2, "b")
+    assert len(store) == 1
+    # Ещё не сброшено на диск - берётся из очереди записи
+    assert store.get("invest", 1).data == {"x": 1}
+    store.flush()
+    store.set("invest", 2, "b")
+    assert store.get("invest", 1).data == {"x": 1}
+
+
+def test_set_keeps_fields_stored_on_disk(persisted):
+    first = persisted(ttl=60)
+    first.set("invest", 1, "a", {"name": "Ivan"})
+    first.flush()
+    second = persisted(ttl=60)
+    second.set("invest", 1, "b", {"phone": "123"})
+    assert second.get("invest", 1).data == {"name": "Ivan", "phone": "123"}
+
+
+def test_expired_state_not_loaded_from_disk(clock, persisted):
+    first = persisted(ttl=60)
+    first.set("invest", 1, "a")
+    first.flush()
+    clock.advance(61)
+    assert persisted(ttl=60).get("invest", 1) is None
+
+
+def test_reset_only_listed_bots(persisted):
+    first = persisted(ttl=60)
+    first.set("invest", 1, "a")
+    first.set("sotr", 1, "a")
+    first.flush()
+    first.set("invest", 2, "a")
+    first.reset(bots=["invest"])
+    first.flush()
+    assert first.get("invest", 1) is None
+    assert first.get("invest", 2) is None
+    assert first.get("sotr", 1) is not None
+    second = persisted(ttl=60)
+    assert second.get("invest", 1) is None
+    assert second.get("sotr", 1) is not None
+
+
+def test_read_extends_ttl_on_disk(clock, persisted):
+    first = persisted(ttl=60)
+    first.set("invest", 1, "a")
+    first.flush()
+    clock.advance(40)
+    assert first.get("invest", 1) is not None
+    first.flush()
+    clock.advance(40)
+    # Запись на диске продлена чтением: после перезапуска диалог ещё жив
+    assert persisted(ttl=60).get("invest", 1) is not None
@@ -0,0 +1,106 @@
+import json
+import os
+
+import pytest
+
+import event_journal
+import journal_archive
+from event_journal import JournalWriter, iter_records, list_segments, segment_name
+
+
+@pytest.fixture(autouse=True)
+def no_compression(monkeypatch):
+    # Сжатие после ротации - в фоновом потоке; здесь сегменты остаются несжатыми
+    monkeypatch.setattr(journal_archive, "compress_later", lambda path, codec=None: None)
+
+
+def writer(directory, **kwargs):
+    kwargs.setdefault("flush_interval", 0.01)
+    kwargs.setdefault("fsync", "never")
+    kwargs.setdefault("index", False)
+    kwargs.setdefault("tag", None)
+    return JournalWriter(str(directory), **kwargs)
+
+
+def keys(records):
+    return [record["key"] for record in records]
+
+
+def test_records_written_in_order(tmp_path):
+    journal = writer(tmp_path)
+    for i in range(10):
+        assert journal.append(f"k{i}", {"n": i})
+    journal.close(5)
+    records = list(iter_records(str(tmp_path)))
+    assert keys(records) == [f"k{i}" for i in range(10)]
+    assert [record["data"] for record in records] == [{"n": i} for i in range(10)]
+    assert all(record["ts"] > 0 for record in records)
+
+
+def test_flush_writes_pending_batch(tmp_path):
+    journal = writer(tmp_path, batch_size=1000, flush_interval=3600)
+    try:
+        journal.append("k", {})
+        assert journal.flush(5)
+        assert keys(iter_records(str(tmp_path))) == ["k"]
+        stats = journal.stats()
+        assert stats["written"] == 1
+        assert stats["batches"] == 1
+    finally:
+        journal.close(5)
+
+
+def test_segments_rotate_by_size(tmp_path):
+    journal = writer(tmp_path, segment_bytes=500, batch_size=1)
+    for i in range(30):
+        journal.append(f"k{i}", {"text": "x" * 50})
+    journal.close(5)
+    segments = list_segments(str(tmp_path))
+    assert len(segments) > 3
+    assert [seq for seq, _ in segments] == list(range(1, len(segments) + 1))
+    # Запись не разрывается между сегментами, сегмент не превышает segment_bytes
+    assert all(os.path.getsize(path) <= 500 for _, path in segments)
+    assert keys(iter_records(str(tmp_path))) == [f"k{i}" for i in range(30)]
+    assert journal.stats()["rotations"] == len(segments) - 1
+
+
+def test_reopen_appends_to_last_segment(tmp_path):
+    journal = writer(tmp_path)
+    journal.append("a", {})
+    journal.close(5)
+    journal = writer(tmp_path)
+    journal.append("b", {})
+    journal.close(5)
+    assert [seq for seq, _ in list_segments(str(tmp_path))] == [1]
+    assert keys(iter_records(str(tmp_path))) == ["a", "b"]
+
+
+def test_append_after_close_is_dropped(tmp_path):
+    journal = writer(tmp_path)
+    journal.close(5)
+    assert not journal.append("k", {})
+
+
+def test_worker_segments_are_tagged(tmp_path):
+    for tag in ("w1", "w2"):
+        journal = writer(tmp_path, tag=tag)
+        journal.append(tag, {})
+        journal.close(5)
+    assert sorted(os.listdir(tmp_path)) == [segment_name(1, "w1"), segment_name(1, "w2")]
+    assert keys(iter_records(str(tmp_path), tag="w2")) == ["w2"]
+    assert event_journal.journal_tags(str(tmp_path)) == ["w1", "w2"]
+
+
+def test_torn_last_line_is_skipped(tmp_path):
+    journal = writer(tmp_path)
+    journal.append("k", {})
+    journal.close(5)
+    (_, path), = list_segments(str(tmp_path))
+    with open(path, "ab") as f:
+        f.write(json.dumps({"ts": 1, "key": "torn", "data": {}}).encode()[:10])
+    assert keys(iter_records(str(tmp_path))) == ["k"]
+
+
+def test_unknown_fsync_policy_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        JournalWriter(str(tmp_path), fsync="sometimes")
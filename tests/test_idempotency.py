@@ -0,0 +1,107 @@
+import pytest
+
+import idempotency
+from idempotency import (IdempotencyCache, SharedIdempotencyCache, SqliteIdempotencyStore, create_cache,
+                         update_key)
+
+
+@pytest.fixture(autouse=True)
+def fake_time(clock, monkeypatch):
+    monkeypatch.setattr(idempotency, "time", clock)
+
+
+def test_second_delivery_is_duplicate():
+    cache = IdempotencyCache(ttl=60, max_size=10)
+    assert not cache.seen("invest:m:1")
+    assert cache.seen("invest:m:1")
+    assert cache.stats() == {"size": 1, "hits": 1, "evicted": 0}
+
+
+def test_empty_key_is_never_duplicate():
+    cache = IdempotencyCache(ttl=60, max_size=10)
+    assert not cache.seen(None)
+    assert not cache.seen(None)
+    assert len(cache) == 0
+
+
+def test_key_expires_after_ttl(clock):
+    cache = IdempotencyCache(ttl=60, max_size=10)
+    cache.seen("a")
+    clock.advance(30)
+    cache.seen("b")
+    clock.advance(30)
+    assert not cache.seen("a")
+    assert cache.seen("b")
+
+
+def test_oldest_key_evicted_over_max_size(clock):
+    cache = IdempotencyCache(ttl=60, max_size=2)
+    for key in ("a", "b", "c"):
+        cache.seen(key)
+        clock.advance(1)
+    assert len(cache) == 2
+    assert cache.stats()["evicted"] == 1
+    assert cache.seen("c")
+    assert not cache.seen("a")
+
+
+def test_forget_allows_redelivery():
+    cache = IdempotencyCache(ttl=60, max_size=10)
+    cache.seen("a")
+    cache.forget("a")
+    cache.forget("missing")
+    assert not cache.seen("a")
+
+
+def test_sqlite_store_shared_between_instances(tmp_path, clock):
+    path = str(tmp_path / "idempotency.db")
+    first = SqliteIdempotencyStore(path, ttl=60)
+    second = SqliteIdempotencyStore(path, ttl=60)
+    assert not first.seen("a")
+    assert second.seen("a")
+    clock.advance(61)
+    # Просроченный ключ считается новым
+    assert not second.seen("a")
+    assert first.seen("a")
+
+
+def test_sqlite_forget_and_purge(tmp_path, clock):
+    store = SqliteIdempotencyStore(str(tmp_path / "idempotency.db"), ttl=60)
+    store.seen("a")
+    store.seen("b")
+    store.forget("a")
+    assert not store.seen("a")
+    clock.advance(61)
+    store.purge()
+    assert store._conn().execute("SELECT COUNT(*) FROM processed").fetchone()[0] == 0
+
+
+def test_shared_cache_checks_local_then_shared(tmp_path):
+    path = str(tmp_path / "idempotency.db")
+    worker1 = SharedIdempotencyCache(SqliteIdempotencyStore(path, ttl=60), IdempotencyCache(60, 10))
+    worker2 = SharedIdempotencyCache(SqliteIdempotencyStore(path, ttl=60), IdempotencyCache(60, 10))
+    assert not worker1.seen("a")
+    assert worker1.seen("a")
+    assert worker2.seen("a")
+    worker1.forget("a")
+    assert not worker1.seen("a")
+
+
+def test_create_cache_backends():
+    assert isinstance(create_cache("memory"), IdempotencyCache)
+    assert isinstance(create_cache("sqlite"), SharedIdempotencyCache)
+    with pytest.raises(ValueError):
+        create_cache("redis")
+
+
+@pytest.mark.parametrize("data, expected", [
+    ({"update_type": "message_created", "message": {"body": {"mid": "m1"}}}, "invest:m:m1"),
+    ({"update_type": "message_callback", "callback": {"callback_id": "c1"}}, "invest:c:c1"),
+    ({"update_type": "bot_started", "chat_id": 5, "user": {"user_id": 7}, "timestamp": 100},
+     "invest:bot_started:5:7:100"),
+    ({"update_type": "message_created", "message": {}}, None),
+    ({"update_type": "bot_started"}, None),
+    ("not a dict", None),
+])
+def test_update_key(data, expected):
+    assert update_key("invest", data) == expected
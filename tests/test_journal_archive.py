@@ -0,0 +1,101 @@
+import json
+import os
+
+import pytest
+
+import event_journal
+import journal_archive
+from event_journal import JournalWriter, iter_records, list_segments
+from journal_index import JournalIndex
+
+
+def message(mid, chat_id, text="x"):
+    return {"update_type": "message_created",
+            "message": {"body": {"mid": mid, "text": text}, "recipient": {"chat_id": chat_id}}}
+
+
+def write_journal(directory, updates):
+    journal = JournalWriter(str(directory), flush_interval=0.01, fsync="never", index=True, tag=None)
+    for data in updates:
+        journal.append(data["message"]["body"]["mid"], data)
+    journal.close(5)
+    (_, path), = list_segments(str(directory))
+    return path
+
+
+@pytest.fixture
+def updates():
+    return [message(f"m{i}", 100 + i % 3, "текст " * 5) for i in range(60)]
+
+
+def mids(records):
+    return [record["data"]["message"]["body"]["mid"] for record in records]
+
+
+def test_journal_written_as_utf8(tmp_path):
+    path = write_journal(tmp_path, [message("m1", 1, "привет ✓")])
+    with open(path, "rb") as f:
+        raw = f.read()
+    assert "привет ✓".encode("utf-8") in raw
+
+
+def test_legacy_cp1251_segment_is_readable(tmp_path):
+    record = {"ts": 1, "key": "k", "data": {"text": "привет"}}
+    path = tmp_path / event_journal.segment_name(1)
+    path.write_bytes((json.dumps(record, ensure_ascii=False) + "\n").encode("cp1251"))
+    assert list(iter_records(str(tmp_path))) == [record]
+
+
+def test_lookup_in_compressed_segment(tmp_path, updates, monkeypatch):
+    path = write_journal(tmp_path, updates)
+    # Мелкие блоки: записи попадают в разные блоки архива
+    monkeypatch.setattr(journal_archive, "JOURNAL_COMPRESSION_BLOCK", 512)
+    target = journal_archive.compress_segment(path, journal_archive.GzipCodec())
+    assert not os.path.exists(path)
+    assert os.path.getsize(journal_archive.blocks_path(target)) > journal_archive.BLOCK.size
+    assert list_segments(str(tmp_path)) == [(1, target)]
+
+    index = JournalIndex(str(tmp_path))
+    assert mids(index.history("chat_id", 102)) == [f"m{i}" for i in range(2, 60, 3)]
+    assert mids(index.history("mid", "m59")) == ["m59"]
+    assert mids(iter_records(str(tmp_path))) == [f"m{i}" for i in range(60)]
+
+
+def test_uncompressed_copy_preferred_while_compressing(tmp_path, updates):
+    path = write_journal(tmp_path, updates)
+    with open(path, "rb") as src, open(path + ".gz", "wb") as dst:
+        dst.write(src.read(10))
+    assert list_segments(str(tmp_path)) == [(1, path)]
+
+
+def test_segment_reader_spans_blocks(tmp_path, monkeypatch):
+    path = str(tmp_path / event_journal.segment_name(1))
+    lines = [f"line {i:04d} ".encode() * 8 + b"\n" for i in range(50)]
+    with open(path, "wb") as f:
+        f.write(b"".join(lines))
+    monkeypatch.setattr(journal_archive, "JOURNAL_COMPRESSION_BLOCK", 300)
+    target = journal_archive.compress_segment(path, journal_archive.GzipCodec())
+    reader = journal_archive.SegmentReader(target)
+    try:
+        data = b"".join(lines)
+        for offset, length in [(0, 10), (250, 400), (len(data) - 5, 5), (0, len(data))]:
+            assert reader.read(offset, length) == data[offset:offset + length]
+    finally:
+        reader.close()
+
+
+def test_segment_reader_without_block_table(tmp_path, updates):
+    path = write_journal(tmp_path, updates)
+    target = journal_archive.compress_segment(path, journal_archive.GzipCodec())
+    os.remove(journal_archive.blocks_path(target))
+    assert mids(JournalIndex(str(tmp_path)).history("mid", "m30")) == ["m30"]
+
+
+def test_writer_starts_new_segment_after_compressed_one(tmp_path, updates):
+    path = write_journal(tmp_path, updates[:5])
+    journal_archive.compress_segment(path, journal_archive.GzipCodec())
+    journal = JournalWriter(str(tmp_path), flush_interval=0.01, fsync="never", index=True, tag=None)
+    journal.append("m99", message("m99", 1))
+    journal.close(5)
+    assert [seq for seq, _ in list_segments(str(tmp_path))] == [1, 2]
+    assert mids(iter_records(str(tmp_path))) == ["m0", "m1", "m2", "m3", "m4", "m99"]
@@ -0,0 +1,81 @@
+import os
+
+import pytest
+
+import journal_archive
+import journal_index
+from event_journal import JournalWriter, list_segments
+from journal_index import JournalIndex, build_index, extract_keys
+
+
+def message(mid, chat_id, user_id, text="x"):
+    return {"update_type": "message_created",
+            "message": {"body": {"mid": mid, "text": text}, "recipient": {"chat_id": chat_id},
+                        "sender": {"user_id": user_id}}}
+
+
+def write_journal(directory, updates, **kwargs):
+    journal = JournalWriter(str(directory), flush_interval=0.01, fsync="never", index=True, tag=None, **kwargs)
+    for data in updates:
+        journal.append(data["message"]["body"]["mid"], data)
+    journal.close(5)
+
+
+@pytest.fixture(autouse=True)
+def no_compression(monkeypatch):
+    # Сжатие после ротации - в фоновом потоке; здесь сегменты остаются несжатыми
+    monkeypatch.setattr(journal_archive, "compress_later", lambda path, codec=None: None)
+
+
+@pytest.fixture
+def updates():
+    return [message(f"m{i}", 100 + i % 3, 7 if i % 2 else 8, "текст " * 5) for i in range(60)]
+
+
+def mids(records):
+    return [record["data"]["message"]["body"]["mid"] for record in records]
+
+
+def test_extract_keys_from_callback():
+    data = {"update_type": "message_callback",
+            "callback": {"callback_id": "cb1", "user": {"user_id": 5}},
+            "message": {"recipient": {"chat_id": 9}, "body": {"mid": "m1"}}}
+    keys = extract_keys(data)
+    assert keys["callback_id"] == {"cb1"}
+    assert keys["user_id"] == {"5"}
+    assert keys["chat_id"] == {"9"}
+    assert keys["mid"] == {"m1"}
+
+
+def test_index_lookup_in_open_segment(tmp_path, updates):
+    write_journal(tmp_path, updates)
+    index = JournalIndex(str(tmp_path))
+    assert mids(index.history("chat_id", 101)) == [f"m{i}" for i in range(1, 60, 3)]
+    assert mids(index.history("user_id", "7")) == [f"m{i}" for i in range(1, 60, 2)]
+    assert mids(index.history("mid", "m42")) == ["m42"]
+    assert list(index.history("mid", "missing")) == []
+
+
+def test_sealed_segments_use_sorted_index(tmp_path, updates):
+    write_journal(tmp_path, updates, segment_bytes=2048, batch_size=1)
+    segments = [path for _, path in list_segments(str(tmp_path))]
+    assert len(segments) > 2
+    assert all(os.path.exists(journal_index.sorted_index_path(path)) for path in segments[:-1])
+    assert mids(JournalIndex(str(tmp_path)).history("chat_id", 100)) == [f"m{i}" for i in range(0, 60, 3)]
+
+
+def test_build_index_restores_lookup(tmp_path, updates):
+    journal = JournalWriter(str(tmp_path), flush_interval=0.01, fsync="never", index=False, tag=None)
+    for data in updates:
+        journal.append("k", data)
+    journal.close(5)
+    assert list(JournalIndex(str(tmp_path)).history("chat_id", 100)) == []
+    assert build_index(str(tmp_path)) == 60
+    assert mids(JournalIndex(str(tmp_path)).history("chat_id", 100)) == [f"m{i}" for i in range(0, 60, 3)]
+
+
+def test_hash_collisions_are_filtered(tmp_path, updates, monkeypatch):
+    write_journal(tmp_path, updates)
+    monkeypatch.setattr(journal_index, "key_hash", lambda value: 1)
+    build_index(str(tmp_path))
+    assert mids(JournalIndex(str(tmp_path)).history("mid", "m5")) == ["m5"]
@@ -0,0 +1,71 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("requests")
+
+from bot_registry import mask_token  # noqa: E402
+from max_client import MaxClient  # noqa: E402
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive между запросами
+
+    def do_GET(self):
+        body = (self.headers.get("Authorization") or "").encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def client():
+    client = MaxClient(pool_maxsize=2)
+    yield client
+    client.close()
+
+
+def test_one_session_per_token(client):
+    assert client.session("a") is client.session("a")
+    assert client.session("a") is not client.session("b")
+
+
+def test_requests_reuse_connection(client, server):
+    for _ in range(5):
+        response = client.request("GET", server, "alpha-token")
+        assert response.status_code == 200
+        assert response.text == "alpha-token"
+    assert client.stats() == {
+        mask_token("alpha-token"): {"requests": 5, "connections_opened": 1, "connections_reused": 4},
+    }
+
+
+def test_tokens_have_separate_pools(client, server):
+    client.request("GET", server, "alpha-token")
+    assert client.request("GET", server, "bravo-token").text == "bravo-token"
+    stats = client.stats()
+    assert stats[mask_token("alpha-token")]["connections_opened"] == 1
+    assert stats[mask_token("bravo-token")]["connections_opened"] == 1
+
+
+def test_close_drops_sessions(client, server):
+    first = client.session("alpha-token")
+    client.request("GET", server, "alpha-token")
+    client.close()
+    assert client.stats() == {}
+    assert client.session("alpha-token") is not first
@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+import metrics
+from metrics import Counter, Histogram
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    # Метрики тестов не попадают в общий реестр приложения
+    monkeypatch.setattr(metrics, "_registry", [])
+
+
+def process_snapshot(requests, latencies):
+    """Снимок одного процесса, прошедший через JSON - как в pre-fork режиме."""
+    counter = Counter("requests_total", "Requests", ("bot", "status"))
+    histogram = Histogram("request_seconds", "Latency", ("bot",), buckets=(0.1, 1.0))
+    for labels, amount in requests.items():
+        counter.inc(*labels, amount=amount)
+    for value in latencies:
+        histogram.observe(value, "invest")
+    return json.loads(json.dumps({metric.name: metric.snapshot() for metric in (counter, histogram)}))
+
+
+def test_counter_render():
+    counter = Counter("requests_total", "Requests", ("bot", "status"))
+    counter.inc("invest", "200")
+    counter.inc("invest", "200", amount=2)
+    counter.inc('a"b\\c', "500")
+    assert counter.value("invest", "200") == 3
+    assert metrics.render().splitlines() == [
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        'requests_total{bot="a\\"b\\\\c",status="500"} 1',
+        'requests_total{bot="invest",status="200"} 3',
+    ]
+
+
+def test_histogram_render_is_cumulative():
+    histogram = Histogram("request_seconds", "Latency", ("bot",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value, "invest")
+    assert metrics.render().splitlines()[2:] == [
+        'request_seconds_bucket{bot="invest",le="0.1"} 2',
+        'request_seconds_bucket{bot="invest",le="1.0"} 3',
+        'request_seconds_bucket{bot="invest",le="+Inf"} 4',
+        'request_seconds_sum{bot="invest"} 3.65',
+        'request_seconds_count{bot="invest"} 4',
+    ]
+
+
+def test_metric_without_labels():
+    Counter("ticks_total", "Ticks").inc()
+    assert metrics.render().splitlines()[-1] == "ticks_total 1"
+
+
+def test_merge_sums_processes():
+    first = process_snapshot({("invest", "200"): 3, ("invest", "500"): 1}, [0.05, 2.0])
+    second = process_snapshot({("invest", "200"): 2, ("sotr", "200"): 4}, [0.5])
+    merged = metrics.merge([first, second])
+    assert sorted(merged["requests_total"]["values"]) == [
+        [["invest", "200"], 5], [["invest", "500"], 1], [["sotr", "200"], 4]]
+    (labels, (counts, total)), = merged["request_seconds"]["values"]
+    assert (labels, counts, total) == (["invest"], [1, 1, 1], pytest.approx(2.55))
+    text = metrics.render(merged)
+    assert 'request_seconds_count{bot="invest"} 3' in text
+    assert 'requests_total{bot="invest",status="200"} 5' in text
+
+
+def test_merge_does_not_change_snapshots():
+    first = process_snapshot({("invest", "200"): 1}, [0.05])
+    second = process_snapshot({("invest", "200"): 1}, [0.05])
+    metrics.merge([first, second])
+    assert first["requests_total"]["values"] == [[["invest", "200"], 1]]
+    assert first["request_seconds"]["values"] == [[["invest"], [[1, 0, 0], 0.05]]]
+
+
+def test_child_process_starts_from_zero():
+    counter = Counter("requests_total", "Requests", ("bot",))
+    counter.inc("invest")
+    metrics._after_fork()
+    assert counter.value("invest") == 0
+    assert metrics.snapshot()["requests_total"]["values"] == []
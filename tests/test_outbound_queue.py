@@ -0,0 +1,225 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("requests")
+
+import reqv_to_bot  # noqa: E402
+from bot_registry import mask_token  # noqa: E402
+from outbound_queue import BULK, INTERACTIVE, LaneQueue, OutboundDispatcher, OutboundJob  # noqa: E402
+from rate_limit import RateLimiter  # noqa: E402
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.ok = 200 <= status_code < 300
+        self.headers = headers or {}
+
+
+class FakeApi:
+    """Подменяет reqv.send_message: отдаёт ответы (или исключения) из очереди по порядку."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+        self.times = []
+        self.lock = threading.Lock()
+
+    def __call__(self, user_id, payload, token):
+        with self.lock:
+            self.calls.append((user_id, payload, token))
+            self.times.append(time.monotonic())
+            result = self.responses.pop(0) if self.responses else FakeResponse(200)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class Outcome:
+    """callback(ok, status) задания; wait() - дождаться итога."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+    def __call__(self, ok, status):
+        self.result = (ok, status)
+        self.event.set()
+
+    def wait(self, timeout=5):
+        assert self.event.wait(timeout), "job did not finish"
+        return self.result
+
+
+@pytest.fixture
+def api(monkeypatch):
+    # Обработчики связываются в __init__ диспетчера, поэтому подмена - до его создания
+    fake = FakeApi()
+    monkeypatch.setattr(reqv_to_bot, "send_message", fake)
+    return fake
+
+
+@pytest.fixture
+def make_dispatcher():
+    created = []
+
+    def make(**kwargs):
+        kwargs.setdefault("workers", 1)
+        kwargs.setdefault("backoff", 0.01)
+        kwargs.setdefault("rate_limiter", RateLimiter(token_rate=1000.0, token_burst=1000,
+                                                      user_rate=1000.0, user_burst=1000))
+        dispatcher = OutboundDispatcher(**kwargs)
+        created.append(dispatcher)
+        return dispatcher
+
+    yield make
+    for dispatcher in created:
+        dispatcher.shutdown(timeout=5)
+
+
+def job(lane=INTERACTIVE, n=0):
+    return OutboundJob("send", (n, {}, "token"), lane)
+
+
+def test_lane_queue_serves_interactive_before_bulk():
+    queue = LaneQueue({INTERACTIVE: 10, BULK: 10})
+    queue.put(job(BULK, 1))
+    queue.put(job(INTERACTIVE, 2))
+    queue.put(job(BULK, 3))
+    assert [queue.get().args[0] for _ in range(3)] == [2, 1, 3]
+
+
+def test_lane_queue_rejects_when_lane_full():
+    queue = LaneQueue({INTERACTIVE: 1, BULK: 1})
+    assert queue.put(job(INTERACTIVE))
+    assert not queue.put(job(INTERACTIVE))
+    assert not queue.put(job(INTERACTIVE), block=True, timeout=0.05)
+    # Полосы независимы: переполненная interactive не мешает рассылке
+    assert queue.put(job(BULK))
+
+
+def test_lane_queue_ready_delayed_jobs_go_first():
+    queue = LaneQueue({INTERACTIVE: 10, BULK: 10})
+    queue.put(job(INTERACTIVE, 1))
+    queue.put_delayed(job(INTERACTIVE, 2), ready_at=0)
+    assert queue.depth() == {INTERACTIVE: 1, BULK: 0, "delayed": 1}
+    assert [queue.get().args[0] for _ in range(2)] == [2, 1]
+
+
+def test_lane_queue_join_waits_for_delayed_jobs():
+    queue = LaneQueue({INTERACTIVE: 10, BULK: 10})
+    queue.put_delayed(job(), ready_at=0)
+    assert not queue.join(0.05)
+    queue.get()
+    queue.task_done()
+    assert queue.join(0.05)
+
+
+def test_transient_error_retried_until_success(api, make_dispatcher):
+    api.responses = [FakeResponse(503), FakeResponse(502), FakeResponse(200)]
+    dispatcher = make_dispatcher(max_retries=3)
+    outcome = Outcome()
+    assert dispatcher.send_message(1, {"text": "hi"}, "token", callback=outcome)
+    assert outcome.wait() == (True, 200)
+    assert len(api.calls) == 3
+    stats = dispatcher.stats()
+    assert stats["retried"] == 2
+    assert stats["completed"] == 1
+    assert stats["failed"] == 0
+
+
+def test_gives_up_after_max_retries(api, make_dispatcher):
+    api.responses = [FakeResponse(500)] * 5
+    dispatcher = make_dispatcher(max_retries=2)
+    outcome = Outcome()
+    dispatcher.send_message(1, {}, "token", callback=outcome)
+    assert outcome.wait() == (False, 500)
+    assert len(api.calls) == 3
+    assert dispatcher.stats()["failed"] == 1
+
+
+def test_client_error_not_retried(api, make_dispatcher):
+    api.responses = [FakeResponse(400)]
+    dispatcher = make_dispatcher()
+    outcome = Outcome()
+    dispatcher.send_message(1, {}, "token", callback=outcome)
+    assert outcome.wait() == (False, 400)
+    assert len(api.calls) == 1
+    assert dispatcher.stats()["retried"] == 0
+
+
+def test_network_error_retried(api, make_dispatcher):
+    api.responses = [ConnectionError("reset"), FakeResponse(200)]
+    dispatcher = make_dispatcher()
+    outcome = Outcome()
+    dispatcher.send_message(1, {}, "token", callback=outcome)
+    assert outcome.wait() == (True, 200)
+    assert len(api.calls) == 2
+
+
+def test_network_error_reports_no_status(api, make_dispatcher):
+    api.responses = [ConnectionError("reset")]
+    dispatcher = make_dispatcher(max_retries=0)
+    outcome = Outcome()
+    dispatcher.send_message(1, {}, "token", callback=outcome)
+    assert outcome.wait() == (False, None)
+
+
+def test_429_penalizes_token_for_retry_after(api, make_dispatcher):
+    api.responses = [FakeResponse(429, {"Retry-After": "0.3"}), FakeResponse(200)]
+    dispatcher = make_dispatcher()
+    outcome = Outcome()
+    dispatcher.send_message(1, {}, "token", callback=outcome)
+    assert outcome.wait() == (True, 200)
+    # Повтор ждёт Retry-After, а не backoff
+    assert api.times[1] - api.times[0] >= 0.3
+    stats = dispatcher.stats()
+    assert stats["rate_limited"] == 1
+    assert stats["rate_limits"]["tokens"][mask_token("token")]["http_429"] == 1
+
+
+def test_full_lane_drops_job(api, make_dispatcher, monkeypatch):
+    release = threading.Event()
+    started = threading.Event()
+
+    def blocked(user_id, payload, token):
+        started.set()
+        release.wait(5)
+        return FakeResponse(200)
+
+    monkeypatch.setattr(reqv_to_bot, "send_message", blocked)
+    dispatcher = make_dispatcher(maxsize=1)
+    try:
+        assert dispatcher.send_message(1, {}, "token")
+        assert started.wait(5)
+        # Поток занят первым заданием: одно место в очереди, следующее уже не влезает
+        assert dispatcher.send_message(2, {}, "token")
+        assert not dispatcher.send_message(3, {}, "token")
+        assert dispatcher.send_message(4, {}, "token", lane=BULK)
+        assert dispatcher.stats()["dropped"] == 1
+    finally:
+        release.set()
+
+
+def test_shutdown_drains_queue_then_rejects(api, make_dispatcher):
+    dispatcher = make_dispatcher(workers=2)
+    for user_id in range(20):
+        assert dispatcher.send_message(user_id, {}, "token", lane=BULK if user_id % 2 else INTERACTIVE)
+    dispatcher.shutdown(timeout=5)
+    assert sorted(call[0] for call in api.calls) == list(range(20))
+    assert dispatcher.stats()["completed"] == 20
+    assert dispatcher.stats()["workers"] == 2
+    assert not dispatcher.send_message(99, {}, "token")
+    assert dispatcher.stats()["dropped"] == 1
+
+
+def test_throttled_job_is_delayed_not_dropped(api, make_dispatcher):
+    limiter = RateLimiter(token_rate=1000.0, token_burst=1000, user_rate=10.0, user_burst=1)
+    dispatcher = make_dispatcher(rate_limiter=limiter)
+    outcomes = [Outcome(), Outcome()]
+    for outcome in outcomes:
+        dispatcher.send_message(7, {}, "token", callback=outcome)
+    assert [outcome.wait() for outcome in outcomes] == [(True, 200), (True, 200)]
+    assert dispatcher.stats()["throttled"] >= 1
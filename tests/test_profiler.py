@@ -0,0 +1,75 @@
+import threading
+
+import pytest
+
+import profiler
+
+
+@pytest.fixture
+def busy_thread():
+    """Поток с узнаваемым стеком, который профайлер должен увидеть."""
+    stop = threading.Event()
+
+    def spin_in_test():
+        while not stop.is_set():
+            stop.wait(0.001)
+
+    thread = threading.Thread(target=spin_in_test, name="sampled-7", daemon=True)
+    thread.start()
+    yield thread
+    stop.set()
+    thread.join(5)
+
+
+@pytest.mark.parametrize("seconds, interval", [("inf", "0.01"), ("1", "nan"), ("-inf", "0.01"), ("x", "0.01")])
+def test_parse_params_rejects_non_finite(seconds, interval):
+    with pytest.raises(ValueError):
+        profiler.parse_params(seconds, interval)
+
+
+def test_parse_params_clamps_to_limits():
+    assert profiler.parse_params("5", "0.01") == (5.0, 0.01)
+    assert profiler.parse_params("1e9", "1e9") == (profiler.PROFILER_MAX_SECONDS, profiler.PROFILER_MAX_INTERVAL)
+    assert profiler.parse_params("-3", "0") == (0.0, 0.001)
+
+
+def test_profile_collects_collapsed_stacks(busy_thread):
+    text, samples = profiler.profile(0.1, 0.005, threads="sampled")
+    assert samples > 0
+    lines = text.splitlines()
+    assert lines
+    for line in lines:
+        stack, count = line.rsplit(" ", 1)
+        # Номер потока пула отброшен, корень стека - имя потока
+        assert stack.startswith("sampled;")
+        assert int(count) > 0
+    assert any("test_profiler.busy_thread.<locals>.spin_in_test" in line for line in lines)
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in lines) == samples
+
+
+def test_profile_excludes_calling_thread():
+    text, _ = profiler.profile(0.05, 0.005, threads="MainThread")
+    assert text == ""
+
+
+def test_only_one_profile_at_a_time():
+    assert profiler._busy.acquire(blocking=False)
+    try:
+        assert profiler.profile(0.05, 0.005) is None
+    finally:
+        profiler._busy.release()
+
+
+def test_authorized_requires_configured_token(monkeypatch):
+    assert not profiler.authorized("anything")
+    monkeypatch.setattr(profiler, "PROFILER_TOKEN", "admin")
+    assert profiler.authorized("admin")
+    assert not profiler.authorized("other")
+    assert not profiler.authorized(None)
+
+
+def test_profile_to_file(tmp_path, busy_thread):
+    path = profiler.profile_to_file(0.05, str(tmp_path))
+    assert path.startswith(str(tmp_path))
+    with open(path, encoding="utf-8") as f:
+        assert "sampled;" in f.read()
@@ -0,0 +1,127 @@
+import pytest
+
+import rate_limit
+from rate_limit import RateLimiter, SqliteRateLimiter, TokenBucket, create_limiter, parse_retry_after
+
+
+@pytest.fixture
+def limits(clock, monkeypatch):
+    monkeypatch.setattr(rate_limit, "time", clock)
+    return dict(token_rate=4.0, token_burst=4, user_rate=1.0, user_burst=2, max_user_buckets=100)
+
+
+def test_token_bucket_refills_at_rate():
+    bucket = TokenBucket(rate=2.0, burst=2, now=0.0)
+    bucket.consume(0.0)
+    bucket.consume(0.0)
+    assert bucket.wait_time(0.0) == pytest.approx(0.5)
+    assert bucket.wait_time(0.5) == 0.0
+    # Простой не копит токены сверх burst
+    bucket.consume(100.0)
+    assert bucket.tokens == 1
+
+
+def test_token_burst_then_throttled(clock, limits):
+    limiter = RateLimiter(**limits)
+    assert [limiter.acquire("t") for _ in range(4)] == [0.0] * 4
+    assert limiter.acquire("t") == pytest.approx(0.25)
+    clock.advance(0.25)
+    assert limiter.acquire("t") == 0.0
+    stats = limiter.stats()["tokens"]["t"]
+    assert stats["allowed"] == 5
+    assert stats["throttled"] == 1
+
+
+def test_user_bucket_limits_one_recipient_only(clock, limits):
+    limiter = RateLimiter(**limits)
+    assert limiter.acquire("t", 1) == 0.0
+    assert limiter.acquire("t", 1) == 0.0
+    assert limiter.acquire("t", 1) == pytest.approx(1.0)
+    assert limiter.acquire("t", 2) == 0.0
+    # Отказ по получателю не расходует корзину токена
+    assert limiter.acquire("t") == 0.0
+    assert limiter.acquire("t") > 0
+
+
+def test_penalize_blocks_token_until_retry_after(clock, limits):
+    limiter = RateLimiter(**limits)
+    limiter.penalize("t", 5.0)
+    assert limiter.acquire("t") == pytest.approx(5.0)
+    clock.advance(5.0)
+    assert limiter.acquire("t") == 0.0
+    assert limiter.stats()["tokens"]["t"]["http_429"] == 1
+
+
+def test_least_recent_user_buckets_are_evicted(clock, limits):
+    limiter = RateLimiter(**dict(limits, max_user_buckets=2))
+    for user_id in (1, 2, 3):
+        limiter.acquire("t", user_id)
+        clock.advance(1.0)
+    assert limiter.stats()["user_buckets"] == 2
+
+
+def test_stats_mask_tokens(limits):
+    limiter = RateLimiter(**limits)
+    limiter.acquire("1234567890")
+    assert list(limiter.stats()["tokens"]) == ["123456…"]
+
+
+@pytest.mark.parametrize("value, expected", [("2", 2.0), ("-1", 0.0), ("", None), (None, None), ("soon", None)])
+def test_parse_retry_after(value, expected):
+    assert parse_retry_after(value) == expected
+
+
+def test_sqlite_buckets_are_shared_between_limiters(tmp_path, clock, limits):
+    path = str(tmp_path / "rate.db")
+    first = SqliteRateLimiter(path=path, **limits)
+    second = SqliteRateLimiter(path=path, **limits)
+    assert first.acquire("t") == 0.0
+    assert second.acquire("t") == 0.0
+    assert first.acquire("t") == 0.0
+    assert second.acquire("t") == 0.0
+    assert first.acquire("t") == pytest.approx(0.25)
+    assert second.acquire("t", 7) == pytest.approx(0.25)
+    clock.advance(0.25)
+    assert first.acquire("t", 7) == 0.0
+
+
+def test_sqlite_penalize_is_shared(tmp_path, clock, limits):
+    path = str(tmp_path / "rate.db")
+    SqliteRateLimiter(path=path, **limits).penalize("t", 3.0)
+    assert SqliteRateLimiter(path=path, **limits).acquire("t") == pytest.approx(3.0)
+
+
+def test_sqlite_stores_token_hash_only(tmp_path, limits):
+    limiter = SqliteRateLimiter(path=str(tmp_path / "rate.db"), **limits)
+    limiter.acquire("secret-token", 5)
+    keys = [key for key, in limiter._conn().execute("SELECT key FROM buckets")]
+    assert len(keys) == 2
+    assert not any("secret-token" in key for key in keys)
+
+
+def test_sqlite_purge_drops_recovered_user_buckets(tmp_path, clock, limits):
+    limiter = SqliteRateLimiter(path=str(tmp_path / "rate.db"), **limits)
+    limiter.acquire("t", 5)
+    clock.advance(10.0)
+    limiter.purge()
+    assert limiter._conn().execute("SELECT COUNT(*) FROM buckets").fetchone()[0] == 1
+
+
+def test_sqlite_error_falls_back_to_process_buckets(tmp_path, limits):
+    # Каталог вместо файла базы - sqlite3 не откроет его
+    limiter = SqliteRateLimiter(path=str(tmp_path), **limits)
+    assert [limiter.acquire("t") for _ in range(4)] == [0.0] * 4
+    assert limiter.acquire("t") > 0
+
+
+def test_create_limiter_backends():
+    assert type(create_limiter("memory")) is RateLimiter
+    assert create_limiter("sqlite").shared
+    with pytest.raises(ValueError):
+        create_limiter("redis")
+
+
+def test_default_limiter_is_in_process():
+    # Общие корзины в SQLite включает только pre-fork режим (и рассылка явно)
+    assert rate_limit.RATE_LIMIT_BACKEND == "memory"
+    assert type(rate_limit.limiter) is RateLimiter
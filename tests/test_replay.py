@@ -0,0 +1,102 @@
+import json
+import os
+import tempfile
+import time
+
+import pytest
+
+pytest.importorskip("requests")
+
+import outbound_queue  # noqa: E402
+import update_handlers  # noqa: E402
+from bot_registry import Bot  # noqa: E402
+from event_journal import segment_name  # noqa: E402
+from replay import Replay, replay_stream  # noqa: E402
+
+NOW = time.time()
+
+
+def created(mid, chat_id=70, user_id=7):
+    return {"update_type": "message_created",
+            "message": {"body": {"mid": mid}, "recipient": {"chat_id": chat_id}, "sender": {"user_id": user_id}}}
+
+
+def started(user_id, chat_id, timestamp):
+    return {"update_type": "bot_started", "chat_id": chat_id, "user": {"user_id": user_id}, "timestamp": timestamp}
+
+
+def write_segment(log_dir, name, records):
+    os.makedirs(log_dir, exist_ok=True)
+    with open(os.path.join(log_dir, name), "a", encoding="utf-8") as f:
+        for ts, data in records:
+            f.write(json.dumps({"ts": ts, "key": "k", "data": data}, ensure_ascii=False) + "\n")
+
+
+def write_legacy(log_dir, name, updates):
+    os.makedirs(log_dir, exist_ok=True)
+    with open(os.path.join(log_dir, name + ".txt"), "a", encoding="cp1251") as f:
+        for data in updates:
+            f.write(json.dumps(data, ensure_ascii=False) + "\n")
+
+
+@pytest.fixture
+def bots(tmp_path):
+    return [Bot("invest", "webhook", "invest-token", str(tmp_path / "invest"), secret=""),
+            Bot("sotr", "webhook1", "sotr-token", str(tmp_path / "sotr"), secret="")]
+
+
+def mids(stream):
+    return [(bot.name, data["message"]["body"]["mid"]) for _, bot, data in stream]
+
+
+def test_stream_merges_bots_workers_and_legacy_logs(bots):
+    invest, sotr = bots
+    # Процессы-обработчики пишут свои сегменты, каждый - в хронологическом порядке
+    write_segment(invest.log_dir, segment_name(1, "w1"), [(NOW + 1, created("a1")), (NOW + 4, created("a4"))])
+    write_segment(invest.log_dir, segment_name(1, "w2"), [(NOW + 2, created("a2")), (NOW + 6, created("a6"))])
+    legacy = dict(created("a3"), timestamp=int((NOW + 3) * 1000))
+    write_legacy(invest.log_dir, "message_a3", [legacy])
+    write_segment(sotr.log_dir, segment_name(1), [(NOW + 2.5, created("s1")), (NOW + 5, created("s2"))])
+    assert mids(replay_stream(bots)) == [("invest", "a1"), ("invest", "a2"), ("sotr", "s1"), ("invest", "a3"),
+                                         ("invest", "a4"), ("sotr", "s2"), ("invest", "a6")]
+
+
+def test_stream_keeps_order_of_equal_timestamps(bots):
+    invest, _ = bots
+    write_segment(invest.log_dir, segment_name(1), [(NOW, created(f"m{i}")) for i in range(5)])
+    assert mids(replay_stream(bots)) == [("invest", f"m{i}") for i in range(5)]
+
+
+def test_replay_report(bots):
+    invest, sotr = bots
+    write_segment(invest.log_dir, segment_name(1), [
+        (NOW, started(7, 70, int(NOW * 1000))),
+        (NOW + 1, created("m1")),
+        (NOW + 2, created("m1")),  # Повторная доставка
+        (NOW + 3, {"update_type": "chat_title_changed"}),
+    ])
+    write_segment(sotr.log_dir, segment_name(1), [(NOW, started(8, 80, int(NOW * 1000)))])
+    dispatcher = outbound_queue.dispatcher
+    subscribers = update_handlers.subscribers
+
+    report = Replay(bots).run()
+    assert report["events"] == 4
+    assert report["duplicates"] == 1
+    assert report["errors"] == 0
+    assert report["by_type"] == {"bot_started": 2, "message_created": 1, "chat_title_changed": 1}
+    assert report["outbound"] == {"send": 2}
+    assert report["subscribers"] == {"invest": 1, "sotr": 1}
+    assert report["conversations"] == 2
+    # Боевые зависимости обработчиков возвращены на место
+    assert outbound_queue.dispatcher is dispatcher
+    assert update_handlers.subscribers is subscribers
+
+
+def test_replay_removes_scratch_state(bots, tmp_path, monkeypatch):
+    invest, _ = bots
+    write_segment(invest.log_dir, segment_name(1), [(NOW, started(7, 70, int(NOW * 1000)))])
+    scratch_root = tmp_path / "tmp"
+    scratch_root.mkdir()
+    monkeypatch.setattr(tempfile, "tempdir", str(scratch_root))
+    assert Replay(bots).run()["subscribers"] == {"invest": 1, "sotr": 0}
+    assert os.listdir(scratch_root) == []
@@ -0,0 +1,135 @@
+import json
+import os
+
+import pytest
+
+from subscribers import LOG_FILE, SNAPSHOT_FILE, SubscriberRegistry
+
+
+@pytest.fixture
+def registries(tmp_path):
+    """Фабрика реестров на одном каталоге - как процессы pre-fork режима."""
+    created = []
+
+    def create(**kwargs):
+        registry = SubscriberRegistry(str(tmp_path), refresh_interval=0, **kwargs)
+        created.append(registry)
+        return registry
+
+    yield create
+    for registry in created:
+        registry.close()
+
+
+def log_lines(directory):
+    with open(os.path.join(directory, LOG_FILE), "rb") as f:
+        return f.read().splitlines()
+
+
+def test_changes_visible_immediately_and_after_reload(registries):
+    first = registries()
+    first.subscribe("invest", 1, 100)
+    first.subscribe("invest", 2, 200)
+    first.unsubscribe("invest", 1)
+    assert first.active("invest") == [(2, 200)]
+    first.close()
+    second = registries()
+    assert second.active("invest") == [(2, 200)]
+    assert not second.is_active("invest", 1)
+
+
+def test_log_records_replayed_by_other_registry(registries):
+    first = registries()
+    second = registries()
+    first.subscribe("invest", 1, 100)
+    first.flush()
+    assert second.chat_id("invest", 1) == 100
+    second.unsubscribe("invest", 1)
+    second.subscribe("sotr", 5, 500)
+    second.flush()
+    assert not first.is_active("invest", 1)
+    assert first.count("sotr") == 1
+
+
+def test_unflushed_changes_survive_refresh(registries):
+    first = registries()
+    second = registries()
+    second.subscribe("invest", 1, 100)
+    second.flush()
+    first.subscribe("invest", 2, 200)
+    # Чужая запись дочитывается поверх, своя незаписанная не теряется
+    assert sorted(first.active("invest")) == [(1, 100), (2, 200)]
+
+
+def test_compaction_writes_snapshot_and_truncates_log(tmp_path, registries):
+    first = registries(compact_every=3)
+    for user_id in range(5):
+        first.subscribe("invest", user_id, user_id * 10)
+    first.unsubscribe("invest", 0)
+    first.flush()
+    assert len(log_lines(str(tmp_path))) < 3
+    with open(tmp_path / SNAPSHOT_FILE, encoding="utf-8") as f:
+        snapshot = json.load(f)
+    assert len(snapshot["bots"]["invest"]) >= 3
+    second = registries()
+    assert sorted(second.active("invest")) == [(1, 10), (2, 20), (3, 30), (4, 40)]
+
+
+def test_registry_reloads_log_compacted_by_other(registries):
+    first = registries(compact_every=2)
+    second = registries()
+    second.subscribe("invest", 7, 70)
+    second.flush()
+    assert first.is_active("invest", 7)
+    first.subscribe("invest", 8, 80)
+    first.subscribe("invest", 9, 90)
+    first.flush()  # Снимок и новый лог - у second устаревший дескриптор и смещение
+    second.subscribe("invest", 10, 100)
+    second.flush()
+    assert sorted(registries().active("invest")) == [(7, 70), (8, 80), (9, 90), (10, 100)]
+
+
+def test_reset_replaces_only_listed_bots(registries):
+    first = registries()
+    first.subscribe("invest", 1, 100)
+    first.subscribe("sotr", 2, 200)
+    first.reset({"invest": {3: 300}}, bots=["invest", "iq"])
+    assert first.active("invest") == [(3, 300)]
+    assert first.active("sotr") == [(2, 200)]
+    assert first.count("iq") == 0
+    assert registries().active("sotr") == [(2, 200)]
+
+
+EVENTS = [
+    {"update_type": "bot_started", "timestamp": 1, "chat_id": 100, "user": {"user_id": 1}},
+    {"update_type": "bot_started", "timestamp": 2, "chat_id": 200, "user": {"user_id": 2}},
+    {"update_type": "bot_stopped", "timestamp": 3, "user": {"user_id": 1}},
+    {"update_type": "message_created", "timestamp": 4},
+]
+
+
+def write_journal(log_dir, events):
+    log_dir.mkdir(exist_ok=True)
+    with open(log_dir / "journal-00000001.jsonl", "a", encoding="utf-8") as f:
+        for event in events:
+            f.write(json.dumps({"ts": 0, "key": "k", "data": event}) + "\n")
+    return str(log_dir)
+
+
+def test_rebuild_from_journal(tmp_path, registries):
+    log_dir = write_journal(tmp_path / "logs", EVENTS)
+    registry = registries()
+    assert registry.rebuild({"invest": log_dir}) == {"invest": 1}
+    assert registry.active("invest") == [(2, 200)]
+
+
+def test_first_start_seeds_from_journal(tmp_path, registries):
+    log_dir = write_journal(tmp_path / "logs", EVENTS)
+    registry = registries(seed=lambda: {"invest": log_dir})
+    assert registry.active("invest") == [(2, 200)]
+    assert os.path.exists(tmp_path / SNAPSHOT_FILE)
+    registry.close()
+    # Снимок уже есть: журнал повторно не читается
+    write_journal(tmp_path / "logs", [{"update_type": "bot_started", "timestamp": 5, "chat_id": 300,
+                                       "user": {"user_id": 3}}])
+    assert registries(seed=lambda: {"invest": log_dir}).active("invest") == [(2, 200)]
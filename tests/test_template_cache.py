@@ -0,0 +1,119 @@
+import json
+import time
+
+import pytest
+
+from template_cache import PreparedPayload, TemplateCache
+
+
+@pytest.fixture
+def directory(tmp_path):
+    (tmp_path / "hello.json").write_text('{"text": "Привет"}', encoding="utf-8")
+    return tmp_path
+
+
+@pytest.fixture
+def cache(directory):
+    cache = TemplateCache(str(directory), poll_interval=0)
+    yield cache
+    cache.stop()
+
+
+def rewrite(path, text):
+    # Другой размер - изменение видно даже при грубом mtime файловой системы
+    path.write_text(text, encoding="utf-8")
+
+
+def test_json_template_by_name(cache):
+    assert cache.get_json("hello") == {"text": "Привет"}
+    assert cache.get_bytes("hello") == '{"text":"Привет"}'.encode("utf-8")
+    assert cache.get_json("missing", default={}) == {}
+    stats = cache.stats()
+    assert (stats["misses"], stats["hits"], stats["loads"]) == (2, 1, 1)
+
+
+def test_preload_reads_directory(cache, directory):
+    (directory / "readme.txt").write_text("Описание", encoding="utf-8")
+    assert cache.preload() == 2
+    cache.get_json("hello")
+    assert cache.stats()["hits"] == 1
+
+
+def test_text_template_encoding_is_part_of_key(cache, directory):
+    path = directory / "about.txt"
+    path.write_bytes("О боте\n".encode("cp1251"))
+    assert cache.get_text(str(path), encoding="cp1251") == "О боте"
+    # Тот же файл в другой кодировке - отдельная запись, а не закэшированный cp1251-текст
+    assert cache.get_text(str(path), default="-") == "-"
+    assert cache.get_text(str(path), encoding="cp1251") == "О боте"
+    assert cache.stats()["hits"] == 1
+
+
+def test_text_lookup_does_not_add_json_extension(cache, directory):
+    (directory / "notes").write_text("без расширения", encoding="utf-8")
+    assert cache.get_text("notes") == "без расширения"
+    assert cache.get_json("notes") is None
+
+
+def test_changed_file_reloaded(cache, directory):
+    assert cache.get_json("hello") == {"text": "Привет"}
+    rewrite(directory / "hello.json", '{"text": "Здравствуйте"}')
+    cache._check()
+    assert cache.get_json("hello") == {"text": "Здравствуйте"}
+    assert cache.stats()["reloads"] == 1
+
+
+def test_new_file_picked_up(cache, directory):
+    cache.preload()
+    (directory / "bye.json").write_text('{"text": "Пока"}', encoding="utf-8")
+    cache._check()
+    misses = cache.stats()["misses"]
+    assert cache.get_json("bye") == {"text": "Пока"}
+    assert cache.stats()["misses"] == misses
+
+
+def test_broken_file_keeps_previous_version(cache, directory):
+    cache.get_json("hello")
+    rewrite(directory / "hello.json", '{"text": ')
+    cache._check()
+    assert cache.get_json("hello") == {"text": "Привет"}
+    assert cache.stats()["errors"] == 1
+
+
+def test_background_poll(directory):
+    cache = TemplateCache(str(directory), poll_interval=0.02)
+    cache.start()
+    try:
+        rewrite(directory / "hello.json", '{"text": "Новое приветствие"}')
+        deadline = time.monotonic() + 5
+        while cache.get_json("hello") != {"text": "Новое приветствие"} and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert cache.get_json("hello") == {"text": "Новое приветствие"}
+    finally:
+        cache.stop()
+
+
+
+def test_static_payload_returns_same_bytes(cache):
+    prepared = cache.get_prepared("hello")
+    assert prepared.is_static
+    assert prepared.render({"user_id": 1}) is prepared.raw
+
+
+def test_render_splices_values():
+    prepared = PreparedPayload.from_value({"text": "Привет, {name}! Чат {chat_id}", "buttons": {}})
+    assert not prepared.is_static
+    body = prepared.render({"name": "Анна", "chat_id": 70})
+    assert json.loads(body) == {"text": "Привет, Анна! Чат 70", "buttons": {}}
+
+
+def test_render_escapes_values():
+    prepared = PreparedPayload.from_value({"text": "{value}"})
+    value = 'кавычка " и \\ слэш\nстрока'
+    assert json.loads(prepared.render({"value": value})) == {"text": value}
+
+
+def test_missing_values_keep_placeholder():
+    prepared = PreparedPayload.from_value({"text": "{a} {b}"})
+    assert json.loads(prepared.render({"b": None})) == {"text": "{a} {b}"}
+    assert prepared.render() == prepared.raw
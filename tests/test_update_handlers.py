@@ -0,0 +1,118 @@
+import json
+
+import pytest
+
+pytest.importorskip("requests")
+
+import update_handlers  # noqa: E402
+from bot_registry import Bot  # noqa: E402
+from event_journal import get_journal, iter_records  # noqa: E402
+from idempotency import IdempotencyCache  # noqa: E402
+from subscribers import SubscriberRegistry  # noqa: E402
+from update_handlers import DUPLICATE, FAILED, UpdateContext, process_update  # noqa: E402
+
+
+@pytest.fixture
+def bot(tmp_path):
+    bot = Bot("invest", "webhook", "invest-token", str(tmp_path / "logs"), secret="")
+    yield bot
+    get_journal(bot.log_dir).close(5)
+
+
+@pytest.fixture
+def subscribers(tmp_path, monkeypatch):
+    registry = SubscriberRegistry(str(tmp_path / "subscribers"), refresh_interval=0)
+    monkeypatch.setattr(update_handlers, "subscribers", registry)
+    yield registry
+    registry.close()
+
+
+@pytest.fixture(autouse=True)
+def handlers_state(conversations, monkeypatch):
+    monkeypatch.setattr(update_handlers, "conversations", conversations)
+    monkeypatch.setattr(update_handlers, "processed_updates", IdempotencyCache(ttl=60, max_size=100))
+
+
+def journal(bot):
+    get_journal(bot.log_dir).flush(5)
+    return list(iter_records(bot.log_dir))
+
+
+def started(user_id=7, chat_id=70, timestamp=1000):
+    return {"update_type": "bot_started", "chat_id": chat_id, "user": {"user_id": user_id}, "timestamp": timestamp}
+
+
+def created(mid="m1", chat_id=70, user_id=7):
+    return {"update_type": "message_created",
+            "message": {"body": {"mid": mid, "text": "hi"}, "recipient": {"chat_id": chat_id},
+                        "sender": {"user_id": user_id}}}
+
+
+def callback(payload, callback_id="cb1", user_id=7, mid="m1"):
+    return {"update_type": "message_callback",
+            "callback": {"callback_id": callback_id, "payload": payload, "user": {"user_id": user_id}},
+            "message": {"body": {"mid": mid}, "recipient": {"chat_id": 70}}}
+
+
+def test_context_parses_callback_fields():
+    ctx = UpdateContext(None, callback("CITY_TGN"))
+    assert (ctx.update_type, ctx.chat_id, ctx.user_id) == ("message_callback", 70, 7)
+    assert (ctx.message_id, ctx.callback_id, ctx.payload) == ("m1", "cb1", "CITY_TGN")
+
+
+def test_bot_started_greets_and_subscribes(bot, outbox, subscribers, conversations):
+    response = process_update(bot, started())
+    (kind, (user_id, payload, token)), = outbox.calls
+    assert (kind, user_id, token) == ("send", 7, "invest-token")
+    # Тот же байтовый ответ уходит и в API, и в ответ вебхука
+    assert payload is response
+    assert json.loads(payload)["text"].startswith("Добро пожаловать")
+    assert subscribers.chat_id("invest", 7) == 70
+    assert conversations.get("invest", 7).step == "start"
+    assert [record["key"] for record in journal(bot)] == ["start_70"]
+
+
+def test_bot_stopped_unsubscribes_and_clears_state(bot, outbox, subscribers, conversations):
+    process_update(bot, started())
+    process_update(bot, dict(started(timestamp=2000), update_type="bot_stopped"))
+    assert not subscribers.is_active("invest", 7)
+    assert conversations.get("invest", 7) is None
+    assert [record["key"] for record in journal(bot)] == ["start_70", "stop_70"]
+
+
+def test_message_created_is_journaled(bot, outbox):
+    assert process_update(bot, created()) == ""
+    records = journal(bot)
+    assert [record["key"] for record in records] == ["message_m1_chat_id_70"]
+    assert records[0]["data"] == created()
+    assert outbox.calls == []
+
+
+def test_callback_runs_route_actions(bot, outbox, conversations):
+    process_update(bot, callback("CITY_TGN"))
+    assert [kind for kind, _ in outbox.calls] == ["delete", "send"]
+    assert outbox.calls[0][1] == ("m1", "invest-token")
+    assert conversations.get("invest", 7).data == {"city": "TGN"}
+    assert [record["key"] for record in journal(bot)] == ["callback_id_cb1_chat_id_70"]
+
+
+def test_unknown_update_type_ignored(bot, outbox):
+    assert process_update(bot, {"update_type": "chat_title_changed", "chat_id": 70}) == ""
+    assert journal(bot) == []
+
+
+def test_redelivered_update_is_duplicate(bot, outbox):
+    assert process_update(bot, created()) == ""
+    assert process_update(bot, created()) is DUPLICATE
+    assert len(journal(bot)) == 1
+
+
+def test_failed_update_can_be_redelivered(bot, outbox, monkeypatch):
+    def broken(ctx):
+        raise RuntimeError("boom")
+
+    monkeypatch.setitem(update_handlers.UPDATE_HANDLERS, "message_created", broken)
+    assert process_update(bot, created()) is FAILED
+    monkeypatch.setitem(update_handlers.UPDATE_HANDLERS, "message_created", update_handlers.on_message_created)
+    assert process_update(bot, created()) == ""
+    assert len(journal(bot)) == 1
@@ -0,0 +1,117 @@
+import io
+import logging
+
+import pytest
+
+import metrics
+from bot_registry import BOTS_BY_ROUTE, Bot
+from webhook_auth import SignatureMiddleware, SignatureVerifier, WebhookAuth
+
+BODY = b'{"update_type":"message_created"}'
+
+
+@pytest.fixture
+def bots():
+    return [Bot("a", "wa", "ta", "logs/a", secret="secret-a"),
+            Bot("b", "wb", "tb", "logs/b", secret="secret-a"),
+            Bot("open", "wo", "to", "logs/o", secret="")]
+
+
+def counts(name):
+    return [metrics.signature_checks.value(name, result) for result in ("verified", "rejected")]
+
+
+def test_sign_matches_known_hmac():
+    # echo -n body | openssl dgst -sha256 -hmac secret
+    signature = SignatureVerifier("secret").sign(b"body")
+    assert signature == "sha256=dc46983557fea127b43af721467eb9b3fde2338fe3e14f51952aa8478c13d355"
+
+
+def test_verify_accepts_header_formats():
+    verifier = SignatureVerifier("secret")
+    digest = verifier.sign(BODY).split("=", 1)[1]
+    assert verifier.verify(BODY, "sha256=" + digest)
+    assert verifier.verify(BODY, digest)
+    assert verifier.verify(BODY, "sha256=" + digest.upper())
+
+
+@pytest.mark.parametrize("header", [None, "", "sha256=abc", "sha256=" + "0" * 64])
+def test_verify_rejects_bad_signatures(header):
+    assert not SignatureVerifier("secret").verify(BODY, header)
+
+
+def test_verify_rejects_other_body_or_secret():
+    signature = SignatureVerifier("secret").sign(BODY)
+    assert not SignatureVerifier("secret").verify(BODY + b" ", signature)
+    assert not SignatureVerifier("other").verify(BODY, signature)
+
+
+def test_enforce_mode_rejects_and_counts(bots):
+    auth = WebhookAuth(bots, mode="enforce")
+    before = counts("a")
+    assert auth.check(bots[0], BODY, auth.verifier(bots[0]).sign(BODY))
+    assert not auth.check(bots[0], BODY, "sha256=" + "0" * 64)
+    assert not auth.check(bots[0], BODY, None)
+    assert [now - was for now, was in zip(counts("a"), before)] == [1, 2]
+
+
+def test_log_mode_accepts_but_counts(caplog):
+    bot = Bot("log-mode", "wl", "tl", "logs/l", secret="secret-l")
+    auth = WebhookAuth([bot], mode="log")
+    with caplog.at_level(logging.WARNING, logger="webhook_auth"):
+        assert auth.check(bot, BODY, None)
+        assert auth.check(bot, BODY, "sha256=" + "0" * 64)
+    assert counts("log-mode") == [0, 2]
+    # Предупреждение - на первую и каждую WEBHOOK_SIGNATURE_LOG_EVERY-ю неверную подпись
+    assert caplog.text.count("accepted in log mode") == 1
+
+
+def test_off_mode_and_bot_without_secret_skip_check(bots):
+    assert WebhookAuth(bots, mode="off").check(bots[0], BODY, None)
+    auth = WebhookAuth(bots, mode="enforce")
+    assert auth.verifier(bots[2]) is None
+    assert auth.check(bots[2], BODY, None)
+
+
+def test_bots_with_same_secret_share_verifier(bots):
+    auth = WebhookAuth(bots)
+    assert auth.verifier(bots[0]) is auth.verifier(bots[1])
+    assert set(auth.stats()["bots"]) == {"a", "b"}
+
+
+def test_unknown_mode_rejected(bots):
+    with pytest.raises(ValueError):
+        WebhookAuth(bots, mode="strict")
+
+
+def test_default_bots_come_from_config():
+    auth = WebhookAuth()
+    # Без WEBHOOK_SIGNATURE_MODE в config запросы не отклоняются, пока подпись не включена явно
+    assert auth.mode == "log"
+    assert set(auth.stats()["bots"]) == {"invest"}
+
+
+def call(middleware, path, body, signature=None):
+    environ = {"REQUEST_METHOD": "POST", "PATH_INFO": path, "CONTENT_LENGTH": str(len(body)),
+               "wsgi.input": io.BytesIO(body)}
+    if signature is not None:
+        environ["HTTP_X_HUB_SIGNATURE_256"] = signature
+    status = []
+    result = middleware(environ, lambda s, headers: status.append(s))
+    return status[0], b"".join(result)
+
+
+def echo(environ, start_response):
+    start_response("200 OK", [])
+    return [environ["wsgi.input"].read()]
+
+
+def test_middleware_rejects_unsigned_request_before_app():
+    bot = BOTS_BY_ROUTE["webhook"]
+    middleware = SignatureMiddleware(echo, WebhookAuth(mode="enforce"))
+    assert call(middleware, "/webhook", BODY)[0] == "403 FORBIDDEN"
+    # Приложению достаётся уже прочитанное тело целиком
+    signature = SignatureVerifier(bot.secret).sign(BODY)
+    assert call(middleware, "/webhook", BODY, signature) == ("200 OK", BODY)
+    # У бота без секрета подпись не проверяется
+    assert call(middleware, "/webhook1", BODY) == ("200 OK", BODY)
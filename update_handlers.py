@@ -0,0 +1,162 @@
+import logging
+import re
+import time
+
+import reqv_to_bot as reqv
+from app_logging import payload_level
+from callback_router import router
+from conversation_state import conversations
+from event_journal import get_journal
+from idempotency import create_cache, update_key
+import metrics
+import outbound_queue
+from bot_registry import BOTS
+from subscribers import registry as subscribers
+from template_cache import PreparedPayload, templates
+
+logger = logging.getLogger(__name__)
+
+# Маркер ответа для повторно доставленного update
+DUPLICATE = object()
+# Маркер ответа для update, обработчик которого завершился исключением (уже записано в лог)
+FAILED = object()
+
+# Приветствие на случай, если templates/hello_message.json недоступен
+_HELLO_FALLBACK = PreparedPayload.from_value(reqv.hello_message)
+
+# Кэш идемпотентности: в памяти процесса или общий для нескольких процессов (IDEMPOTENCY_BACKEND)
+processed_updates = create_cache()
+
+# Каталог журнала -> имя бота (метка метрик для save_message_to_log)
+_BOT_BY_LOG_DIR = {bot.log_dir: bot.name for bot in BOTS}
+
+
+def sanitize_filename(name):
+    """Оставляет в имени файла только безопасные символы (цифры и буквы)."""
+    if name is None:
+        return "unknown"
+    # Разрешаем только цифры, буквы, дефис и подчеркивание
+    return re.sub(r'[^\w\-]', '', str(name))
+
+
+def save_message_to_log(filename, data, dir):
+    """
+    Ставит входящее сообщение в журнал бота (каталог dir).
+    Запись на диск пачками делает фоновый поток журнала.
+    """
+    started = time.perf_counter()
+    try:
+        get_journal(dir).append(sanitize_filename(filename), data)
+    except Exception as e:
+        logger.exception("Error saving log for %s: %s", filename, e)
+    metrics.journal_seconds.observe(time.perf_counter() - started, _BOT_BY_LOG_DIR.get(dir, dir))
+
+
+def is_message_processed(message_id):
+    """Проверяет, обрабатывалось ли уже это сообщение (идемпотентность)."""
+    return processed_updates.seen(message_id)
+
+
+class UpdateContext:
+    """Поля update, разобранные один раз и доступные всем обработчикам."""
+
+    __slots__ = ("bot", "data", "update_type", "chat_id", "user_id", "message_id",
+                 "callback_id", "payload", "response")
+
+    def __init__(self, bot, data):
+        message = data.get('message') or {}
+        recipient = message.get('recipient') or {}
+        callback = data.get('callback') or {}
+        user = data.get('user') or callback.get('user') or message.get('sender') or recipient
+
+        self.bot = bot
+        self.data = data
+        self.update_type = data.get('update_type')
+        self.chat_id = data.get('chat_id') or recipient.get('chat_id')
+        self.user_id = user.get('user_id')
+        self.message_id = (message.get('body') or {}).get('mid')
+        self.callback_id = callback.get('callback_id')
+        self.payload = callback.get('payload')
+        self.response = ''
+
+
+# ==================== ОБРАБОТЧИКИ UPDATE ====================
+
+def on_message_created(ctx):
+    save_message_to_log(f"message_{ctx.message_id}_chat_id_{ctx.chat_id}", ctx.data, ctx.bot.log_dir)
+
+
+def on_message_callback(ctx):
+    save_message_to_log(f"callback_id_{ctx.callback_id}_chat_id_{ctx.chat_id}", ctx.data, ctx.bot.log_dir)
+    # Действия кнопок описаны в callbacks.json (см. callback_router.py)
+    router.dispatch(ctx)
+
+
+def on_bot_started(ctx):
+    # Приветствие из templates/hello_message.json уже сериализовано в байты:
+    # ни отправка, ни ответ вебхука не вызывают json.dumps
+    hello = templates.get_prepared("hello_message") or _HELLO_FALLBACK
+    ctx.response = hello.render({"user_id": ctx.user_id, "chat_id": ctx.chat_id})
+    outbound_queue.dispatcher.send_message(ctx.user_id, ctx.response, ctx.bot.token)
+    subscribers.subscribe(ctx.bot.name, ctx.user_id, ctx.chat_id)
+    # /start начинает сценарий заново
+    conversations.set(ctx.bot.name, ctx.user_id, "start")
+    save_message_to_log(f"start_{ctx.chat_id}", ctx.data, ctx.bot.log_dir)
+
+
+def on_bot_stopped(ctx):
+    subscribers.unsubscribe(ctx.bot.name, ctx.user_id)
+    conversations.clear(ctx.bot.name, ctx.user_id)
+    save_message_to_log(f"stop_{ctx.chat_id}", ctx.data, ctx.bot.log_dir)
+
+
+# update_type -> обработчик
+UPDATE_HANDLERS = {
+    "message_created": on_message_created,
+    "message_callback": on_message_callback,
+    "bot_started": on_bot_started,
+    "bot_stopped": on_bot_stopped,
+}
+
+
+def handle_update(bot, data):
+    """Обрабатывает разобранный update бота и возвращает тело ответа для вебхука."""
+    ctx = UpdateContext(bot, data)
+    handler = UPDATE_HANDLERS.get(ctx.update_type)
+    if handler is None:
+        logger.info("Received unknown update type %s", ctx.update_type)
+        return ctx.response
+
+    handler(ctx)
+    # Полный дамп update - на DEBUG, в обычный лог - только выборка (app_logging.py)
+    level = payload_level(logger, ctx.update_type) if ctx.update_type and ctx.chat_id else None
+    if level is not None:
+        logger.log(level, "Webhook [%s]|%s", ctx.update_type, data)
+    return ctx.response
+
+
+def process_update(bot, data):
+    """
+    Полный конвейер для одного update: идемпотентность -> обработчик.
+    Возвращает DUPLICATE для повторно доставленного update и FAILED, если обработчик упал.
+    """
+    update_type = data.get("update_type") if isinstance(data, dict) else None
+    # Метка - только известные типы, чтобы мусорные update не плодили серии метрик
+    label = update_type if update_type in UPDATE_HANDLERS else "unknown"
+    key = update_key(bot.name, data)
+    if is_message_processed(key):
+        metrics.updates.inc(bot.name, label, "duplicate")
+        return DUPLICATE
+    started = time.perf_counter()
+    try:
+        response = handle_update(bot, data)
+        result = "ok"
+    except Exception as e:
+        logger.exception("Error during logging phase: %s", e)
+        # Не прерываем обработку, если упало логирование.
+        # Отметку снимаем: повторная доставка этого update должна обработаться, а не считаться дублем
+        processed_updates.forget(key)
+        response, result = FAILED, "error"
+    metrics.update_seconds.observe(time.perf_counter() - started, bot.name, label)
+    metrics.updates.inc(bot.name, label, result)
+    return response
@@ -0,0 +1,134 @@
+import hashlib
+import hmac
+import io
+import logging
+
+import config
+import metrics
+from bot_registry import BOTS, BOTS_BY_ROUTE
+
+logger = logging.getLogger(__name__)
+
+# ==================== КОНФИГУРАЦИЯ ====================
+# "log" - неверная подпись только пишется в лог и считается, "enforce" - такие запросы получают 403,
+# "off" - не проверять. Включать "enforce" после того, как в логе нет отклонённых подписей
+WEBHOOK_SIGNATURE_MODE = getattr(config, "WEBHOOK_SIGNATURE_MODE", "log")
+WEBHOOK_SIGNATURE_LOG_EVERY = getattr(config, "WEBHOOK_SIGNATURE_LOG_EVERY", 1000)  # В режиме log - каждую N-ю
+
+SIGNATURE_HEADERS = ("X-Hub-Signature-256", "X-Hub-Signature")
+_FORBIDDEN = b'{"error":"Forbidden"}'
+
+
+class SignatureVerifier:
+    """
+    HMAC-SHA256 подпись тела запроса одним секретом.
+    Ключ обрабатывается один раз в конструкторе; на запрос - copy() готового состояния
+    и хэширование тела.
+    """
+
+    def __init__(self, secret):
+        self._keyed = hmac.new(secret.encode("utf-8"), digestmod=hashlib.sha256)
+        self._hex_size = self._keyed.digest_size * 2
+
+    def sign(self, body):
+        """Значение заголовка X-Hub-Signature-256 для тела (нужно для тестовых клиентов)."""
+        h = self._keyed.copy()
+        h.update(body)
+        return "sha256=" + h.hexdigest()
+
+    def verify(self, body, header_signature):
+        """True, если подпись верна. Ожидаемый формат: sha256=hexdigest или просто hexdigest."""
+        if not header_signature:
+            return False
+        if "=" in header_signature:
+            header_signature = header_signature.split("=", 1)[1]
+        # Мусор неверной длины отсекаем без хэширования тела
+        if len(header_signature) != self._hex_size:
+            return False
+        h = self._keyed.copy()
+        h.update(body)
+        return hmac.compare_digest(h.hexdigest(), header_signature.lower())
+
+
+class WebhookAuth:
+    """Проверка подписи вебхуков всех ботов реестра со счётчиками по ботам."""
+
+    def __init__(self, bots=None, mode=WEBHOOK_SIGNATURE_MODE):
+        if mode not in ("enforce", "log", "off"):
+            raise ValueError(f"Unknown WEBHOOK_SIGNATURE_MODE: {mode}")
+        self.mode = mode
+        by_secret = {}
+        self._verifiers = {}
+        for bot in (bots or BOTS):
+            if bot.secret:
+                # Боты с одним секретом делят одно подготовленное состояние
+                self._verifiers[bot.name] = by_secret.setdefault(bot.secret, SignatureVerifier(bot.secret))
+
+    def verifier(self, bot):
+        return self._verifiers.get(bot.name)
+
+    def check(self, bot, body, header_signature):
+        """
+        True - запрос можно обрабатывать. Бот без секрета и режим "off" не проверяются;
+        в режиме "log" (по умолчанию) неверная подпись только пишется в лог и учитывается.
+        """
+        verifier = self._verifiers.get(bot.name)
+        if verifier is None or self.mode == "off":
+            return True
+        ok = verifier.verify(body, header_signature)
+        metrics.signature_checks.inc(bot.name, "verified" if ok else "rejected")
+        if ok:
+            return True
+        if self.mode == "log":
+            rejected = metrics.signature_checks.value(bot.name, "rejected")
+            # Первая и каждая N-я: без подписи от платформы предупреждение было бы на каждый запрос
+            if WEBHOOK_SIGNATURE_LOG_EVERY <= 1 or rejected % WEBHOOK_SIGNATURE_LOG_EVERY == 1:
+                logger.warning("Webhook signature mismatch for bot %s (%s so far, header %s), accepted in log mode",
+                               bot.name, rejected, "present" if header_signature else "missing")
+            return True
+        return False
+
+    def stats(self):
+        stats = {name: {result: metrics.signature_checks.value(name, result) for result in ("verified", "rejected")}
+                 for name in self._verifiers}
+        return {"mode": self.mode, "bots": stats}
+
+
+auth = WebhookAuth()
+
+
+class SignatureMiddleware:
+    """
+    WSGI-прослойка перед Flask: для POST на маршрут бота читает сырое тело и проверяет
+    подпись до маршрутизации и разбора JSON. Неподписанный запрос получает 403,
+    не создавая объектов Flask; прошедший - тело заново отдаётся приложению.
+    """
+
+    def __init__(self, app, webhook_auth=None):
+        self.app = app
+        self.auth = webhook_auth or auth
+
+    def __call__(self, environ, start_response):
+        if environ.get("REQUEST_METHOD") != "POST":
+            return self.app(environ, start_response)
+        bot = BOTS_BY_ROUTE.get(environ.get("PATH_INFO", "").strip("/"))
+        if bot is None or self.auth.verifier(bot) is None:
+            return self.app(environ, start_response)
+
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            length = 0
+        stream = environ["wsgi.input"]
+        body = stream.read(length) if length > 0 else stream.read()
+        signature = environ.get("HTTP_X_HUB_SIGNATURE_256") or environ.get("HTTP_X_HUB_SIGNATURE")
+        if not self.auth.check(bot, body, signature):
+            logger.debug("Invalid signature for %s from %s", bot.name, environ.get("REMOTE_ADDR"))
+            metrics.webhook_requests.inc(bot.name, "403")
+            start_response("403 FORBIDDEN", [("Content-Type", "application/json"),
+                                             ("Content-Length", str(len(_FORBIDDEN)))])
+            return [_FORBIDDEN]
+
+        environ["wsgi.input"] = io.BytesIO(body)
+        environ["CONTENT_LENGTH"] = str(len(body))
+        return self.app(environ, start_response)